@@ -0,0 +1,41 @@
+"""Microbenchmarks for the bloom filter.
+
+Usage::
+
+    python benchmarks/bench_bloomfilter.py [--number N]
+
+"""
+from __future__ import print_function
+
+import argparse
+import hashlib
+import timeit
+
+from scrapy_redis_loadbalancing.bloomfilter import BloomFilter
+
+
+def fingerprints(number):
+    return [hashlib.sha1(str(i).encode()).hexdigest() for i in range(number)]
+
+
+def bench_offsets(number):
+    """Time the bit offset computation alone, no Redis involved."""
+    fps = fingerprints(number)
+    results = {}
+    for mode in ('legacy', 'double'):
+        bf = BloomFilter(server=None, hash_mode=mode)
+        seconds = min(timeit.repeat(lambda: [bf.offsets(fp) for fp in fps], number=1, repeat=3))
+        results[mode] = seconds
+        print('{:>8}: {:8.1f} ns/fingerprint'.format(mode, seconds / number * 1e9))
+    print('speedup: {:.1f}x'.format(results['legacy'] / results['double']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=100000, help='fingerprints per run')
+    args = parser.parse_args()
+    bench_offsets(args.number)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Compare the cuckoo filter with the bloom filter on a live Redis.
+
+Usage::
+
+    python benchmarks/bench_cuckoofilter.py [--number N] [--redis-url URL]
+
+Both filters are sized for N fingerprints at the cuckoo filter's false positive
+rate. N fingerprints are inserted in batches, then N others are looked up to
+measure the observed false positive rate.
+
+"""
+from __future__ import print_function
+
+import argparse
+import hashlib
+import time
+
+import redis
+
+from scrapy_redis_loadbalancing.bloomfilter import BloomFilter
+from scrapy_redis_loadbalancing.cuckoofilter import CuckooFilter
+
+
+def fingerprints(start, number):
+    return [hashlib.sha1(str(i).encode()).hexdigest() for i in range(start, start + number)]
+
+
+def bloom_contains_many(bf):
+    """Read-only lookups; existent_many would also set the bits."""
+    def contains_many(fps):
+        pipe = bf.server.pipeline(transaction=False)
+        for fp in fps:
+            for loc in bf.offsets(fp):
+                pipe.getbit(bf.block(fp), loc)
+        bits = pipe.execute()
+        k = bf.hash_count
+        return [all(bits[i:i + k]) for i in range(0, len(bits), k)]
+    return contains_many
+
+
+def bench(name, filter_, contains_many, keys, server, number):
+    present, absent = fingerprints(0, number), fingerprints(number, number)
+    server.delete(*keys())
+    try:
+        start = time.time()
+        filter_.existent_many(present)
+        seconds = time.time() - start
+        memory = sum(server.strlen(key) for key in keys() if server.type(key) == b'string') * 8
+        false_positives = sum(contains_many(absent))
+        print('{:>7}: {:8.1f} us/insert {:6.1f} bits/entry  fp rate {:.5f}'.format(
+            name, seconds / number * 1e6, float(memory) / number, false_positives / float(number)))
+    finally:
+        server.delete(*keys())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=100000, help='fingerprints per run')
+    parser.add_argument('--redis-url', default='redis://localhost:6379')
+    args = parser.parse_args()
+    server = redis.StrictRedis.from_url(args.redis_url)
+
+    cf = CuckooFilter(server, 'bench:cuckoofilter', capacity=args.number)
+    bf = BloomFilter(server, 'bench:bloomfilter', capacity=args.number, error_rate=cf.false_positive_rate())
+    bf.buerfilter_is_on = False
+    bench('bloom', bf, bloom_contains_many(bf), bf.keys, server, args.number)
+    bench('cuckoo', cf, cf.contains_many, cf.keys, server, args.number)
+
+
+if __name__ == '__main__':
+    main()
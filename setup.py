@@ -32,6 +32,9 @@ setup(
     package_dir={'': 'src'},
     setup_requires=read_requirements('requirements-setup.txt'),
     install_requires=read_requirements('requirements-install.txt'),
+    extras_require={
+        'msgpack': ['msgpack>=1.0'],
+    },
     include_package_data=True,
     license="MIT",
     keywords='scrapy-redis-project',
@@ -6,25 +6,100 @@
 #   优化了前作者的代码,优化了 BuerFilter 提高效率
 # ---------------------------------------
 
-from collections import OrderedDict
+import logging
+import math
+import time
+from array import array
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 没有安装 futures 时各分片依次执行
+    ThreadPoolExecutor = None
 
-class BuerFilter(object):
-    """ 存在的目的是,在短期内,不问服务器同样的问题两次!从而减少网络访问的时间损耗 """
-    """ 如此我们可以利用一个有序字典! 顺序尾部是最近使用的,顺序头部是很久没用的 """
+logger = logging.getLogger(__name__)
 
-    def __init__(self, contain=2000):
-        self.filter = OrderedDict()  # 去重器
-        self.contain = contain  # 约束去重量
+
+class FingerprintCache(object):
+    """ 定长的本地缓存: 短期内不问服务器同样的问题两次
+
+    只保存指纹的前 64 位, 放在一个组相联的表 (array) 里: 指纹按取模落到某一组, 组内 ways 个槽顺序查找,
+    查询与插入都不分配新对象. 组满以后用 CLOCK 算法淘汰: 每组一根指针, 访问过的条目清掉访问位留下,
+    没访问过的被替换. 淘汰只发生在插入的那一组, 表不会出现越来越长的探测链.
+    每个条目占 9 字节 (8 字节指纹 + 1 字节访问位), 每组另有 1 字节的 CLOCK 指针.
+    """
+    ways = 8
+
+    def __init__(self, contain=100000):
+        self.sets = max(1, -(-contain // self.ways))
+        self.contain = self.sets * self.ways  # 约束去重量, 向上取整到整组
+        self.keys = array('Q', [0]) * self.contain  # 0 表示空槽, 组内的空槽总在已用槽之后
+        self.ref = bytearray(self.contain)  # CLOCK 的访问位
+        self.hands = bytearray(self.sets)  # 每组的 CLOCK 指针
+        self.count = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def entries_for(cls, nbytes):
+        """ 内存预算 (字节) 能容纳的条目数 """
+        return max(1, nbytes // (9 * cls.ways + 1)) * cls.ways
+
+    @classmethod
+    def from_memory(cls, nbytes):
+        """ 按内存预算 (字节) 创建 """
+        return cls(cls.entries_for(nbytes))
+
+    def __len__(self):
+        return self.count
 
     def existent(self, url):
-        """ 如果 url 存在返回 True 不存在返回 False """
-        if len(self.filter) >= self.contain and self.filter:  # 控制长度
-            self.filter.pop(next(self.filter.__iter__()))  # 踢掉最不常用的
+        """ 如果指纹存在返回 True, 不存在则记下并返回 False """
+        if self.contains(url):
+            return True
+        self.add(url)
+        return False
 
-        result = self.filter.pop(url, False)
-        self.filter[url] = True
-        return result
+    def contains(self, url):
+        """ 只查询不记录, 指纹存在返回 True """
+        key = int(url[:16], 16) or 1
+        keys = self.keys
+        start = key % self.sets * self.ways
+        for i in range(start, start + self.ways):
+            if keys[i] == key:
+                self.ref[i] = 1
+                self.hits += 1
+                return True
+            if not keys[i]:
+                break
+        self.misses += 1
+        return False
+
+    def add(self, url):
+        """ 记下指纹, 已存在时什么也不做 """
+        key = int(url[:16], 16) or 1
+        keys = self.keys
+        group = key % self.sets
+        start = group * self.ways
+        for i in range(start, start + self.ways):
+            if keys[i] == key:
+                return
+            if not keys[i]:
+                keys[i] = key
+                self.count += 1
+                return
+        keys[self._evict(group, start)] = key
+        self.evictions += 1
+
+    def _evict(self, group, start):
+        """ 在满的组里用 CLOCK 选出被替换的槽 """
+        ref, ways = self.ref, self.ways
+        hand = self.hands[group]
+        while ref[start + hand]:  # 最近访问过, 再给一次机会
+            ref[start + hand] = 0
+            hand = (hand + 1) % ways
+        self.hands[group] = (hand + 1) % ways
+        return start + hand
 
 
 class SimpleHash(object):
@@ -40,40 +115,660 @@ class SimpleHash(object):
 
 
 class BloomFilter(object):
-    def __init__(self, server, key='bloomfilter', blockNum=1, db=0):
+    # KEYS[1] 为脏段有序集合, KEYS[2] 为版本号, 之后为涉及的块; ARGV[1] 为 k, ARGV[2] 为每段的位数;
+    # 之后每个指纹占 1 + k 个参数: 块在 KEYS 中的下标, k 个位置.
+    # 返回每个指纹在置位前是否已全部为 1. 每段的位数大于 0 时, 有位被改动就把版本号加一,
+    # 并把改动过的段以新版本号记进脏段集合, 供本地副本 (ReplicatedBloomFilter) 增量同步; 为 0 时不记录.
+    CHECK_AND_SET_SCRIPT = """
+local k = tonumber(ARGV[1])
+local segment = tonumber(ARGV[2])
+local result = {}
+local dirty = {}
+local changed = false
+for i = 3, #ARGV, k + 1 do
+    local key = KEYS[tonumber(ARGV[i])]
+    local seen = 1
+    for j = 1, k do
+        if redis.call('SETBIT', key, ARGV[i + j], 1) == 0 then
+            seen = 0
+            if segment > 0 then
+                dirty[key .. '@' .. math.floor(tonumber(ARGV[i + j]) / segment)] = true
+                changed = true
+            end
+        end
+    end
+    result[#result + 1] = seen
+end
+if changed then
+    local version = redis.call('INCR', KEYS[2])
+    for member in pairs(dirty) do
+        redis.call('ZADD', KEYS[1], version, member)
+    end
+end
+return result
+"""
+
+    batch_size = 1000  # 每次脚本调用最多处理的指纹数, 避免长时间阻塞 Redis
+    segment_bits = 1 << 19  # 脏段的大小, 64KB
+    track_dirty = False  # 是否记录脏段; 只有本地副本需要, 其他过滤器省掉这部分写入
+
+    MAX_BLOCK_BITS = 1 << 31  # Redis的String类型最大容量为512M，每块最多使用256M
+
+    def __init__(self, server, key='bloomfilter', blockNum=1, db=0, hash_mode='double',
+                 capacity=None, error_rate=None, cache_size=1000):
         """
         :param server: the client of Redis-Cluster
         :param db: witch db in Redis
         :param blockNum: one blockNum for about 90,000,000; if you have more strings for filtering, increase it.
         :param key: the key's name in Redis
+        :param hash_mode: 'double' derives the bit offsets from the SHA1 fingerprint itself (Kirsch-Mitzenmacher);
+                          'legacy' uses SimpleHash and is compatible with bitmaps written by older versions.
+        :param capacity: expected number of fingerprints; together with error_rate it derives the bit count,
+                         the hash count and the block count (blockNum is ignored then). Needs hash_mode='double'.
+        :param error_rate: wanted false positive rate once capacity fingerprints were added.
+        :param cache_size: how many recent fingerprints the local FingerprintCache keeps.
         """
+        if hash_mode not in ('double', 'legacy'):
+            raise ValueError("hash_mode must be 'double' or 'legacy': %r" % hash_mode)
         self.bit_size = 1 << 31  # Redis的String类型最大容量为512M，现使用256M
         self.seeds = [5, 7, 11, 13, 31, 37, 61]
+        self.hash_count = len(self.seeds)
+        self.capacity = capacity
+        self.error_rate = error_rate or 0.001
         self.server = server
         self.key = key
         self.blockNum = blockNum
+        self.hash_mode = hash_mode
+        self.dirty_key = key + ':dirty'
+        self.version_key = key + ':version'
+        if capacity:
+            if hash_mode == 'legacy':
+                raise ValueError("capacity sizing needs hash_mode='double'")
+            self.bit_size, self.hash_count, self.blockNum = self.optimal_size(capacity, self.error_rate)
         self.hashfunc = []
-        self.buerfilter = BuerFilter(1000)  # 设置容量为 1000
+        self.buerfilter = FingerprintCache(cache_size)
         self.buerfilter_is_on = True  # Buer缓存过滤器
         for seed in self.seeds:
             self.hashfunc.append(SimpleHash(self.bit_size, seed))
+        self._script = server.register_script(self.CHECK_AND_SET_SCRIPT) if server is not None else None
+
+    @classmethod
+    def optimal_size(cls, capacity, error_rate):
+        """ 由容量与误判率推导 (每块的位数, 哈希函数个数, 块数)
+
+        总位数 m = -n ln(p) / ln(2)^2, 哈希个数 k = m / n * ln(2); 超过单块上限时均分到多块, 每块按字节取整.
+        """
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1: %r" % error_rate)
+        bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        hash_count = max(1, int(round(bits / float(capacity) * math.log(2))))
+        blocks = max(1, int(math.ceil(bits / float(cls.MAX_BLOCK_BITS))))
+        block_bits = int(math.ceil(bits / float(blocks) / 8)) * 8
+        return block_bits, hash_count, blocks
+
+    def false_positive_rate(self, count):
+        """ 已加入 count 个指纹时的理论误判率 (1 - e^(-kn/m))^k """
+        bits = float(self.bit_size) * self.blockNum
+        return (1 - math.exp(-self.hash_count * count / bits)) ** self.hash_count
+
+    def info(self):
+        """ 返回过滤器的参数, 便于写入 stats """
+        info = {
+            'bit_size': self.bit_size * self.blockNum,
+            'hash_count': self.hash_count,
+            'block_count': self.blockNum,
+        }
+        if self.capacity:
+            info['capacity'] = self.capacity
+            info['error_rate'] = self.error_rate
+            info['false_positive_rate'] = self.false_positive_rate(self.capacity)
+        return info
+
+    def offsets(self, str_input):
+        """ 返回 str_input 在块中的 k 个位置 """
+        if self.hash_mode == 'legacy':
+            return [f.hash(str_input) for f in self.hashfunc]
+        # 指纹本身就是均匀分布的 SHA1, 取前两段 64 位作为两个独立的哈希值: g_i = h1 + i * h2
+        m = self.bit_size
+        if not m & (m - 1):  # 2 的幂大小: h2 取奇数, 保证 k 个位置各不相同
+            mask = m - 1
+            h1 = int(str_input[0:16], 16) & mask
+            h2 = int(str_input[16:32], 16) & mask | 1
+            return [(h1 + i * h2) & mask for i in range(self.hash_count)]
+        h1 = int(str_input[0:16], 16) % m
+        h2 = int(str_input[16:32], 16) % (m - 1) + 1  # h2 不能为 0
+        return [(h1 + i * h2) % m for i in range(self.hash_count)]
+
+    def block(self, str_input):
+        """ 返回 str_input 所在块的键名 """
+        if self.hash_mode == 'legacy':
+            return self.key + str(int(str_input[0:2], 16) % self.blockNum)
+        # 用位置计算之外的 32 位均匀地选择块, 任意块数都不会倾斜
+        return self.key + str(int(str_input[32:40], 16) % self.blockNum)
+
+    @property
+    def dirty_segment_bits(self):
+        """ 传给脚本的每段位数, 0 表示不记录脏段 """
+        return self.segment_bits if self.track_dirty else 0
 
     def existent(self, str_input):
-        if not str_input:
-            return False
+        """ 检查并登记一个指纹, 存在返回 True, 不存在返回 False """
+        return self.existent_many([str_input])[0]
 
-        # 如果不二缓存说有,那肯定是爬过,如果不二说没有,那得进一步判断
-        if self.buerfilter_is_on and self.buerfilter.existent(str_input):
-            return True
+    def existent_many(self, str_inputs):
+        """ 检查并登记一批指纹, 返回每个指纹是否已存在的列表
+
+        不二缓存没有命中的指纹交给服务器端脚本原子地检查并置位, 一批只需一次往返;
+        两个节点同时提交同一个指纹时只有一个会得到 "不存在". 同一批内重复的指纹, 后出现的视为已存在.
+        指纹在服务器应答之后才记进缓存: 调用出错时这批指纹没有被记下, 重试时不会被当成已存在.
+        """
+        result = [False] * len(str_inputs)
+        pending = []  # (下标, 指纹)
+        for i, str_input in enumerate(str_inputs):
+            if not str_input:
+                continue
+            # 如果不二缓存说有,那肯定是爬过,如果不二说没有,那得进一步判断
+            if self.buerfilter_is_on and self.buerfilter.contains(str_input):
+                result[i] = True
+            else:
+                pending.append((i, str_input))
+        for start in range(0, len(pending), self.batch_size):
+            chunk = pending[start:start + self.batch_size]
+            for (i, str_input), seen in zip(chunk, self._check_and_set([fp for _, fp in chunk])):
+                result[i] = bool(seen)
+                if self.buerfilter_is_on:
+                    self.buerfilter.add(str_input)
+        return result
+
+    def _check_and_set(self, str_inputs):
+        """ 用一次脚本调用检查并置位一批指纹 """
+        keys, index, args = [self.dirty_key, self.version_key], {}, [self.hash_count, self.dirty_segment_bits]
+        for str_input in str_inputs:
+            name = self.block(str_input)
+            if name not in index:
+                keys.append(name)
+                index[name] = len(keys)
+            args.append(index[name])
+            args.extend(self.offsets(str_input))
+        return self._script(keys=keys, args=args)
+
+    def block_names(self):
+        """ 返回所有块的键名 """
+        return [self.key + str(i) for i in range(self.blockNum)]
+
+    def keys(self):
+        """ 返回所有块与脏段记录的键名 """
+        return self.block_names() + [self.dirty_key, self.version_key]
+
+    def clear(self):
+        """ 删除过滤器的全部键 """
+        self.server.delete(*self.keys())
+
+
+class ReplicatedBloomFilter(BloomFilter):
+    """ 在本地保存一份位图副本的布隆过滤器
+
+    副本用分块的 GETRANGE 整体载入, 之后每隔 sync_interval 秒按脏段集合增量同步. 整体载入可能要几秒,
+    应该在爬虫启动时放到线程里调用 sync() (BloomDupeFilter.open 就是这样做的); 没有载入就被使用时才在当前线程载入.
+    位只会从 0 变成 1, 所以本地副本上 k 个位全部为 1 的指纹一定已存在, 不用访问 Redis;
+    只有 "可能是新的" 指纹才交给服务器端脚本置位, 新置的位同时写进本地副本.
+    副本与远端位图一样大, 所以必须给出 capacity, 否则每个节点都要复制 256M 的默认位图.
+    """
+    chunk_size = 4 * 1024 * 1024  # 整体载入时每次 GETRANGE 的字节数
+    track_dirty = True  # 所有节点都必须记录脏段, 副本才能同步到别的节点的写入
+
+    def __init__(self, server, key='bloomfilter', sync_interval=5, stats=None, **kwargs):
+        if not kwargs.get('capacity'):
+            raise ValueError('ReplicatedBloomFilter needs a capacity')
+        super(ReplicatedBloomFilter, self).__init__(server, key, **kwargs)
+        self.sync_interval = sync_interval
+        self.stats = stats
+        self.blocks = None  # 块名 -> bytearray, 第一次同步时载入
+        self.version = 0  # 已同步到的版本号
+        self.synced = 0  # 上次同步的时间
+        self.lookups = 0
+        self.hits = 0
+
+    def load(self):
+        """ 分块读入所有块 """
+        self.version = int(self.server.get(self.version_key) or 0)  # 先取版本号, 之后的改动留给增量同步
+        nbytes = self.bit_size // 8
+        blocks = {}
+        for name in self.block_names():
+            block = bytearray(nbytes)
+            length = min(self.server.strlen(name), nbytes)
+            pipe = self.server.pipeline(transaction=False)
+            for start in range(0, length, self.chunk_size):
+                pipe.getrange(name, start, min(start + self.chunk_size, length) - 1)
+            start = 0
+            for data in pipe.execute():
+                block[start:start + len(data)] = data
+                start += len(data)
+            blocks[name] = block
+        self.blocks = blocks  # 全部读完才替换, 载入途中不会被用到半个副本
+
+    def sync(self):
+        """ 读入上次同步之后改动过的段 """
+        self.synced = time.time()
+        if self.blocks is None:
+            self.load()
+            segments = 0
         else:
-            name = self.key + str(int(str_input[0:2], 16) % self.blockNum)
-            # 利用 pipeline 并开启事务,减少RTT次数，提高请求效率。
-            pipeline = self.server.pipeline()
-            for f in self.hashfunc:
-                loc = f.hash(str_input)
-                pipeline.setbit(name, loc, 1)
-            bool_table = pipeline.execute()
-            return all(bool_table)
+            version = int(self.server.get(self.version_key) or 0)
+            members = self.server.zrangebyscore(self.dirty_key, '(%d' % self.version, '+inf')
+            seg_bytes = self.segment_bits // 8
+            pipe = self.server.pipeline(transaction=False)
+            targets = []
+            for member in members:
+                name, _, segment = member.decode().rpartition('@')
+                if name not in self.blocks:
+                    continue
+                start = int(segment) * seg_bytes
+                pipe.getrange(name, start, start + seg_bytes - 1)
+                targets.append((self.blocks[name], start))
+            for (block, start), data in zip(targets, pipe.execute()):
+                block[start:start + len(data)] = data
+            self.version = version
+            segments = len(targets)
+        if self.stats:
+            self.stats.set_value('bloomfilter/replica/version', self.version)
+            self.stats.inc_value('bloomfilter/replica/segments', segments)
+        return segments
+
+    def staleness(self):
+        """ 距离上次同步的秒数 """
+        return time.time() - self.synced if self.synced else None
+
+    def _contains(self, block, offsets):
+        for loc in offsets:
+            if not block[loc >> 3] & (0x80 >> (loc & 7)):
+                return False
+        return True
+
+    def _check_and_set(self, str_inputs):
+        """ 本地副本能确认已存在的直接返回, 其余交给 Redis, 新置的位同步写进副本 """
+        if time.time() - self.synced >= self.sync_interval:
+            self.sync()
+        result = [1] * len(str_inputs)
+        pending = []  # (下标, 指纹, 块, 位置)
+        for i, str_input in enumerate(str_inputs):
+            block = self.blocks[self.block(str_input)]
+            offsets = self.offsets(str_input)
+            if not self._contains(block, offsets):
+                pending.append((i, str_input, block, offsets))
+        self.lookups += len(str_inputs)
+        self.hits += len(str_inputs) - len(pending)
+        if pending:
+            seen = super(ReplicatedBloomFilter, self)._check_and_set([fp for _, fp, _, _ in pending])
+            for (i, _, block, offsets), flag in zip(pending, seen):
+                result[i] = flag
+                for loc in offsets:
+                    block[loc >> 3] |= 0x80 >> (loc & 7)
+        if self.stats:
+            self.stats.set_value('bloomfilter/replica/hits', self.hits)
+            self.stats.set_value('bloomfilter/replica/lookups', self.lookups)
+            self.stats.set_value('bloomfilter/replica/staleness', self.staleness())
+        return result
+
+
+class ScalableBloomFilter(BloomFilter):
+    """ 可扩展的布隆过滤器, 见 Almeida 等人的 Scalable Bloom Filters
+
+    由若干层组成, 第 i 层的容量为 capacity * growth^i, 误判率为 error_rate * (1 - tightening) * tightening^i,
+    所有层的误判率之和不超过 error_rate. 只有最新一层会被写入, 旧层只读.
+    每隔 check_interval 秒用 BITCOUNT 统计最新一层的填充率, 超过 fill_ratio 时追加一层; 层数存在 Redis 中, 各节点共享.
+
+    同时按指纹的末 16 位抽取约 sample_rate 的指纹放进一个精确的集合, 与布隆过滤器的结论对比, 在线估计实际误判率.
+    """
+    # KEYS[1] 为抽样集合, 之后为涉及的块; ARGV[1] 为层数 L, ARGV[2..L+1] 为每层的 k;
+    # 之后每个指纹占 1 + L * (1 + k) 个参数: 抽样时为指纹本身否则为空串, 再按层给出块在 KEYS 中的下标与 k 个位置.
+    # 旧层只检查, 全部为 1 即已存在; 都不存在时在最新一层置位.
+    # 返回 seen + 2 * (抽样且精确集合中原本没有): 3 表示一次误判.
+    CHECK_AND_SET_SCRIPT = """
+local layers = tonumber(ARGV[1])
+local result = {}
+local i = layers + 2
+while i <= #ARGV do
+    local member = ARGV[i]
+    i = i + 1
+    local seen = 0
+    for l = 1, layers do
+        local k = tonumber(ARGV[l + 1])
+        local key = KEYS[tonumber(ARGV[i])]
+        if seen == 0 then
+            seen = 1
+            for j = 1, k do
+                if l == layers then
+                    if redis.call('SETBIT', key, ARGV[i + j], 1) == 0 then
+                        seen = 0
+                    end
+                elseif redis.call('GETBIT', key, ARGV[i + j]) == 0 then
+                    seen = 0
+                    break
+                end
+            end
+        end
+        i = i + k + 1
+    end
+    if member ~= '' then
+        seen = seen + 2 * redis.call('SADD', KEYS[1], member)
+    end
+    result[#result + 1] = seen
+end
+return result
+"""
+    # 层数只在等于调用者看到的值时加一, 多个节点同时发现写满也只追加一层
+    GROW_SCRIPT = """
+local layers = tonumber(redis.call('GET', KEYS[1]) or '1')
+if layers == tonumber(ARGV[1]) then
+    layers = layers + 1
+    redis.call('SET', KEYS[1], layers)
+end
+return layers
+"""
+
+    def __init__(self, server, key='bloomfilter', capacity=None, error_rate=None, growth=2, tightening=0.5,
+                 fill_ratio=0.5, check_interval=60, sample_rate=0.001, stats=None, cache_size=1000):
+        """
+        :param capacity: capacity of the first layer, required
+        :param error_rate: bound of the compound false positive rate
+        :param growth: every new layer holds growth times more fingerprints than the previous one
+        :param tightening: every new layer's error rate is tightening times the previous one
+        :param fill_ratio: add a layer once this fraction of the newest layer's bits are set
+        :param check_interval: seconds between two fill ratio checks
+        :param sample_rate: fraction of fingerprints kept in an exact set to measure the false positive rate
+        :param stats: the crawler stats to publish layers, fill ratio and false positive rates to
+        """
+        if not capacity:
+            raise ValueError('ScalableBloomFilter needs a capacity')
+        super(ScalableBloomFilter, self).__init__(server, key, capacity=capacity, error_rate=error_rate,
+                                                  cache_size=cache_size)
+        if not 0 < tightening < 1:
+            raise ValueError("tightening must be between 0 and 1: %r" % tightening)
+        self.growth = growth
+        self.tightening = tightening
+        self.fill_ratio = fill_ratio
+        self.check_interval = check_interval
+        self.sample_threshold = int(sample_rate * 0x10000)
+        self.stats = stats
+        self.layers_key = key + ':layers'
+        self.sample_key = key + ':sample'
+        self.layers = [self.layer(0)]
+        self.fill = 0.0  # 最新一层的填充率
+        self.checked = 0  # 上次检查填充率的时间
+        self.sampled = 0  # 抽样指纹中真正新的个数
+        self.false_positives = 0  # 其中被布隆过滤器判为已存在的个数
+        if server is not None:
+            self._script = server.register_script(self.CHECK_AND_SET_SCRIPT)
+            self._grow = server.register_script(self.GROW_SCRIPT)
+
+    def layer(self, index):
+        """ 返回第 index 层; 第 0 层与普通过滤器使用相同的键名 """
+        key = self.key if index == 0 else '%s:layer%d:' % (self.key, index)
+        return BloomFilter(None, key, capacity=self.capacity * self.growth ** index,
+                           error_rate=self.error_rate * (1 - self.tightening) * self.tightening ** index)
+
+    def existent_many(self, str_inputs):
+        if time.time() - self.checked >= self.check_interval:
+            self.check()
+        return super(ScalableBloomFilter, self).existent_many(str_inputs)
+
+    def _check_and_set(self, str_inputs):
+        """ 用一次脚本调用检查所有层并在最新一层置位 """
+        keys, index = [self.sample_key], {}
+        args = [len(self.layers)] + [layer.hash_count for layer in self.layers]
+        for str_input in str_inputs:
+            args.append(str_input if int(str_input[-4:], 16) < self.sample_threshold else '')
+            for layer in self.layers:
+                name = layer.block(str_input)
+                if name not in index:
+                    keys.append(name)
+                    index[name] = len(keys)
+                args.append(index[name])
+                args.extend(layer.offsets(str_input))
+        result = self._script(keys=keys, args=args)
+        for flag in result:
+            if flag >= 2:
+                self.sampled += 1
+                self.false_positives += flag == 3
+        return [flag & 1 for flag in result]
+
+    def sync(self, layers=None):
+        """ 按 Redis 中记录的层数补齐本地的层 """
+        if layers is None:
+            layers = int(self.server.get(self.layers_key) or 1)
+        while len(self.layers) < layers:
+            self.layers.append(self.layer(len(self.layers)))
+
+    def check(self):
+        """ 统计最新一层的填充率, 超过阈值时追加一层, 并发布统计 """
+        self.checked = time.time()
+        self.sync()
+        newest = self.layers[-1]
+        pipe = self.server.pipeline(transaction=False)
+        for name in newest.block_names():
+            pipe.bitcount(name)
+        self.fill = sum(pipe.execute()) / float(newest.bit_size * newest.blockNum)
+        if self.fill >= self.fill_ratio:
+            self.sync(self._grow(keys=[self.layers_key], args=[len(self.layers)]))
+            logger.info('bloomfilter %s is %.1f%% full, grow to %d layers', self.key, self.fill * 100, len(self.layers))
+            self.fill = 0.0
+        if self.stats:
+            for name, value in self.info().items():
+                self.stats.set_value('bloomfilter/' + name, value)
+        observed = self.observed_false_positive_rate()
+        if observed is not None and observed > 2 * self.error_rate:
+            logger.warning('bloomfilter %s observed false positive rate %.4f exceeds %.4f',
+                           self.key, observed, self.error_rate)
+        return self.fill
+
+    def observed_false_positive_rate(self):
+        """ 抽样得到的实际误判率, 样本不足 1000 个时返回 None """
+        if self.sampled < 1000:
+            return None
+        return self.false_positives / float(self.sampled)
+
+    def false_positive_rate(self, count=None):
+        """ 按各层填充率估计的总误判率; 写满的旧层按 fill_ratio 计算 """
+        ok = 1.0
+        for layer in self.layers[:-1]:
+            ok *= 1 - self.fill_ratio ** layer.hash_count
+        ok *= 1 - self.fill ** self.layers[-1].hash_count
+        return 1 - ok
+
+    def info(self):
+        info = {
+            'capacity': sum(layer.capacity for layer in self.layers),
+            'error_rate': self.error_rate,
+            'bit_size': sum(layer.bit_size * layer.blockNum for layer in self.layers),
+            'layers': len(self.layers),
+            'fill_ratio': self.fill,
+            'false_positive_rate': self.false_positive_rate(),
+            'sampled': self.sampled,
+            'false_positives': self.false_positives,
+        }
+        observed = self.observed_false_positive_rate()
+        if observed is not None:
+            info['observed_false_positive_rate'] = observed
+        return info
+
+    def keys(self):
+        """ 返回所有层的块, 层数与抽样集合的键名 """
+        self.sync()
+        keys = [self.layers_key, self.sample_key]
+        for layer in self.layers:
+            keys.extend(layer.keys())
+        return keys
+
+
+class RotatingBloomFilter(BloomFilter):
+    """ 按时间窗口去重的布隆过滤器
+
+    时间被切成长度为 window / generations 的代, 每代一组块, 键名为 key:g<代号>:<块号>, 只有当前代会被写入.
+    指纹在最近 generations + 1 代中任何一代出现过即为已存在, 所以 "已存在" 的含义是在最近 window 秒
+    (多出不到一代的长度) 内见过. 每代的块设置 EXPIREAT, 过期的代由 Redis 自己删除, 不需要扫描.
+    再次见到旧代里的指纹不会把它写进新一代, 过了窗口它就可以被重新抓取.
+    """
+    # 与可扩展过滤器的脚本相同: 旧代只检查, 当前代置位
+    CHECK_AND_SET_SCRIPT = ScalableBloomFilter.CHECK_AND_SET_SCRIPT
+
+    def __init__(self, server, key='bloomfilter', window=86400, generations=4, capacity=None, error_rate=None,
+                 cache_size=1000):
+        """
+        :param window: seconds a fingerprint is remembered
+        :param generations: how many generations the window is cut into
+        :param capacity: expected fingerprints per generation, required
+        :param error_rate: bound of the false positive rate over all live generations
+        """
+        if not capacity:  # 否则每代都是 2^31 位, generations + 1 代合计超过 1 GB
+            raise ValueError('RotatingBloomFilter needs a capacity')
+        error_rate = (error_rate or 0.001) / (generations + 1)
+        super(RotatingBloomFilter, self).__init__(server, key, capacity=capacity, error_rate=error_rate,
+                                                  cache_size=cache_size)
+        self.window = window
+        self.generations = generations
+        self.span = float(window) / generations  # 每代的秒数
+        self.current = None  # 当前代号
+        self.expiring = None  # 已设置过期时间的代号
+
+    def generation(self, index):
+        """ 返回第 index 代; 各代大小相同 """
+        bf = BloomFilter(None, '%s:g%d:' % (self.key, index), capacity=self.capacity, error_rate=self.error_rate)
+        bf.bit_size, bf.hash_count, bf.blockNum = self.bit_size, self.hash_count, self.blockNum
+        return bf
+
+    def live(self):
+        """ 返回仍在窗口内的各代, 从旧到新 """
+        current = int(time.time() // self.span)
+        if current != self.current:
+            self.current = current
+            self.buerfilter = FingerprintCache(self.buerfilter.contain)  # 缓存里的条目可能属于已过期的代
+            self.live_generations = [self.generation(index)
+                                     for index in range(current - self.generations, current + 1)]
+        return self.live_generations
+
+    def existent_many(self, str_inputs):
+        self.live()  # 先轮换, 再查缓存
+        return super(RotatingBloomFilter, self).existent_many(str_inputs)
+
+    def _check_and_set(self, str_inputs):
+        """ 用一次脚本调用检查所有仍在窗口内的代, 并在当前代置位 """
+        generations = self.live()
+        keys, index = [self.key], {}  # 第一个键是抽样集合, 这里不抽样, 不会被访问
+        args = [len(generations)] + [self.hash_count] * len(generations)
+        for str_input in str_inputs:
+            args.append('')
+            for generation in generations:
+                name = generation.block(str_input)
+                if name not in index:
+                    keys.append(name)
+                    index[name] = len(keys)
+                args.append(index[name])
+                args.extend(generation.offsets(str_input))
+        result = self._script(keys=keys, args=args)
+        if self.expiring != self.current:
+            # 当前代在窗口外再保留一代后过期
+            expire_at = int((self.current + self.generations + 1) * self.span) + 1
+            pipe = self.server.pipeline(transaction=False)
+            for name in generations[-1].block_names():
+                pipe.expireat(name, expire_at)
+            if all(pipe.execute()):  # 还没被创建的块下次再设置
+                self.expiring = self.current
+        return result
+
+    def keys(self):
+        """ 返回仍在窗口内的各代的块 """
+        keys = []
+        for generation in self.live():
+            keys.extend(generation.block_names())
+        return keys
+
+
+class ShardedBloomFilter(BloomFilter):
+    """ 把块分散到多个分片的布隆过滤器
+
+    第 i 个分片的块名为 {key<i>}, 脏段与版本号为 {key<i>}:dirty 与 {key<i>}:version; 花括号是 Redis Cluster 的
+    hash tag, 同一分片的键落在同一个槽, 脚本可以原子地处理, 不同分片分散到不同的槽与节点.
+    给出 servers 时分片轮流分给这些 Redis (也可以只给一个 Redis Cluster 客户端).
+    一批指纹按分片分组, 每个分片一次脚本调用, 各分片在线程池中并发执行, 吞吐量随节点数增长.
+    """
+
+    def __init__(self, server, key='bloomfilter', shards=2, servers=None, capacity=None, error_rate=None,
+                 cache_size=1000):
+        """
+        :param shards: number of shards, at least the block count capacity needs
+        :param servers: Redis clients the shards are spread over; defaults to [server]
+        :param capacity: expected number of fingerprints over all shards; without it the default bitmap is
+                         spread over the shards instead of allocated once per shard
+        """
+        super(ShardedBloomFilter, self).__init__(server, key, capacity=capacity, error_rate=error_rate,
+                                                 cache_size=cache_size)
+        shards = max(shards, self.blockNum)
+        self.bit_size = int(math.ceil(self.bit_size * self.blockNum / float(shards) / 8)) * 8
+        self.blockNum = shards
+        self.servers = list(servers or [server])
+        self.batch_size = BloomFilter.batch_size * shards  # 分组后每个分片每次仍约处理 batch_size 个指纹
+        self.executor = None
+
+    def shard(self, str_input):
+        """ 返回 str_input 所在的分片号 """
+        return int(str_input[32:40], 16) % self.blockNum
+
+    def shard_key(self, index):
+        return '{%s%d}' % (self.key, index)
+
+    def shard_server(self, index):
+        return self.servers[index % len(self.servers)]
+
+    def block(self, str_input):
+        return self.shard_key(self.shard(str_input))
+
+    def info(self):
+        info = super(ShardedBloomFilter, self).info()
+        info['server_count'] = len(self.servers)
+        return info
+
+    def _check_shard(self, index, str_inputs):
+        name = self.shard_key(index)
+        args = [self.hash_count, self.dirty_segment_bits]
+        for str_input in str_inputs:
+            args.append(3)
+            args.extend(self.offsets(str_input))
+        return self._script(keys=[name + ':dirty', name + ':version', name], args=args,
+                            client=self.shard_server(index))
+
+    def _check_and_set(self, str_inputs):
+        """ 按分片分组, 并发地检查并置位 """
+        groups = {}  # 分片号 -> [下标]
+        for i, str_input in enumerate(str_inputs):
+            groups.setdefault(self.shard(str_input), []).append(i)
+        calls = [(index, [str_inputs[i] for i in positions]) for index, positions in groups.items()]
+        if len(calls) > 1 and ThreadPoolExecutor is not None:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(min(self.blockNum, 32))
+            futures = [self.executor.submit(self._check_shard, index, fps) for index, fps in calls]
+            replies = [future.result() for future in futures]
+        else:
+            replies = [self._check_shard(index, fps) for index, fps in calls]
+        result = [0] * len(str_inputs)
+        for (index, _), seen in zip(calls, replies):
+            for i, flag in zip(groups[index], seen):
+                result[i] = flag
+        return result
+
+    def block_names(self):
+        return [self.shard_key(i) for i in range(self.blockNum)]
+
+    def keys(self):
+        keys = []
+        for name in self.block_names():
+            keys.extend([name, name + ':dirty', name + ':version'])
+        return keys
+
+    def clear(self):
+        """ 各分片的键在各自的服务器上删除 """
+        for i, name in enumerate(self.block_names()):
+            self.shard_server(i).delete(name, name + ':dirty', name + ':version')
 
 
 class OldBloomFilter(object):
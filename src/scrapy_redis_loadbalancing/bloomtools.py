@@ -0,0 +1,178 @@
+"""Snapshot, restore and merge bloom filter bitmaps.
+
+Usage::
+
+    python -m scrapy_redis_loadbalancing.bloomtools dump myspider:dupefilter0 bloom.bin
+    python -m scrapy_redis_loadbalancing.bloomtools restore myspider:dupefilter0 bloom.bin
+    python -m scrapy_redis_loadbalancing.bloomtools merge myspider:dupefilter0 other:dupefilter0
+    python -m scrapy_redis_loadbalancing.bloomtools merge-file myspider:dupefilter0 bloom.bin
+    python -m scrapy_redis_loadbalancing.bloomtools load myspider:dupefilter myspider:fingerprints
+
+A dump is the raw bitmap, byte for byte, so it can be memory-mapped and read
+with the same bit order Redis uses. Transfers go in ``chunk_size`` pieces with
+``depth`` pieces in flight per pipeline, so a 256 MB block moves in a few
+round trips.
+"""
+from __future__ import print_function
+
+import argparse
+import binascii
+import mmap
+import os
+
+import redis
+
+from .bloomfilter import BloomFilter
+
+CHUNK_SIZE = 4 * 1024 * 1024
+DEPTH = 16  # chunks per pipeline
+
+
+def _chunks(length, chunk_size):
+    return [(start, min(start + chunk_size, length)) for start in range(0, length, chunk_size)]
+
+
+def dump(server, key, path, chunk_size=CHUNK_SIZE, depth=DEPTH):
+    """Writes the string at ``key`` to ``path``, returns the bytes written."""
+    length = server.strlen(key)
+    chunks = _chunks(length, chunk_size)
+    with open(path, 'wb') as f:
+        for i in range(0, len(chunks), depth):
+            pipe = server.pipeline(transaction=False)
+            for start, end in chunks[i:i + depth]:
+                pipe.getrange(key, start, end - 1)
+            for data in pipe.execute():
+                f.write(data)
+    return length
+
+
+def _write_file(server, key, path, chunk_size, depth):
+    """Streams ``path`` into ``key``, skipping all-zero chunks."""
+    written = 0
+    with open(path, 'rb') as f:
+        length = os.fstat(f.fileno()).st_size
+        if not length:
+            return 0
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            chunks = _chunks(length, chunk_size)
+            for i in range(0, len(chunks), depth):
+                pipe = server.pipeline(transaction=False)
+                for start, end in chunks[i:i + depth]:
+                    data = buf[start:end]
+                    if data.count(b'\0') == len(data):  # unwritten ranges read as zero bits anyway
+                        continue
+                    pipe.setrange(key, start, data)
+                    written += len(data)
+                pipe.execute()
+        finally:
+            buf.close()
+    return written
+
+
+def restore(server, key, path, chunk_size=CHUNK_SIZE, depth=DEPTH):
+    """Replaces ``key`` with the dump at ``path``, returns the bytes written."""
+    server.delete(key)
+    return _write_file(server, key, path, chunk_size, depth)
+
+
+def _temporary_key(key):
+    """Returns a fresh key in the same cluster slot as ``key``."""
+    start = key.find('{')
+    end = key.find('}', start + 1)
+    tag = key[start + 1:end] if 0 <= start < end - 1 else key
+    return '{%s}:merge:%s' % (tag, binascii.hexlify(os.urandom(8)).decode('ascii'))
+
+
+def merge_file(server, key, path, chunk_size=CHUNK_SIZE, depth=DEPTH):
+    """ORs the dump at ``path`` into ``key``, e.g. a filter taken from another instance.
+
+    The dump is restored into a temporary key first and ORed in with one
+    ``BITOP``, so bits set on a live filter while the file streams in are
+    kept. Returns the bytes of the dump written to Redis.
+    """
+    tmp = _temporary_key(key)
+    try:
+        written = restore(server, tmp, path, chunk_size, depth)
+        if written:
+            server.bitop('OR', key, key, tmp)
+    finally:
+        server.delete(tmp)
+    return written
+
+
+def merge(server, dest, *sources):
+    """ORs ``sources`` into ``dest`` with one server-side BITOP."""
+    return server.bitop('OR', dest, dest, *sources)
+
+
+def load_set(server, set_key, bloomfilter, count=1000):
+    """Adds every fingerprint of an ``RFPDupeFilter`` set to ``bloomfilter``.
+
+    The set is walked with ``SSCAN`` and each page is added with one
+    ``existent_many`` call. Fingerprints may be hex strings or full 20 byte
+    binary digests; truncated digests lack the bits the bloom filter needs.
+    Returns the number of fingerprints added.
+    """
+    bloomfilter.buerfilter_is_on = False
+    added = 0
+    cursor = 0
+    while True:
+        cursor, members = server.sscan(set_key, cursor, count=count)
+        fps = []
+        for member in members:
+            if len(member) == 20:
+                member = binascii.hexlify(member)
+            elif len(member) != 40:
+                raise ValueError('cannot load a %d byte fingerprint into a bloom filter' % len(member))
+            fps.append(member.decode('ascii'))
+        if fps:
+            bloomfilter.existent_many(fps)
+            added += len(fps)
+        if not cursor:
+            return added
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', default=os.environ.get('REDIS_URL', 'redis://localhost:6379'))
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    commands = parser.add_subparsers(dest='command')
+    cmd = commands.add_parser('dump', help='write a bitmap to a file')
+    cmd.add_argument('key')
+    cmd.add_argument('path')
+    cmd = commands.add_parser('restore', help='replace a bitmap with a dump')
+    cmd.add_argument('key')
+    cmd.add_argument('path')
+    cmd = commands.add_parser('merge', help='OR bitmaps of the same instance into the first one')
+    cmd.add_argument('key')
+    cmd.add_argument('sources', nargs='+')
+    cmd = commands.add_parser('merge-file', help='OR a dump into a bitmap')
+    cmd.add_argument('key')
+    cmd.add_argument('path')
+    cmd = commands.add_parser('load', help='add the fingerprints of a RFPDupeFilter set to a bloom filter')
+    cmd.add_argument('key', help='bloom filter key, as in SCHEDULER_DUPEFILTER_KEY')
+    cmd.add_argument('set_key')
+    cmd.add_argument('--capacity', type=int)
+    cmd.add_argument('--error-rate', type=float)
+    cmd.add_argument('--hash', default='double', choices=['double', 'legacy'])
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.error('a command is required')
+
+    server = redis.StrictRedis.from_url(args.redis_url)
+    if args.command == 'dump':
+        print('dumped {} bytes'.format(dump(server, args.key, args.path, args.chunk_size)))
+    elif args.command == 'restore':
+        print('restored {} bytes'.format(restore(server, args.key, args.path, args.chunk_size)))
+    elif args.command == 'merge':
+        print('merged into {} bytes'.format(merge(server, args.key, *args.sources)))
+    elif args.command == 'merge-file':
+        print('merged {} bytes'.format(merge_file(server, args.key, args.path, args.chunk_size)))
+    elif args.command == 'load':
+        bf = BloomFilter(server, args.key, hash_mode=args.hash, capacity=args.capacity, error_rate=args.error_rate)
+        print('loaded {} fingerprints'.format(load_set(server, args.set_key, bf)))
+
+
+if __name__ == '__main__':
+    main()
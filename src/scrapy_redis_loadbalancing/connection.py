@@ -44,6 +44,10 @@ def get_redis_from_settings(settings):
         Additional client parameters.
 
     """
+    return get_redis(**_params_from_settings(settings))
+
+
+def _params_from_settings(settings):
     params = defaults.REDIS_PARAMS.copy()
     params.update(settings.getdict('REDIS_PARAMS'))
     # XXX: Deprecate REDIS_* settings.
@@ -55,8 +59,30 @@ def get_redis_from_settings(settings):
     # Allow ``redis_cls`` to be a path to a class.
     if isinstance(params.get('redis_cls'), six.string_types):
         params['redis_cls'] = load_object(params['redis_cls'])
+    return params
+
+
+def get_redis_list_from_settings(settings, urls):
+    """Returns one redis client per URL.
 
-    return get_redis(**params)
+    The clients share every other parameter with ``get_redis_from_settings``,
+    only the address comes from the URL.
+
+    Parameters
+    ----------
+    settings : Settings
+    urls : list of str
+
+    Returns
+    -------
+    list
+        Redis client instances.
+
+    """
+    params = _params_from_settings(settings)
+    for name in ('url', 'host', 'port'):
+        params.pop(name, None)
+    return [get_redis(url=url, **params) for url in urls]
 
 
 # Backwards compatible alias.
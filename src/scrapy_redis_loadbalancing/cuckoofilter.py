@@ -0,0 +1,229 @@
+# encoding=utf-8
+import math
+
+
+class CuckooFilter(object):
+    """ 保存在 Redis 字符串里的布谷鸟过滤器, 与布隆过滤器不同, 它可以删除指纹
+
+    过滤器由 capacity / (4 * 0.95) 个桶组成, 每个桶 4 个槽, 每个槽保存指纹的 16 位标签 (0 表示空槽), 用 BITFIELD 读写.
+    指纹的前 64 位决定第一个桶 i1, 第二个桶 i2 = (hash(标签) - i1) mod 桶数; 这个映射是自己的逆,
+    由任何一个桶和标签都能算出另一个桶, 桶数也不必是 2 的幂, 装满时正好是 95% 的装填率.
+    两个桶都满时随机踢出一个标签, 把它搬到它的另一个桶, 最多 max_kicks 次; 仍然放不下的标签
+    进入一个很小的溢出集合, 保证不会漏判.
+
+    误判率约为 2 * 4 / 2^16 ≈ 0.012%, 装填率 95% 时每个指纹约占 16.8 位,
+    同样误判率的布隆过滤器每个指纹需要约 18.8 位.
+    """
+    slots = 4
+    load_factor = 0.95
+    max_buckets = 1 << 26  # Redis 字符串最大 512M, 每个桶 8 字节
+
+    # 公共部分: KEYS[1] 为过滤器, KEYS[2] 为计数, KEYS[3] 为溢出集合; ARGV[1] 为桶数.
+    # 之后每个指纹两个参数: 第一个桶号, 标签.
+    COMMON = """
+local buckets = tonumber(ARGV[1])
+local function alt(i, tag)
+    return ((tag * 0x5bd1e995) % 4294967296 - i) % buckets
+end
+local function bucket(i)
+    local base = i * 4
+    return redis.call('BITFIELD', KEYS[1], 'GET', 'u16', '#' .. base, 'GET', 'u16', '#' .. (base + 1),
+                      'GET', 'u16', '#' .. (base + 2), 'GET', 'u16', '#' .. (base + 3))
+end
+local function put(i, s, tag)
+    redis.call('BITFIELD', KEYS[1], 'SET', 'u16', '#' .. (i * 4 + s - 1), tag)
+end
+local function index(b, tag)
+    for s = 1, 4 do
+        if b[s] == tag then
+            return s
+        end
+    end
+end
+local function overflow(i, tag)
+    return math.min(i, alt(i, tag)) .. ':' .. tag
+end
+"""
+
+    # ARGV[2] 为最大踢出次数. 检查每个指纹, 不存在时插入; 返回每个指纹是否已存在.
+    INSERT_SCRIPT = COMMON + """
+local kicks = tonumber(ARGV[2])
+local result = {}
+local added = 0
+for n = 3, #ARGV, 2 do
+    local i1 = tonumber(ARGV[n])
+    local tag = tonumber(ARGV[n + 1])
+    local i2 = alt(i1, tag)
+    local b1 = bucket(i1)
+    local b2 = bucket(i2)
+    local seen = 0
+    if index(b1, tag) or index(b2, tag) or redis.call('SISMEMBER', KEYS[3], overflow(i1, tag)) == 1 then
+        seen = 1
+    elseif index(b1, 0) then
+        put(i1, index(b1, 0), tag)
+    elseif index(b2, 0) then
+        put(i2, index(b2, 0), tag)
+    else
+        local i = i1
+        if math.random(2) == 2 then
+            i = i2
+        end
+        for k = 1, kicks do
+            local s = math.random(4)
+            local victim = bucket(i)[s]
+            put(i, s, tag)
+            tag = victim
+            i = alt(i, tag)
+            local b = bucket(i)
+            local free = index(b, 0)
+            if free then
+                put(i, free, tag)
+                tag = 0
+                break
+            end
+        end
+        if tag ~= 0 then
+            redis.call('SADD', KEYS[3], overflow(i, tag))
+        end
+    end
+    if seen == 0 then
+        added = added + 1
+    end
+    result[#result + 1] = seen
+end
+if added > 0 then
+    redis.call('INCRBY', KEYS[2], added)
+end
+return result
+"""
+
+    # 只检查, 返回每个指纹是否存在.
+    CONTAINS_SCRIPT = COMMON + """
+local result = {}
+for n = 2, #ARGV, 2 do
+    local i1 = tonumber(ARGV[n])
+    local tag = tonumber(ARGV[n + 1])
+    local seen = 0
+    if index(bucket(i1), tag) or index(bucket(alt(i1, tag)), tag)
+            or redis.call('SISMEMBER', KEYS[3], overflow(i1, tag)) == 1 then
+        seen = 1
+    end
+    result[#result + 1] = seen
+end
+return result
+"""
+
+    # 删除每个指纹的一个副本, 返回每个指纹是否被删除.
+    DELETE_SCRIPT = COMMON + """
+local result = {}
+local removed = 0
+for n = 2, #ARGV, 2 do
+    local i1 = tonumber(ARGV[n])
+    local tag = tonumber(ARGV[n + 1])
+    local i2 = alt(i1, tag)
+    local done = 0
+    local s = index(bucket(i1), tag)
+    if s then
+        put(i1, s, 0)
+        done = 1
+    else
+        s = index(bucket(i2), tag)
+        if s then
+            put(i2, s, 0)
+            done = 1
+        else
+            done = redis.call('SREM', KEYS[3], overflow(i1, tag))
+        end
+    end
+    removed = removed + done
+    result[#result + 1] = done
+end
+if removed > 0 then
+    redis.call('DECRBY', KEYS[2], removed)
+end
+return result
+"""
+
+    batch_size = 500  # 每次脚本调用最多处理的指纹数; 接近满时每个指纹可能要搬动多次, 比布隆过滤器小一些
+
+    def __init__(self, server, key='cuckoofilter', capacity=10000000, max_kicks=200):
+        """
+        :param server: the client of Redis
+        :param key: the key's name in Redis
+        :param capacity: expected number of fingerprints
+        :param max_kicks: relocations tried before a tag goes to the overflow set
+        """
+        buckets = max(1, int(math.ceil(capacity / (self.slots * self.load_factor))))
+        if buckets > self.max_buckets:
+            raise ValueError("capacity too large for one cuckoo filter: %r" % capacity)
+        self.server = server
+        self.key = key
+        self.capacity = capacity
+        self.buckets = buckets
+        self.max_kicks = max_kicks
+        self.count_key = key + ':count'
+        self.overflow_key = key + ':overflow'
+        if server is not None:
+            self._insert = server.register_script(self.INSERT_SCRIPT)
+            self._contains = server.register_script(self.CONTAINS_SCRIPT)
+            self._delete = server.register_script(self.DELETE_SCRIPT)
+
+    def position(self, str_input):
+        """ 返回 (第一个桶号, 标签) """
+        return int(str_input[0:16], 16) % self.buckets, int(str_input[16:20], 16) or 1
+
+    def alternate(self, index, tag):
+        """ 与脚本中的 alt 相同, 由一个桶号与标签算出另一个桶号 """
+        return ((tag * 0x5bd1e995) % 4294967296 - index) % self.buckets
+
+    def _call(self, script, str_inputs, extra=()):
+        result = []
+        keys = [self.key, self.count_key, self.overflow_key]
+        for start in range(0, len(str_inputs), self.batch_size):
+            args = [self.buckets] + list(extra)
+            for str_input in str_inputs[start:start + self.batch_size]:
+                args.extend(self.position(str_input))
+            result.extend(bool(flag) for flag in script(keys=keys, args=args))
+        return result
+
+    def existent(self, str_input):
+        """ 检查并登记一个指纹, 存在返回 True, 不存在返回 False """
+        return self.existent_many([str_input])[0]
+
+    def existent_many(self, str_inputs):
+        """ 检查并登记一批指纹, 返回每个指纹是否已存在的列表; 同一批内重复的指纹, 后出现的视为已存在 """
+        return self._call(self._insert, str_inputs, [self.max_kicks])
+
+    def contains_many(self, str_inputs):
+        """ 只检查, 返回每个指纹是否存在 """
+        return self._call(self._contains, str_inputs)
+
+    def delete_many(self, str_inputs):
+        """ 删除一批指纹, 返回每个指纹是否被删除; 只能删除确实插入过的指纹, 否则可能删掉别的指纹的标签 """
+        return self._call(self._delete, str_inputs)
+
+    def __len__(self):
+        return int(self.server.get(self.count_key) or 0)
+
+    def false_positive_rate(self):
+        """ 理论误判率上限 2 * 每桶槽数 / 2^16 """
+        return 2.0 * self.slots / (1 << 16)
+
+    def info(self):
+        """ 返回过滤器的参数, 便于写入 stats """
+        return {
+            'capacity': self.capacity,
+            'bit_size': self.buckets * self.slots * 16,
+            'buckets': self.buckets,
+            'bits_per_entry': self.buckets * self.slots * 16.0 / self.capacity,
+            'false_positive_rate': self.false_positive_rate(),
+        }
+
+    def keys(self):
+        """ 返回过滤器用到的全部键名 """
+        return [self.key, self.count_key, self.overflow_key]
+
+
+def bloom_bits_per_entry(error_rate):
+    """ 同样误判率下布隆过滤器每个指纹需要的位数, 用于比较 """
+    return -math.log(error_rate) / math.log(2) ** 2
@@ -17,9 +17,85 @@ REDIS_PARAMS = {
 
 SCHEDULER_QUEUE_KEY = '%(spider)s:requests'
 # SCHEDULER_QUEUE_CLASS = 'scrapy_redis_loadbalancing.queues.FifoQueue'
+# SCHEDULER_QUEUE_CLASS = 'scrapy_redis_loadbalancing.smartqueue.PrioritySmartQueue'
+# SCHEDULER_QUEUE_CLASS = 'scrapy_redis_loadbalancing.smartqueue.DomainSmartQueue'
+# SCHEDULER_QUEUE_CLASS = 'scrapy_redis_loadbalancing.smartqueue.ReliableSmartQueue'
+# SCHEDULER_QUEUE_CLASS = 'scrapy_redis_loadbalancing.smartqueue.StealingSmartQueue'
 SCHEDULER_QUEUE_CLASS = 'scrapy_redis_loadbalancing.smartqueue.SmartQueue'
+# SmartQueue 负载均衡的周期(秒)与每次搬运的任务量, 由 BalanceController 在范围内自适应调整.
+SMARTQUEUE_INTERVAL = 2
+SMARTQUEUE_INTERVAL_MIN = 0.5
+SMARTQUEUE_INTERVAL_MAX = 30
+SMARTQUEUE_BATCH_SIZE = 200  # 初始批量, 与自适应之前的固定批量相同
+SMARTQUEUE_BATCH_MIN = 20
+SMARTQUEUE_BATCH_MAX = 2000
+SMARTQUEUE_RTT_MULTIPLIER = 100  # 周期 = 往返延迟 * 倍数, 即每个周期里网络开销约占 1%
+SMARTQUEUE_DAMPING = 0.3  # 每次只向目标值靠近 30%, 防止振荡
+# 本地队列在内存中最多保留的任务数, 超出部分溢出到磁盘; 0 表示不限制.
+SMARTQUEUE_MEMORY_LIMIT = 0
+SMARTQUEUE_SPILL_DIR = None  # 溢出文件所在目录, 默认为系统临时目录
+SMARTQUEUE_SPILL_SEGMENT_SIZE = 16 * 1024 * 1024  # 每个溢出分段的字节数
+# ReliableSmartQueue 的节点租约期限(秒), 超过这么久没有续约的节点被视为死亡, 其任务被放回远程队列.
+SMARTQUEUE_LEASE_TIMEOUT = 120
+# 本地任务低于 tps_page * 往返延迟 * 倍数 时, 立即从远端预取一批任务.
+SMARTQUEUE_PREFETCH = True
+SMARTQUEUE_PREFETCH_FACTOR = 4
+# 调度器的微批: 入队的请求先攒在本地, 攒够 BATCH_SIZE 个、每隔 BATCH_INTERVAL 秒或者队列取空时,
+# 一起去重并批量推入队列, 每批只需几次往返. 0 为关闭, 每个请求单独处理.
+SCHEDULER_BATCH_SIZE = 0
+SCHEDULER_BATCH_INTERVAL = 0.1
+# 异步准入: 去重放到线程里执行, 不阻塞 reactor, 结果回来后再把没有重复的请求推入队列 (此时不设置 BATCH_SIZE 也会攒批).
+# 等待准入的请求超过 ADMISSION_BUFFER 个时暂停引擎, 降到一半以下再恢复.
+SCHEDULER_ADMISSION_ASYNC = False
+SCHEDULER_ADMISSION_BUFFER = 10000
 SCHEDULER_DUPEFILTER_KEY = '%(spider)s:dupefilter'
+# SCHEDULER_DUPEFILTER_CLASS = 'scrapy_redis_loadbalancing.dupefiltercuckoo.CuckooDupeFilter'
 SCHEDULER_DUPEFILTER_CLASS = 'scrapy_redis_loadbalancing.dupefilterbloom.BloomDupeFilter'
+# 布隆过滤器计算位置的方式: 'double' 为双重哈希; 'legacy' 兼容旧版本写入的位图.
+BLOOMFILTER_HASH = 'double'
+# 预计的指纹数量与期望的误判率, 用来推导位图大小、哈希个数与块数; 不设置容量时使用 256M 位图与 7 个哈希.
+BLOOMFILTER_CAPACITY = None
+BLOOMFILTER_ERROR_RATE = 0.001
+# 可扩展模式: 最新一层的填充率超过 FILL_RATIO 时追加一层, 新层容量乘以 GROWTH, 误判率乘以 TIGHTENING.
+# 每 CHECK_INTERVAL 秒检查一次填充率; 按 SAMPLE_RATE 抽样指纹放进精确集合, 统计实际误判率. 需要设置容量.
+BLOOMFILTER_SCALABLE = False
+BLOOMFILTER_GROWTH = 2
+BLOOMFILTER_TIGHTENING = 0.5
+BLOOMFILTER_FILL_RATIO = 0.5
+BLOOMFILTER_CHECK_INTERVAL = 60
+BLOOMFILTER_SAMPLE_RATE = 0.001
+# 本地指纹缓存的条目数 (每条 9 字节, 每 8 条另加 1 字节); 设置 CACHE_MEMORY (字节) 时按内存预算计算条目数.
+BLOOMFILTER_CACHE_SIZE = 100000
+BLOOMFILTER_CACHE_MEMORY = None
+# 在本地保存一份位图副本, 每 REPLICA_INTERVAL 秒按改动过的段增量同步; 副本与位图一样大, 需要设置容量, 不能与可扩展模式同时使用.
+# 只有开启副本时才记录改动过的段, 所以共享同一个过滤器的节点必须都开启或都不开启.
+BLOOMFILTER_REPLICA = False
+BLOOMFILTER_REPLICA_INTERVAL = 5
+# 分片: 把位图分成 SHARDS 个分片, 键名带 {hash tag}, 在 Redis Cluster 中各分片落在不同的槽;
+# 给出 SHARD_URLS 时分片轮流放到这些 Redis 上 (只设置 URL 时每个 URL 一个分片). 每批指纹按分片分组并发检查.
+# 不能与可扩展、副本或时间窗口模式同时使用.
+BLOOMFILTER_SHARDS = 0
+BLOOMFILTER_SHARD_URLS = []
+
+# 按时间窗口去重 (秒, 0 为永久记住): 只有最近 WINDOW 秒内见过的请求才算重复, 用于定期重新抓取.
+# 窗口被切成 GENERATIONS 代, 每代的键到期后由 Redis 自动删除. 对两种去重器都有效,
+# 布隆过滤器的 BLOOMFILTER_CAPACITY 此时是每一代的容量, 必须设置.
+DUPEFILTER_WINDOW = 0
+DUPEFILTER_GENERATIONS = 4
+# RFPDupeFilter 保存指纹的字节数: 0 为 40 字符的十六进制串 (兼容旧数据); 20 为完整的二进制 SHA1;
+# 8 或 16 为截断的摘要, 更省内存但有极小的碰撞概率, 见 RFPDupeFilter 的说明.
+DUPEFILTER_FINGERPRINT_BYTES = 0
+# 计算请求指纹的类, 结果按请求缓存. DROP_PARAMS 中匹配的查询参数 (可用 * 通配) 不参与指纹,
+# 使带跟踪参数的同一页面只抓一次; 默认为空, 与 Scrapy 的指纹一致.
+DUPEFILTER_FINGERPRINTER = 'scrapy_redis_loadbalancing.fingerprint.Fingerprinter'
+DUPEFILTER_DROP_PARAMS = []
+DUPEFILTER_KEEP_FRAGMENTS = False
+# 布谷鸟过滤器 (dupefiltercuckoo.CuckooDupeFilter) 的容量与插入时最多的踢出次数; 它可以删除指纹,
+# 配合 downloadermiddlewares.forget.ForgetFailedMiddleware 让彻底失败的请求以后还能被重新发现.
+CUCKOOFILTER_CAPACITY = 10000000
+CUCKOOFILTER_MAX_KICKS = 200
+# 哪些响应码视为彻底失败而被遗忘, 为空时使用 RETRY_HTTP_CODES.
+DUPEFILTER_FORGET_HTTP_CODES = []
 
 START_URLS_KEY = '%(name)s:start_urls'
 START_URLS_AS_SET = False
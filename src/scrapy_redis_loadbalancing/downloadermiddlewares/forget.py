@@ -0,0 +1,73 @@
+"""Forget requests that failed for good, so the dupefilter lets them in again."""
+import logging
+
+from scrapy.exceptions import IgnoreRequest
+
+from .. import defaults
+from ..dupefiltercuckoo import CuckooDupeFilter
+from ..fingerprint import fingerprinter_from_crawler
+
+logger = logging.getLogger(__name__)
+
+
+class ForgetFailedMiddleware(object):
+    """Removes the fingerprint of requests that ended in an error.
+
+    Works with dupefilters that have a ``forget`` method, such as
+    ``CuckooDupeFilter``. It must run after ``RetryMiddleware`` gave up, so give
+    it a lower order::
+
+        DOWNLOADER_MIDDLEWARES = {
+            'scrapy_redis_loadbalancing.downloadermiddlewares.forget.ForgetFailedMiddleware': 540,
+        }
+
+    A request is forgotten when its download raised (DNS errors, timeouts,
+    refused connections...) or its response status is in
+    ``DUPEFILTER_FORGET_HTTP_CODES`` (``RETRY_HTTP_CODES`` by default).
+    Retries are ``dont_filter`` copies, so the decision is based on the
+    ``CuckooDupeFilter.RECORDED_META`` flag the dupefilter sets on the original
+    request; requests that were never recorded are left alone.
+
+    """
+
+    def __init__(self, crawler, http_codes):
+        self.crawler = crawler
+        self.http_codes = set(http_codes)
+        # the dupefilter's fingerprinter, so logging a fingerprint is a cache hit
+        self.fingerprinter = fingerprinter_from_crawler(crawler)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        codes = (settings.getlist('DUPEFILTER_FORGET_HTTP_CODES', defaults.DUPEFILTER_FORGET_HTTP_CODES) or
+                 settings.getlist('RETRY_HTTP_CODES'))
+        return cls(crawler, [int(code) for code in codes])
+
+    @property
+    def dupefilter(self):
+        slot = getattr(self.crawler.engine, 'slot', None)
+        return getattr(getattr(slot, 'scheduler', None), 'df', None)
+
+    def forget(self, request, spider, reason):
+        if not request.meta.get(CuckooDupeFilter.RECORDED_META):
+            return
+        forget = getattr(self.dupefilter, 'forget', None)
+        if forget is None:
+            return
+        try:
+            if forget(request):
+                logger.debug('Forgot failed request %(request)s (%(reason)s, fingerprint %(fp)s)',
+                             {'request': request, 'reason': reason, 'fp': self.fingerprinter(request)},
+                             extra={'spider': spider})
+        except Exception:
+            logger.exception('Could not forget failed request %(request)s', {'request': request},
+                             extra={'spider': spider})
+
+    def process_response(self, request, response, spider):
+        if response.status in self.http_codes:
+            self.forget(request, spider, response.status)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if not isinstance(exception, IgnoreRequest):
+            self.forget(request, spider, exception.__class__.__name__)
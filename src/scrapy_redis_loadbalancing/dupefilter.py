@@ -1,12 +1,14 @@
+import binascii
 import logging
+import threading
 import time
 import redis
 
 from scrapy.dupefilters import BaseDupeFilter
-from scrapy.utils.request import request_fingerprint
 
 from . import defaults
 from .connection import get_redis_from_settings
+from .fingerprint import Fingerprinter, fingerprinter_from_crawler, fingerprinter_from_settings
 
 
 logger = logging.getLogger(__name__)
@@ -22,7 +24,31 @@ class RFPDupeFilter(BaseDupeFilter):
 
     logger = logger
 
-    def __init__(self, server, key, debug=False):
+    # KEYS[1] 为当前代, 之后为仍在窗口内的旧代; ARGV[1] 为当前代的过期时间, 之后为指纹.
+    # 旧代只检查, 都没有时加入当前代; 返回每个指纹是否已存在.
+    ROTATE_SCRIPT = """
+local result = {}
+for i = 2, #ARGV do
+    local seen = 0
+    for j = 2, #KEYS do
+        if redis.call('SISMEMBER', KEYS[j], ARGV[i]) == 1 then
+            seen = 1
+            break
+        end
+    end
+    if seen == 0 then
+        seen = 1 - redis.call('SADD', KEYS[1], ARGV[i])
+    end
+    result[#result + 1] = seen
+end
+redis.call('EXPIREAT', KEYS[1], ARGV[1])
+return result
+"""
+
+    batch_size = 1000  # fingerprints per pipeline or script call in request_seen_many
+
+    def __init__(self, server, key, debug=False, stats=None, window=0, generations=4, fingerprint_bytes=0,
+                 fingerprinter=None):
         """Initialize the duplicates filter.
 
         Parameters
@@ -33,16 +59,46 @@ class RFPDupeFilter(BaseDupeFilter):
             Redis key Where to store fingerprints.
         debug : bool, optional
             Whether to log filtered requests.
+        stats : scrapy.statscollectors.StatsCollector, optional
+        window : int, optional
+            When set, a request is a duplicate only if it was seen in the last
+            ``window`` seconds. Fingerprints are kept in ``generations + 1``
+            sets of ``window / generations`` seconds each, which expire on
+            their own.
+        generations : int, optional
+            How many generations the window is cut into.
+        fingerprint_bytes : int, optional
+            Store fingerprints as raw digests of this many bytes (at most 20)
+            instead of 40 character hex strings. Truncated digests can collide:
+            with ``n`` fingerprints the chance that any two share a prefix is
+            about ``n**2 / 2**(8 * fingerprint_bytes + 1)``, e.g. 3e-4 for
+            100 million 8 byte fingerprints and below 1e-22 with 16 bytes. A
+            collision makes one request look like a duplicate of another.
+            ``0`` keeps hex strings, as older versions wrote them.
+        fingerprinter : Fingerprinter, optional
+            Computes request fingerprints; defaults to a ``Fingerprinter``
+            without drop rules, which matches Scrapy's fingerprints.
 
         """
+        if not 0 <= fingerprint_bytes <= 20:
+            raise ValueError("fingerprint_bytes must be between 0 and 20: %r" % fingerprint_bytes)
         self.server = server
 #        self.server = redis.StrictRedis()
         self.key = key
         self.debug = debug
+        self.stats = stats
         self.logdupes = True
+        self.window = window
+        self.generations = generations
+        self.fingerprint_bytes = fingerprint_bytes
+        self.fingerprinter = fingerprinter or Fingerprinter()
+        # request_seen may run in the scheduler's admission thread
+        self.lock = threading.Lock()
+        if window:
+            self._rotate = server.register_script(self.ROTATE_SCRIPT)
 
     @classmethod
-    def from_settings(cls, settings, stats):
+    def from_settings(cls, settings, stats, fingerprinter=None):
         """Returns an instance from given settings.
 
         This uses by default the key ``dupefilter:<timestamp>``. When using the
@@ -52,6 +108,9 @@ class RFPDupeFilter(BaseDupeFilter):
         Parameters
         ----------
         settings : scrapy.settings.Settings
+        stats : scrapy.statscollectors.StatsCollector
+        fingerprinter : Fingerprinter, optional
+            Defaults to the one configured by ``DUPEFILTER_FINGERPRINTER``.
 
         Returns
         -------
@@ -67,8 +126,20 @@ class RFPDupeFilter(BaseDupeFilter):
         # TODO: Use SCRAPY_JOB env as default and fallback to timestamp.
         key = defaults.DUPEFILTER_KEY % {'timestamp': int(time.time())}
         debug = settings.getbool('DUPEFILTER_DEBUG')
-        return cls(server, key=key, stats=stats, debug=debug)
-        
+        fingerprinter = fingerprinter or fingerprinter_from_settings(settings)
+        return cls(server, key=key, stats=stats, debug=debug, fingerprinter=fingerprinter,
+                   **cls.window_kwargs(settings))
+
+    @staticmethod
+    def window_kwargs(settings):
+        """Returns the time window and storage parameters from given settings."""
+        return {
+            'window': settings.getint('DUPEFILTER_WINDOW', defaults.DUPEFILTER_WINDOW),
+            'generations': settings.getint('DUPEFILTER_GENERATIONS', defaults.DUPEFILTER_GENERATIONS),
+            'fingerprint_bytes': settings.getint('DUPEFILTER_FINGERPRINT_BYTES',
+                                                 defaults.DUPEFILTER_FINGERPRINT_BYTES),
+        }
+
     @classmethod
     def from_crawler(cls, crawler):
         """Returns instance from crawler.
@@ -83,7 +154,7 @@ class RFPDupeFilter(BaseDupeFilter):
             Instance of RFPDupeFilter.
 
         """
-        return cls.from_settings(crawler.settings, crawler.stats)
+        return cls.from_settings(crawler.settings, crawler.stats, fingerprinter_from_crawler(crawler))
     
     @classmethod
     def from_spider(cls, spider):
@@ -93,8 +164,10 @@ class RFPDupeFilter(BaseDupeFilter):
         key = dupefilter_key % {'spider': spider.name}
         debug = settings.getbool('DUPEFILTER_DEBUG')
         stats = spider.crawler.stats
-        return cls(server, key=key, stats=stats, debug=debug)
-    
+        fingerprinter = fingerprinter_from_crawler(spider.crawler)
+        return cls(server, key=key, stats=stats, debug=debug, fingerprinter=fingerprinter,
+                   **cls.window_kwargs(settings))
+
     def request_seen(self, request):
         """Returns True if request was already seen.
 
@@ -107,10 +180,60 @@ class RFPDupeFilter(BaseDupeFilter):
         bool
 
         """
-        fp = self.request_fingerprint(request)
-        # This returns the number of values added, zero if already exists.
-        added = self.server.sadd(self.key, fp)
-        return added == 0
+        with self.lock:
+            fp = self.encode(self.request_fingerprint(request))
+            if self.window:
+                return bool(self._rotate(keys=self.generation_keys(), args=[self.expire_at(), fp])[0])
+            # This returns the number of values added, zero if already exists.
+            added = self.server.sadd(self.key, fp)
+            return added == 0
+
+    def request_seen_many(self, requests):
+        """Returns, for each request, whether it was already seen.
+
+        Fingerprints are added with one pipelined (or, with a time window,
+        scripted) call per ``batch_size`` requests. A request repeated inside
+        the batch is seen from its second occurrence.
+
+        Parameters
+        ----------
+        requests : list of scrapy.http.Request
+
+        Returns
+        -------
+        list of bool
+
+        """
+        with self.lock:
+            fps = [self.encode(self.request_fingerprint(request)) for request in requests]
+            seen = []
+            for start in range(0, len(fps), self.batch_size):
+                chunk = fps[start:start + self.batch_size]
+                if self.window:
+                    added = self._rotate(keys=self.generation_keys(), args=[self.expire_at()] + chunk)
+                    seen.extend(bool(flag) for flag in added)
+                else:
+                    pipe = self.server.pipeline(transaction=False)
+                    for fp in chunk:
+                        pipe.sadd(self.key, fp)
+                    seen.extend(added == 0 for added in pipe.execute())
+            return seen
+
+    def encode(self, fp):
+        """Returns the stored form of a hex fingerprint."""
+        if self.fingerprint_bytes:
+            return binascii.unhexlify(fp)[:self.fingerprint_bytes]
+        return fp
+
+    def generation_keys(self):
+        """Returns the keys of the live generations, the current one first."""
+        current = int(time.time() // (float(self.window) / self.generations))
+        return ['%s:g%d' % (self.key, index) for index in range(current, current - self.generations - 1, -1)]
+
+    def expire_at(self):
+        """Returns when the current generation leaves the window."""
+        span = float(self.window) / self.generations
+        return int((time.time() // span + self.generations + 1) * span) + 1
 
     def request_fingerprint(self, request):
         """Returns a fingerprint for a given request.
@@ -124,16 +247,7 @@ class RFPDupeFilter(BaseDupeFilter):
         str
 
         """
-        return request_fingerprint(request)
-
-    @classmethod
-    def from_spider(cls, spider):
-        settings = spider.settings
-        server = get_redis_from_settings(settings)
-        dupefilter_key = settings.get("SCHEDULER_DUPEFILTER_KEY", defaults.SCHEDULER_DUPEFILTER_KEY)
-        key = dupefilter_key % {'spider': spider.name}
-        debug = settings.getbool('DUPEFILTER_DEBUG')
-        return cls(server, key=key, debug=debug)
+        return self.fingerprinter.fingerprint(request)
 
     def close(self, reason=''):
         """Delete data on close. Called by Scrapy's scheduler.
@@ -147,7 +261,10 @@ class RFPDupeFilter(BaseDupeFilter):
 
     def clear(self):
         """Clears fingerprints data."""
-        self.server.delete(self.key)
+        if self.window:
+            self.server.delete(self.key, *self.generation_keys())
+        else:
+            self.server.delete(self.key)
 
     def log(self, request, spider):
         """Logs given request.
@@ -1,11 +1,16 @@
 import logging
+import threading
 import time
 
 from scrapy.dupefilters import BaseDupeFilter
+from twisted.internet.threads import deferToThread
 from scrapy_redis_loadbalancing import defaults
-from scrapy_redis_loadbalancing.bloomfilter import BloomFilter
-from scrapy_redis_loadbalancing.connection import get_redis_from_settings
-from scrapy.dupefilters import request_fingerprint
+from scrapy_redis_loadbalancing.bloomfilter import (
+    BloomFilter, FingerprintCache, ReplicatedBloomFilter, RotatingBloomFilter, ScalableBloomFilter,
+    ShardedBloomFilter,
+)
+from scrapy_redis_loadbalancing.connection import get_redis_from_settings, get_redis_list_from_settings
+from scrapy_redis_loadbalancing.fingerprint import Fingerprinter, fingerprinter_from_crawler, fingerprinter_from_settings
 
 logger = logging.getLogger(__name__)
 
@@ -20,7 +25,11 @@ class BloomDupeFilter(BaseDupeFilter):
 
     logger = logger
 
-    def __init__(self, server, key, stats, debug=False):
+    def __init__(self, server, key, stats, debug=False, hash_mode=defaults.BLOOMFILTER_HASH,
+                 capacity=defaults.BLOOMFILTER_CAPACITY, error_rate=defaults.BLOOMFILTER_ERROR_RATE,
+                 scalable=defaults.BLOOMFILTER_SCALABLE, cache_size=defaults.BLOOMFILTER_CACHE_SIZE,
+                 replica=defaults.BLOOMFILTER_REPLICA, window=defaults.DUPEFILTER_WINDOW, fingerprinter=None,
+                 shards=defaults.BLOOMFILTER_SHARDS, shard_servers=None, **scalable_kwargs):
         """Initialize the duplicates filter.
 
         Parameters
@@ -31,6 +40,49 @@ class BloomDupeFilter(BaseDupeFilter):
             Redis key Where to store fingerprints.
         debug : bool, optional
             Whether to log filtered requests.
+        hash_mode : str, optional
+            How bit offsets are derived, see ``BloomFilter``. Use ``'legacy'``
+            to keep reading bitmaps written by older versions; the window,
+            scalable and sharded filters only support ``'double'``.
+        capacity : int, optional
+            Expected number of fingerprints. When given, the bitmap size, the
+            hash count and the block count are derived from it and
+            ``error_rate``; otherwise the historical 256 MB / 7 hashes is used.
+        error_rate : float, optional
+            Wanted false positive rate at ``capacity``.
+        scalable : bool, optional
+            Use a ``ScalableBloomFilter`` that adds layers as it fills up
+            instead of a fixed size one. Needs ``capacity``.
+        cache_size : int, optional
+            Entries of the local ``FingerprintCache`` answering repeated
+            fingerprints without a Redis call.
+        replica : bool, optional
+            Keep a local copy of the bitmap (``ReplicatedBloomFilter``) so
+            fingerprints it already holds are answered without Redis.
+        window : int, optional
+            Only requests seen in the last ``window`` seconds are duplicates
+            (``RotatingBloomFilter``); ``capacity`` is then per generation and
+            required.
+        fingerprinter : Fingerprinter, optional
+            Computes request fingerprints; defaults to a ``Fingerprinter``
+            without drop rules, which matches Scrapy's fingerprints.
+        shards : int, optional
+            Spread the bitmap over this many hash-tagged shards
+            (``ShardedBloomFilter``), queried concurrently.
+        shard_servers : list, optional
+            Redis clients the shards are spread over; defaults to ``server``.
+        scalable_kwargs
+            Extra ``ScalableBloomFilter`` parameters (``growth``,
+            ``tightening``, ``fill_ratio``, ``check_interval``, ``sample_rate``),
+            ``sync_interval`` for ``ReplicatedBloomFilter``, or
+            ``generations`` for ``RotatingBloomFilter``.
+
+        Raises
+        ------
+        ValueError
+            When more than one of ``window``, ``scalable``, ``shards`` and
+            ``replica`` is set, as each selects a different filter, or when
+            ``hash_mode`` is not supported by the selected one.
 
         """
         import redis
@@ -40,10 +92,38 @@ class BloomDupeFilter(BaseDupeFilter):
         self.stats = stats
         self.debug = debug
         self.logdupes = True
-        self.bf = BloomFilter(self.server, key, blockNum=1)
+        self.fingerprinter = fingerprinter or Fingerprinter()
+        # request_seen may run in the scheduler's admission thread while the
+        # reactor uses the filter too; the local caches, the replica bitmap and
+        # the stats it updates are only touched while holding this lock
+        self.lock = threading.Lock()
+        variants = [name for name, enabled in (('window', window), ('scalable', scalable),
+                                                ('shards', shards or shard_servers), ('replica', replica)) if enabled]
+        if len(variants) > 1:
+            raise ValueError('bloom filter options cannot be combined: %s' % ', '.join(variants))
+        if hash_mode != 'double' and variants and variants != ['replica']:
+            raise ValueError("hash_mode=%r is not supported with %s" % (hash_mode, variants[0]))
+        if window:
+            self.bf = RotatingBloomFilter(self.server, key, window=window, capacity=capacity, error_rate=error_rate,
+                                          cache_size=cache_size, **scalable_kwargs)
+        elif scalable:
+            self.bf = ScalableBloomFilter(self.server, key, capacity=capacity, error_rate=error_rate,
+                                          stats=stats, cache_size=cache_size, **scalable_kwargs)
+        elif shards or shard_servers:
+            self.bf = ShardedBloomFilter(self.server, key, shards=shards or len(shard_servers), servers=shard_servers,
+                                         capacity=capacity, error_rate=error_rate, cache_size=cache_size)
+        elif replica:
+            self.bf = ReplicatedBloomFilter(self.server, key, stats=stats, hash_mode=hash_mode, capacity=capacity,
+                                            error_rate=error_rate, cache_size=cache_size, **scalable_kwargs)
+        else:
+            self.bf = BloomFilter(self.server, key, blockNum=1, hash_mode=hash_mode,
+                                  capacity=capacity, error_rate=error_rate, cache_size=cache_size)
+        if self.stats:
+            for name, value in self.bf.info().items():
+                self.stats.set_value('bloomfilter/' + name, value)
 
     @classmethod
-    def from_settings(cls, settings, stats):
+    def from_settings(cls, settings, stats, fingerprinter=None):
         """Returns an instance from given settings.
 
         This uses by default the key ``dupefilter:<timestamp>``. When using the
@@ -53,6 +133,9 @@ class BloomDupeFilter(BaseDupeFilter):
         Parameters
         ----------
         settings : scrapy.settings.Settings
+        stats : scrapy.statscollectors.StatsCollector
+        fingerprinter : Fingerprinter, optional
+            Defaults to the one configured by ``DUPEFILTER_FINGERPRINTER``.
 
         Returns
         -------
@@ -68,7 +151,51 @@ class BloomDupeFilter(BaseDupeFilter):
         # TODO: Use SCRAPY_JOB env as default and fallback to timestamp.
         key = defaults.DUPEFILTER_KEY % {'timestamp': int(time.time())}
         debug = settings.getbool('DUPEFILTER_DEBUG')
-        return cls(server, key=key, stats=stats, debug=debug)
+        fingerprinter = fingerprinter or fingerprinter_from_settings(settings)
+        return cls(server, key=key, stats=stats, debug=debug, fingerprinter=fingerprinter,
+                   **cls.bloom_kwargs(settings))
+
+    @staticmethod
+    def bloom_kwargs(settings):
+        """Returns the bloom filter parameters from given settings."""
+        cache_memory = settings.getint('BLOOMFILTER_CACHE_MEMORY') or defaults.BLOOMFILTER_CACHE_MEMORY
+        kwargs = {
+            'cache_size': (FingerprintCache.entries_for(cache_memory) if cache_memory else
+                           settings.getint('BLOOMFILTER_CACHE_SIZE', defaults.BLOOMFILTER_CACHE_SIZE)),
+            'hash_mode': settings.get('BLOOMFILTER_HASH', defaults.BLOOMFILTER_HASH),
+            'capacity': settings.getint('BLOOMFILTER_CAPACITY') or defaults.BLOOMFILTER_CAPACITY,
+            'error_rate': settings.getfloat('BLOOMFILTER_ERROR_RATE', defaults.BLOOMFILTER_ERROR_RATE),
+        }
+        # every option is passed on, __init__ rejects the combinations it cannot honour
+        if settings.getint('DUPEFILTER_WINDOW', defaults.DUPEFILTER_WINDOW):
+            kwargs.update({
+                'window': settings.getint('DUPEFILTER_WINDOW', defaults.DUPEFILTER_WINDOW),
+                'generations': settings.getint('DUPEFILTER_GENERATIONS', defaults.DUPEFILTER_GENERATIONS),
+            })
+        if settings.getbool('BLOOMFILTER_SCALABLE', defaults.BLOOMFILTER_SCALABLE):
+            kwargs.update({
+                'scalable': True,
+                'growth': settings.getint('BLOOMFILTER_GROWTH', defaults.BLOOMFILTER_GROWTH),
+                'tightening': settings.getfloat('BLOOMFILTER_TIGHTENING', defaults.BLOOMFILTER_TIGHTENING),
+                'fill_ratio': settings.getfloat('BLOOMFILTER_FILL_RATIO', defaults.BLOOMFILTER_FILL_RATIO),
+                'check_interval': settings.getfloat('BLOOMFILTER_CHECK_INTERVAL',
+                                                    defaults.BLOOMFILTER_CHECK_INTERVAL),
+                'sample_rate': settings.getfloat('BLOOMFILTER_SAMPLE_RATE', defaults.BLOOMFILTER_SAMPLE_RATE),
+            })
+        if settings.getbool('BLOOMFILTER_REPLICA', defaults.BLOOMFILTER_REPLICA):
+            kwargs.update({
+                'replica': True,
+                'sync_interval': settings.getfloat('BLOOMFILTER_REPLICA_INTERVAL',
+                                                   defaults.BLOOMFILTER_REPLICA_INTERVAL),
+            })
+        urls = settings.getlist('BLOOMFILTER_SHARD_URLS', defaults.BLOOMFILTER_SHARD_URLS)
+        shards = settings.getint('BLOOMFILTER_SHARDS', defaults.BLOOMFILTER_SHARDS) or len(urls)
+        if shards:
+            kwargs.update({
+                'shards': shards,
+                'shard_servers': get_redis_list_from_settings(settings, urls) if urls else None,
+            })
+        return kwargs
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -84,7 +211,7 @@ class BloomDupeFilter(BaseDupeFilter):
             Instance of RFPDupeFilter.
 
         """
-        return cls.from_settings(crawler.settings, crawler.stats)
+        return cls.from_settings(crawler.settings, crawler.stats, fingerprinter_from_crawler(crawler))
 
     @classmethod
     def from_spider(cls, spider):
@@ -94,7 +221,9 @@ class BloomDupeFilter(BaseDupeFilter):
         key = dupefilter_key % {'spider': spider.name}
         debug = settings.getbool('DUPEFILTER_DEBUG')
         stats = spider.crawler.stats
-        return cls(server, key=key, stats=stats, debug=debug)
+        fingerprinter = fingerprinter_from_crawler(spider.crawler)
+        return cls(server, key=key, stats=stats, debug=debug, fingerprinter=fingerprinter,
+                   **cls.bloom_kwargs(settings))
 
     def request_seen(self, request):
         """Returns True if request was already seen.
@@ -108,10 +237,13 @@ class BloomDupeFilter(BaseDupeFilter):
         bool
 
         """
-        fp = self.request_fingerprint(request)
-        # BloomFilter
-        self.stats.inc_value('dupefilter/buerfilter')
-        if self.bf.existent(fp):
+        with self.lock:
+            fp = self.request_fingerprint(request)
+            # BloomFilter
+            self.stats.inc_value('dupefilter/buerfilter')
+            seen = self.bf.existent(fp)
+            self.cache_stats()
+        if seen:
             return True
         else:
             self.stats.inc_value('dupefilter/bloomfilter')
@@ -120,6 +252,35 @@ class BloomDupeFilter(BaseDupeFilter):
             # added = self.server.sadd(self.key, fp)
             # return added == 0
 
+    def request_seen_many(self, requests):
+        """Returns, for each request, whether it was already seen.
+
+        All fingerprints are checked and recorded with a single atomic call,
+        use this when a callback yields many requests at once.
+
+        Parameters
+        ----------
+        requests : list of scrapy.http.Request
+
+        Returns
+        -------
+        list of bool
+
+        """
+        with self.lock:
+            seen = self.bf.existent_many([self.request_fingerprint(request) for request in requests])
+            self.stats.inc_value('dupefilter/buerfilter', len(seen))
+            self.stats.inc_value('dupefilter/bloomfilter', seen.count(False))
+            self.cache_stats()
+        return seen
+
+    def cache_stats(self):
+        """Publishes the local fingerprint cache counters."""
+        cache = self.bf.buerfilter
+        self.stats.set_value('bloomfilter/cache/hits', cache.hits)
+        self.stats.set_value('bloomfilter/cache/misses', cache.misses)
+        self.stats.set_value('bloomfilter/cache/evictions', cache.evictions)
+
     def request_fingerprint(self, request):
         """Returns a fingerprint for a given request.
 
@@ -134,7 +295,18 @@ class BloomDupeFilter(BaseDupeFilter):
         """
         # splash_request_fingerprint 会自动判断 request 是否符合 SplashRequest 特征
         # 如果符合 SplashRequest 特征会进一步处理,否则就和普通的 request_fingerprint 是一样的效果
-        return request_fingerprint(request)
+        return self.fingerprinter.fingerprint(request)
+
+    def open(self):
+        """Loads the local bitmap replica, if any, off the reactor thread.
+
+        Returns
+        -------
+        Deferred or None
+
+        """
+        if isinstance(self.bf, ReplicatedBloomFilter) and self.bf.blocks is None:
+            return deferToThread(self.bf.sync)
 
     def close(self, reason=''):
         """Delete data on close. Called by Scrapy's scheduler.
@@ -149,6 +321,7 @@ class BloomDupeFilter(BaseDupeFilter):
     def clear(self):
         """Clears fingerprints data."""
         self.server.delete(self.key)
+        self.bf.clear()
 
     def log(self, request, spider):
         """Logs given request.
@@ -0,0 +1,138 @@
+import logging
+import threading
+
+from scrapy_redis_loadbalancing import defaults
+from scrapy_redis_loadbalancing.cuckoofilter import CuckooFilter
+from scrapy_redis_loadbalancing.dupefilterbloom import BloomDupeFilter
+from scrapy_redis_loadbalancing.fingerprint import Fingerprinter
+
+logger = logging.getLogger(__name__)
+
+
+class CuckooDupeFilter(BloomDupeFilter):
+    """Redis-based request duplicates filter backed by a cuckoo filter.
+
+    Unlike the bloom filter, fingerprints can be removed again: enable
+    ``scrapy_redis_loadbalancing.downloadermiddlewares.forget.ForgetFailedMiddleware``
+    so requests that failed for good can be discovered and crawled later.
+
+    """
+
+    logger = logger
+
+    # Set on requests this filter recorded as new. Retries are copies with
+    # ``dont_filter=True``, so the flag, which survives the copy, is what
+    # tells ForgetFailedMiddleware the fingerprint may be removed.
+    RECORDED_META = 'dupefilter_recorded'
+
+    def __init__(self, server, key, stats, debug=False, capacity=defaults.CUCKOOFILTER_CAPACITY,
+                 max_kicks=defaults.CUCKOOFILTER_MAX_KICKS, fingerprinter=None):
+        """Initialize the duplicates filter.
+
+        Parameters
+        ----------
+        server : redis.StrictRedis
+            The redis server instance.
+        key : str
+            Redis key Where to store fingerprints.
+        debug : bool, optional
+            Whether to log filtered requests.
+        capacity : int, optional
+            Expected number of fingerprints.
+        max_kicks : int, optional
+            Relocations tried on insert before a tag overflows.
+        fingerprinter : Fingerprinter, optional
+            Computes request fingerprints.
+
+        """
+        self.server = server
+        self.key = key
+        self.stats = stats
+        self.debug = debug
+        self.logdupes = True
+        self.fingerprinter = fingerprinter or Fingerprinter()
+        # see BloomDupeFilter.__init__
+        self.lock = threading.Lock()
+        self.bf = CuckooFilter(server, key, capacity=capacity, max_kicks=max_kicks)
+        if self.stats:
+            for name, value in self.bf.info().items():
+                self.stats.set_value('cuckoofilter/' + name, value)
+
+    @staticmethod
+    def bloom_kwargs(settings):
+        """Returns the cuckoo filter parameters from given settings."""
+        return {
+            'capacity': settings.getint('CUCKOOFILTER_CAPACITY', defaults.CUCKOOFILTER_CAPACITY),
+            'max_kicks': settings.getint('CUCKOOFILTER_MAX_KICKS', defaults.CUCKOOFILTER_MAX_KICKS),
+        }
+
+    def request_seen(self, request):
+        """Returns True if request was already seen.
+
+        Parameters
+        ----------
+        request : scrapy.http.Request
+
+        Returns
+        -------
+        bool
+
+        """
+        return self.request_seen_many([request])[0]
+
+    def request_seen_many(self, requests):
+        """Returns, for each request, whether it was already seen.
+
+        Parameters
+        ----------
+        requests : list of scrapy.http.Request
+
+        Returns
+        -------
+        list of bool
+
+        """
+        with self.lock:
+            seen = self.bf.existent_many([self.request_fingerprint(request) for request in requests])
+            self.stats.inc_value('dupefilter/cuckoofilter', len(seen))
+            self.stats.inc_value('dupefilter/cuckoofilter/new', seen.count(False))
+        for request, flag in zip(requests, seen):
+            if not flag:
+                request.meta[self.RECORDED_META] = True
+        return seen
+
+    def forget(self, request):
+        """Removes a request, so it is not a duplicate anymore.
+
+        Only requests this filter reported as new may be forgotten; removing
+        any other fingerprint could drop the tag of a different request.
+        Requests without the ``RECORDED_META`` flag are left alone, and the
+        flag is cleared so a request is forgotten at most once.
+
+        Parameters
+        ----------
+        request : scrapy.http.Request
+
+        Returns
+        -------
+        bool
+            Whether a fingerprint was removed.
+
+        """
+        return self.forget_many([request])[0]
+
+    def forget_many(self, requests):
+        """Removes several requests with one call, see ``forget``."""
+        result = [False] * len(requests)
+        recorded = [i for i, request in enumerate(requests) if request.meta.pop(self.RECORDED_META, False)]
+        with self.lock:
+            if recorded:
+                removed = self.bf.delete_many([self.request_fingerprint(requests[i]) for i in recorded])
+                for i, flag in zip(recorded, removed):
+                    result[i] = flag
+            self.stats.inc_value('dupefilter/cuckoofilter/forgotten', sum(result))
+        return result
+
+    def clear(self):
+        """Clears fingerprints data."""
+        self.server.delete(*self.bf.keys())
@@ -0,0 +1,123 @@
+import hashlib
+import re
+import threading
+from fnmatch import translate
+from weakref import WeakKeyDictionary
+
+from scrapy.utils.misc import load_object
+from scrapy.utils.python import to_bytes
+from w3lib.url import canonicalize_url, url_query_cleaner
+
+from . import defaults
+
+
+class Fingerprinter(object):
+    """Request fingerprints shared by every dedup component.
+
+    The fingerprint is the SHA1 of the method, the canonical URL and the body,
+    exactly like ``scrapy.utils.request.request_fingerprint``, so without drop
+    rules both give the same value. ``canonicalize_url`` already sorts the
+    query and lowercases the host; on top of that, query parameters matching
+    one of ``drop_params`` (shell-style patterns such as ``utm_*``) are removed
+    so tracking variants of a URL share one fingerprint.
+
+    Results are cached per request in a ``WeakKeyDictionary``, so the
+    dupefilter, the scheduler and any other component asking for the same
+    request pay for the hash only once. The cache is guarded by a lock, as
+    fingerprints are also computed in the scheduler's admission thread.
+
+    """
+
+    def __init__(self, drop_params=(), keep_fragments=False):
+        """Initialize the fingerprinter.
+
+        Parameters
+        ----------
+        drop_params : list of str, optional
+            Patterns of query parameter names to ignore.
+        keep_fragments : bool, optional
+            Whether URL fragments are part of the fingerprint.
+
+        """
+        self.drop_params = list(drop_params)
+        self.keep_fragments = keep_fragments
+        self._drop = re.compile('|'.join(translate(p) for p in self.drop_params)).match if self.drop_params else None
+        self.cache = WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            drop_params=settings.getlist('DUPEFILTER_DROP_PARAMS', defaults.DUPEFILTER_DROP_PARAMS),
+            keep_fragments=settings.getbool('DUPEFILTER_KEEP_FRAGMENTS', defaults.DUPEFILTER_KEEP_FRAGMENTS),
+        )
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls.from_settings(crawler.settings)
+
+    def canonical_url(self, url):
+        """Returns the URL as it is fingerprinted.
+
+        Parameters
+        ----------
+        url : str
+
+        Returns
+        -------
+        str
+
+        """
+        if self._drop and '?' in url:
+            query = url.split('?', 1)[1].split('#', 1)[0]
+            names = [part.split('=', 1)[0] for part in query.split('&') if part]
+            dropped = [name for name in names if self._drop(name)]
+            if dropped:
+                url = url_query_cleaner(url, dropped, remove=True, unique=False, keep_fragments=True)
+        return canonicalize_url(url, keep_fragments=self.keep_fragments)
+
+    def fingerprint(self, request):
+        """Returns the hex fingerprint of a request, computed once per request.
+
+        Parameters
+        ----------
+        request : scrapy.http.Request
+
+        Returns
+        -------
+        str
+
+        """
+        with self._lock:
+            result = self.cache.get(request)
+        if result is not None:
+            return result
+        fp = hashlib.sha1()
+        fp.update(to_bytes(request.method))
+        fp.update(to_bytes(self.canonical_url(request.url)))
+        fp.update(request.body or b'')
+        result = fp.hexdigest()
+        with self._lock:
+            self.cache[request] = result
+        return result
+
+    __call__ = fingerprint
+
+
+def fingerprinter_from_settings(settings):
+    """Returns the fingerprinter configured by ``DUPEFILTER_FINGERPRINTER``."""
+    cls = load_object(settings.get('DUPEFILTER_FINGERPRINTER', defaults.DUPEFILTER_FINGERPRINTER))
+    return cls.from_settings(settings)
+
+
+def fingerprinter_from_crawler(crawler):
+    """Returns the fingerprinter shared by every component of a crawler.
+
+    It is created on first use and kept as ``crawler.dupefilter_fingerprinter``,
+    so the scheduler, the dupefilter and the middlewares share one cache.
+
+    """
+    fingerprinter = getattr(crawler, 'dupefilter_fingerprinter', None)
+    if fingerprinter is None:
+        fingerprinter = crawler.dupefilter_fingerprinter = fingerprinter_from_settings(crawler.settings)
+    return fingerprinter
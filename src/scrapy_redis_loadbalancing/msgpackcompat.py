@@ -0,0 +1,105 @@
+"""A compact msgpack codec for ``request_to_dict`` output.
+
+Use it as a drop-in serializer::
+
+    SCHEDULER_SERIALIZER = 'scrapy_redis_loadbalancing.msgpackcompat'
+
+Each payload is one version byte followed by a msgpack map. Known request
+fields use small integer keys and are left out when they hold their default
+value. Common callback names are sent as one-byte codes, and decoded names are
+interned. Values msgpack cannot represent exactly, such as tuples or dict
+subclasses, fall back to an embedded pickle so they keep their type.
+Payloads written by ``picklecompat`` are still readable.
+"""
+import sys
+
+import msgpack
+
+from . import picklecompat
+
+VERSION = 1
+
+_PICKLE_EXT = 1
+_PICKLE_PROTO = 0x80  # pickle protocol >= 2 always starts with this byte
+
+# (field, tag, default) - the tag order is part of the format, only append.
+FIELDS = (
+    ('url', 0, None),
+    ('callback', 1, None),
+    ('errback', 2, None),
+    ('method', 3, 'GET'),
+    ('headers', 4, {}),
+    ('body', 5, b''),
+    ('cookies', 6, {}),
+    ('meta', 7, {}),
+    ('_encoding', 8, 'utf-8'),
+    ('priority', 9, 0),
+    ('dont_filter', 10, False),
+    ('flags', 11, []),
+    ('cb_kwargs', 12, {}),
+    ('_class', 13, None),
+)
+_TAGS = {field: tag for field, tag, _ in FIELDS}
+_FIELDS = {tag: (field, default) for field, tag, default in FIELDS}
+
+# Callback names common enough to deserve a one-byte code; only append.
+CALLBACKS = ('parse', '_response_downloaded', 'parse_item', 'parse_detail', 'parse_list')
+_CALLBACK_CODES = {name: code for code, name in enumerate(CALLBACKS)}
+
+
+def _default(obj):
+    return msgpack.ExtType(_PICKLE_EXT, picklecompat.dumps(obj))
+
+
+def _ext_hook(code, data):
+    if code == _PICKLE_EXT:
+        return picklecompat.loads(data)
+    return msgpack.ExtType(code, data)
+
+
+def _encode_name(name):
+    if name is None:
+        return None
+    return _CALLBACK_CODES.get(name, name)
+
+
+def _decode_name(value):
+    if isinstance(value, int):
+        return CALLBACKS[value]
+    return sys.intern(value)
+
+
+def dumps(obj):
+    packed = {}
+    for field, value in obj.items():
+        tag = _TAGS.get(field)
+        if tag is None:
+            packed[field] = value  # unknown fields travel with their name
+            continue
+        if field != 'url' and value == _FIELDS[tag][1]:
+            continue
+        if field in ('callback', 'errback'):
+            value = _encode_name(value)
+        elif field == 'headers':
+            value = dict(value)
+        packed[tag] = value
+    return bytes(bytearray([VERSION])) + msgpack.packb(packed, use_bin_type=True, strict_types=True, default=_default)
+
+
+def loads(s):
+    if s[0] == _PICKLE_PROTO:  # written by picklecompat
+        return picklecompat.loads(s)
+    if s[0] != VERSION:
+        raise ValueError("unsupported msgpackcompat version: %r" % s[0])
+    packed = msgpack.unpackb(s[1:], raw=False, strict_map_key=False, ext_hook=_ext_hook)
+    obj = {}
+    for field, tag, default in FIELDS:
+        if tag in packed:
+            value = packed.pop(tag)
+            if field in ('callback', 'errback') and value is not None:
+                value = _decode_name(value)
+            obj[field] = value
+        elif field != '_class':
+            obj[field] = default.copy() if isinstance(default, (dict, list)) else default
+    obj.update(packed)
+    return obj
@@ -59,6 +59,24 @@ class Base(object):
         """Pop a request"""
         raise NotImplementedError
 
+    def push_many(self, requests):
+        """Push several requests, returns how many were pushed"""
+        count = 0
+        for request in requests:
+            self.push(request)
+            count += 1
+        return count
+
+    def pop_many(self, count):
+        """Pop up to ``count`` requests"""
+        requests = []
+        while len(requests) < count:
+            request = self.pop()
+            if request is None:
+                break
+            requests.append(request)
+        return requests
+
     def clear(self):
         """Clear queue/stack"""
         self.server.delete(self.key)
@@ -75,6 +93,13 @@ class FifoQueue(Base):
         """Push a request"""
         self.server.lpush(self.key, self._encode_request(request))
 
+    def push_many(self, requests):
+        """Push several requests with one LPUSH"""
+        datas = [self._encode_request(request) for request in requests]
+        if datas:
+            self.server.lpush(self.key, *datas)
+        return len(datas)
+
     def pop(self, timeout=0):
         """Pop a request"""
         if timeout > 0:
@@ -88,7 +113,46 @@ class FifoQueue(Base):
 
 
 class PriorityQueue(Base):
-    """Per-spider priority queue abstraction using redis' sorted set"""
+    """Per-spider priority queue abstraction using redis' sorted set
+
+    The score is ``-priority`` plus a fraction taken from a sequence counter
+    stored at ``<key>:seq``, so higher priorities come out first and requests
+    of equal priority come out in the order they were pushed, across all
+    nodes sharing the queue. The fraction has 32 bits; the order of equal
+    priorities wraps around once every 2**32 pushes.
+
+    """
+
+    # KEYS[1] is the queue, KEYS[2] the sequence counter; ARGV holds
+    # (-priority, data) pairs. Scores are formatted by hand because Lua would
+    # otherwise round them to 14 significant digits.
+    PUSH_SCRIPT = """
+local n = #ARGV / 2
+local seq = redis.call('INCRBY', KEYS[2], n) - n
+local args = {}
+for i = 1, #ARGV, 2 do
+    seq = seq + 1
+    args[#args + 1] = string.format('%.17g', tonumber(ARGV[i]) + (seq % 4294967296) / 4294967296)
+    args[#args + 1] = ARGV[i + 1]
+end
+return redis.call('ZADD', KEYS[1], unpack(args))
+"""
+
+    POP_SCRIPT = """
+local items = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, #items - 1)
+end
+return items
+"""
+
+    batch_size = 1000  # requests per script call, keeps unpack() and the server stall small
+
+    def __init__(self, *args, **kwargs):
+        super(PriorityQueue, self).__init__(*args, **kwargs)
+        self.seq_key = self.key + ':seq'
+        self._push_script = self.server.register_script(self.PUSH_SCRIPT)
+        self._pop_script = self.server.register_script(self.POP_SCRIPT)
 
     def __len__(self):
         """Return the length of the queue"""
@@ -96,25 +160,37 @@ class PriorityQueue(Base):
 
     def push(self, request):
         """Push a request"""
-        data = self._encode_request(request)
-        score = -request.priority
-        # We don't use zadd method as the order of arguments change depending on
-        # whether the class is Redis or StrictRedis, and the option of using
-        # kwargs only accepts strings, not bytes.
-        self.server.execute_command('ZADD', self.key, score, data)
+        self.push_many([request])
+
+    def push_many(self, requests):
+        """Push several requests with one script call per ``batch_size``"""
+        requests = list(requests)
+        for start in range(0, len(requests), self.batch_size):
+            args = []
+            for request in requests[start:start + self.batch_size]:
+                args.extend((-request.priority, self._encode_request(request)))
+            self._push_script(keys=[self.key, self.seq_key], args=args)
+        return len(requests)
 
     def pop(self, timeout=0):
         """
         Pop a request
         timeout not support in this queue class
         """
-        # use atomic range/remove using multi/exec
-        pipe = self.server.pipeline()
-        pipe.multi()
-        pipe.zrange(self.key, 0, 0).zremrangebyrank(self.key, 0, 0)
-        results, count = pipe.execute()
-        if results:
-            return self._decode_request(results[0])
+        requests = self.pop_many(1)
+        if requests:
+            return requests[0]
+
+    def pop_many(self, count):
+        """Atomically pop the ``count`` highest priority requests"""
+        if count < 1:
+            return []
+        datas = self._pop_script(keys=[self.key], args=[count])
+        return [self._decode_request(data) for data in datas]
+
+    def clear(self):
+        """Clear the queue and its sequence counter"""
+        self.server.delete(self.key, self.seq_key)
 
 
 class LifoQueue(Base):
@@ -128,6 +204,13 @@ class LifoQueue(Base):
         """Push a request"""
         self.server.lpush(self.key, self._encode_request(request))
 
+    def push_many(self, requests):
+        """Push several requests with one LPUSH"""
+        datas = [self._encode_request(request) for request in requests]
+        if datas:
+            self.server.lpush(self.key, *datas)
+        return len(datas)
+
     def pop(self, timeout=0):
         """Pop a request"""
         if timeout > 0:
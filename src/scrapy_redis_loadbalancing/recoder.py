@@ -1,7 +1,7 @@
 # coding: utf-8
 
 from __future__ import print_function, unicode_literals
-from twisted.internet import task
+from twisted.internet import reactor, task
 from collections import deque
 import statistics
 import uuid
@@ -17,6 +17,9 @@ from .tools import Color
 
 logger = logging.getLogger(__name__)
 
+# 有节点离开集群时发出, 参数 nodes 为离开节点的 uuid 集合
+node_departed = object()
+
 
 class CacheQueue(deque):
     """ 通过 cache 采集一定长度的数据,便于数据分析 """
@@ -76,8 +79,12 @@ class ClusterState(object):
         """ 集群数量监听: COUNT_OF_HOSTS """
 
         def listen(children):  # 监听有没有新节点加入
+            current = {uuid.UUID(_uuid) for _uuid in children}
+            departed = self.hosts - current  # 离开集群的节点
             self.hosts.clear()  # 清空
-            self.hosts.update({uuid.UUID(_uuid) for _uuid in children})  # 更新主机列表
+            self.hosts.update(current)  # 更新主机列表
+            if departed:  # 监听运行在 kazoo 的线程中, 信号要回到 reactor 线程发出
+                reactor.callFromThread(self.crawler.signals.send_catch_log, signal=node_departed, nodes=departed)
             count_of_hosts = len(self.hosts)  # 当前主机的数量
             self.stats.set_value('COUNT_OF_HOSTS', count_of_hosts)
             logger.warning(Color.yellow('COUNT_OF_HOSTS is {}'.format(count_of_hosts)))
@@ -216,13 +223,16 @@ class SlotStats(ClusterState):
         smartqueue = self.stats.get_value('scheduler/dequeued/redis', 0) + self.stats.get_value(
             'scheduler/enqueued/redis', 0)  # 本地进出队列次数
 
+        localload = length_queue / tps_page if tps_page else 0  # 本地负载量
+        self.stats.set_value('localload', localload)  # 供 StealingSmartQueue 发布给其他节点
+
         # 数据
         data = {
             'count_pages': pages,  # 爬取量
             'count_items': items,  # 处理量
             'tps_page': tps_page or 0,  # 吞吐量
             'tps_download': tps_download // 1024,  # 转换成KB为单位
-            'localload': length_queue / tps_page if tps_page else 0,  # 本地负载量
+            'localload': localload,  # 本地负载量
             'memoryusage': memoryusage / 1024 / 1024,  # MB 内存使用量
             'optimize_filter': (buerfilter - bloomfilter) / buerfilter if buerfilter else 0,  # (本地访问数量-远端访问数量)/本地访问数量
             'optimize_queue': (smartqueue - remotequeue) / smartqueue if smartqueue else 0,  # (本地访问数量-远端访问数量)/本地访问数量
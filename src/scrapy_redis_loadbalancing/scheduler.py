@@ -1,9 +1,20 @@
 import importlib
+import logging
+import time
+
 import six
 
+from scrapy import signals
+from scrapy.utils.log import failure_to_exc_info
 from scrapy.utils.misc import load_object
+from twisted.internet import task
+from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
 
 from . import connection, defaults
+from .fingerprint import fingerprinter_from_crawler
+
+logger = logging.getLogger(__name__)
 
 
 # TODO: add SCRAPY_JOB support.
@@ -27,10 +38,33 @@ class Scheduler(object):
     SCHEDULER_DUPEFILTER_CLASS : str
         Scheduler dupefilter class.
     SCHEDULER_SERIALIZER : str
-        Scheduler serializer.
+        Scheduler serializer. ``scrapy_redis_loadbalancing.msgpackcompat``
+        gives the most compact remote queue entries.
+    SCHEDULER_BATCH_SIZE : int (default: 0)
+        Buffer enqueued requests and dedup/push them in batches of this
+        size. 0 handles each request on its own.
+    SCHEDULER_BATCH_INTERVAL : float (default: 0.1)
+        Seconds after which a partial batch is flushed anyway.
+    SCHEDULER_ADMISSION_ASYNC : bool (default: False)
+        Resolve dedup of buffered requests in a thread instead of on the
+        reactor; surviving requests are pushed when the answer arrives.
+    SCHEDULER_ADMISSION_BUFFER : int (default: 10000)
+        Buffered requests above which the engine is paused until the
+        admission catches up.
+
+    With batching enabled, duplicates are only known when the buffer is
+    flushed: ``enqueue_request`` then always returns True and the engine does
+    not send ``request_dropped`` itself. The scheduler sends that signal for
+    each duplicate at flush time instead, so handlers still see every dropped
+    request, only later.
 
     """
 
+    # requests per dupefilter call, no larger than the batch of the bundled
+    # filters so that each chunk is recorded by a single call
+    dedup_chunk = 500
+    admission_retry_delay = 1.0  # seconds before a failed admission is retried
+
     def __init__(self, server,
                  persist=False,
                  flush_on_start=False,
@@ -39,7 +73,11 @@ class Scheduler(object):
                  dupefilter_key=defaults.SCHEDULER_DUPEFILTER_KEY,
                  dupefilter_cls=defaults.SCHEDULER_DUPEFILTER_CLASS,
                  idle_before_close=0,
-                 serializer=None):
+                 serializer=None,
+                 batch_size=defaults.SCHEDULER_BATCH_SIZE,
+                 batch_interval=defaults.SCHEDULER_BATCH_INTERVAL,
+                 admission_async=defaults.SCHEDULER_ADMISSION_ASYNC,
+                 admission_buffer=defaults.SCHEDULER_ADMISSION_BUFFER):
         """Initialize scheduler.
 
         Parameters
@@ -60,6 +98,14 @@ class Scheduler(object):
             Importable path to the dupefilter class.
         idle_before_close : int
             Timeout before giving up.
+        batch_size : int
+            Requests buffered before a flush, 0 disables batching.
+        batch_interval : float
+            Seconds between timed flushes of a partial batch.
+        admission_async : bool
+            Whether dedup runs off the reactor thread.
+        admission_buffer : int
+            Buffered requests that pause the engine in async mode.
 
         """
         if idle_before_close < 0:
@@ -74,10 +120,24 @@ class Scheduler(object):
         self.dupefilter_key = dupefilter_key
         self.idle_before_close = idle_before_close
         self.serializer = serializer
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.admission_async = admission_async
+        self.admission_buffer = admission_buffer
+        self.pending = []  # requests waiting for the next flush
+        self.pending_since = None  # when the oldest pending request arrived
+        self.admitting = []  # requests whose dedup runs in a thread
+        self.accepted = []  # deduped requests not pushed yet
+        self._admission = None  # Deferred of the running admission
+        self._paused = False
+        self._flush_task = None
+        self._retry = None  # DelayedCall of the next admission retry
         self.stats = None
+        self.crawler = None
+        self.fingerprinter = None  # shared with the dupefilter, see from_crawler
 
     def __len__(self):
-        return len(self.queue)
+        return len(self.queue) + len(self.pending) + len(self.admitting) + len(self.accepted)
 
     @classmethod
     def from_settings(cls, settings):
@@ -85,6 +145,10 @@ class Scheduler(object):
             'persist': settings.getbool('SCHEDULER_PERSIST'),
             'flush_on_start': settings.getbool('SCHEDULER_FLUSH_ON_START'),
             'idle_before_close': settings.getint('SCHEDULER_IDLE_BEFORE_CLOSE'),
+            'batch_size': settings.getint('SCHEDULER_BATCH_SIZE', defaults.SCHEDULER_BATCH_SIZE),
+            'batch_interval': settings.getfloat('SCHEDULER_BATCH_INTERVAL', defaults.SCHEDULER_BATCH_INTERVAL),
+            'admission_async': settings.getbool('SCHEDULER_ADMISSION_ASYNC', defaults.SCHEDULER_ADMISSION_ASYNC),
+            'admission_buffer': settings.getint('SCHEDULER_ADMISSION_BUFFER', defaults.SCHEDULER_ADMISSION_BUFFER),
         }
 
         # If these values are missing, it means we want to use the defaults.
@@ -118,6 +182,9 @@ class Scheduler(object):
         instance = cls.from_settings(crawler.settings)
         # FIXME: for now, stats are only supported from this constructor
         instance.stats = crawler.stats
+        instance.crawler = crawler
+        # the dupefilter built in open() picks up the same instance
+        instance.fingerprinter = fingerprinter_from_crawler(crawler)
         return instance
 
     def open(self, spider):
@@ -138,19 +205,54 @@ class Scheduler(object):
 
         if self.flush_on_start:
             self.flush()
+        if self.batching and self.batch_interval > 0:
+            self._flush_task = task.LoopingCall(self.admit if self.admission_async else self.flush_pending)
+            self._flush_task.start(self.batch_interval, now=False)
         # notice if there are requests already in the queue to resume the crawl
         if len(self.queue):
             spider.log("Resuming crawl (%d requests scheduled)" % len(self.queue))
+        # the engine waits for a Deferred, e.g. a bitmap replica loading in a thread
+        return self.df.open()
+
+    @property
+    def batching(self):
+        return self.batch_size > 0 or self.admission_async
 
     def close(self, reason):
+        if self._flush_task is not None and self._flush_task.running:
+            self._flush_task.stop()
+        self._cancel_retry()
+        self.admission_async = False  # what is left is flushed synchronously
+        if self._admission is not None:
+            # let the running admission push its requests first
+            return self._admission.addBoth(lambda _: self._close(reason))
+        return self._close(reason)
+
+    def _close(self, reason):
+        self.flush_pending()
         if not self.persist:
             self.flush()
 
     def flush(self):
+        self.pending = []
+        self.pending_since = None
+        self.accepted = []
         self.df.clear()
         self.queue.clear()
 
     def enqueue_request(self, request):
+        if self.batching:
+            # Duplicates are only known at the next flush, request_dropped is sent there.
+            if not self.pending:
+                self.pending_since = time.time()
+            self.pending.append(request)
+            if self.admission_async:
+                if len(self.pending) >= self.batch_size:
+                    self.admit()
+                self._backpressure()
+            elif len(self.pending) >= self.batch_size:
+                self.flush_pending()
+            return True
         if not request.dont_filter and self.df.request_seen(request):
             self.df.log(request, self.spider)
             return False
@@ -159,9 +261,216 @@ class Scheduler(object):
         self.queue.push(request)
         return True
 
+    def flush_pending(self):
+        """Dedups and pushes the buffered requests with bulk calls.
+
+        Uses ``request_seen_many`` of the dupefilter and ``push_many`` of the
+        queue when they exist. Errors are logged and never raised, so the
+        flush timer keeps running: if the dedup fails, the requests not
+        recorded yet go back to the buffer; if the push fails, the deduped requests are kept and
+        pushed by the next flush. Returns the number of requests pushed.
+
+        """
+        requests, since = self.pending, self.pending_since
+        self.pending, self.pending_since = [], None
+        if requests:
+            seen = []
+            try:
+                self._seen(requests, seen)
+            except Exception:
+                self._requeue(requests[len(seen):], since)
+                logger.exception('Dedup of %(count)d requests failed, retrying on the next flush',
+                                 {'count': len(requests) - len(seen)}, extra={'spider': self.spider})
+                if self.stats:
+                    self.stats.inc_value('scheduler/flush/errors', spider=self.spider)
+            self._accept(requests[:len(seen)], seen)
+        return self._push_accepted()
+
+    def admit(self):
+        """Starts the dedup of the buffered requests in a thread.
+
+        At most one admission runs at a time; requests arriving meanwhile wait
+        for the next one. When the dupefilter answers, the surviving requests
+        are pushed from the reactor thread. If the dedup fails, the chunks
+        already recorded are accepted, only the other requests go back to the
+        buffer, and the admission is retried after ``admission_retry_delay``
+        even when the flush timer is off.
+
+        The whole ``request_seen_many`` call runs in the thread, including
+        fingerprinting, local caches and stats. The bundled dupefilters hold
+        their ``lock`` for that call and for ``forget``, and the fingerprinter
+        guards its cache, so the reactor can use them meanwhile. The thread
+        never touches the scheduler's buffers or the queue; a third-party
+        dupefilter used here must be safe to call from a thread.
+
+        Returns
+        -------
+        Deferred or None
+            The running admission, None when there was nothing to start.
+
+        """
+        if self.accepted:
+            self._push_accepted()
+        if self._admission is not None or not self.pending:
+            return None
+        self._cancel_retry()
+        requests, since = self.pending, self.pending_since
+        self.pending, self.pending_since, self.admitting = [], None, requests
+        started = time.time()
+        seen = []  # filled by the thread chunk by chunk, read once it is done
+        d = self._admission = deferToThread(self._seen, requests, seen)
+        d.addBoth(self._admitted, requests, seen, since, started)
+        d.addErrback(self._admission_error)
+        return d
+
+    def _admitted(self, result, requests, seen, since, started):
+        self._admission, self.admitting = None, []
+        failed = isinstance(result, Failure)
+        if failed:
+            self._requeue(requests[len(seen):], since)
+            logger.error('Admission of %(count)d requests failed, retrying: %(error)s',
+                         {'count': len(requests) - len(seen), 'error': result.getErrorMessage()},
+                         extra={'spider': self.spider})
+            if self.stats:
+                self.stats.inc_value('scheduler/admission/errors', spider=self.spider)
+        self._accept(requests[:len(seen)], seen)
+        pushed = self._push_accepted()
+        now = time.time()
+        if self.stats and not failed:
+            self.stats.set_value('scheduler/admission/latency', now - since, spider=self.spider)
+            self.stats.max_value('scheduler/admission/latency_max', now - since, spider=self.spider)
+            self.stats.set_value('scheduler/admission/dedup_time', now - started, spider=self.spider)
+        self._backpressure()
+        if failed:
+            self._schedule_retry()
+        elif self.admission_async and self.pending and (len(self.pending) >= self.batch_size or self._paused):
+            # a paused engine enqueues nothing and may not ask for requests, go on here
+            self.admit()
+        return pushed
+
+    def _admission_error(self, failure):
+        """Logs an error raised while handling an admission result."""
+        self._admission, self.admitting = None, []
+        logger.error('Error handling an admission result',
+                     exc_info=failure_to_exc_info(failure), extra={'spider': self.spider})
+        self._schedule_retry()
+
+    def _schedule_retry(self):
+        """Retries the admission later without relying on the flush timer."""
+        if not self.admission_async or (self._retry is not None and self._retry.active()):
+            return
+        from twisted.internet import reactor
+        self._retry = reactor.callLater(self.admission_retry_delay, self.admit)
+
+    def _cancel_retry(self):
+        if self._retry is not None and self._retry.active():
+            self._retry.cancel()
+        self._retry = None
+
+    def _backpressure(self):
+        """Pauses the engine while too many requests wait for admission."""
+        engine = getattr(self.crawler, 'engine', None)
+        if engine is None:
+            return
+        buffered = len(self.pending) + len(self.admitting)
+        if not self._paused and buffered >= self.admission_buffer:
+            self._paused = True
+            engine.pause()
+            if self.stats:
+                self.stats.inc_value('scheduler/admission/paused', spider=self.spider)
+        elif self._paused and buffered < self.admission_buffer // 2:
+            self._paused = False
+            engine.unpause()
+
+    def _seen(self, requests, seen):
+        """Appends to ``seen``, for each request, whether the dupefilter drops it.
+
+        Requests are checked ``dedup_chunk`` at a time and the answers of a
+        chunk are appended once the dupefilter has recorded it, so after an
+        error ``seen`` covers exactly the requests already marked; these must
+        not be checked again, they would all look like duplicates.
+
+        Runs in the admission thread, see ``admit``.
+
+        """
+        request_seen_many = getattr(self.df, 'request_seen_many', None)
+        if request_seen_many is None:
+            for request in requests[len(seen):]:
+                seen.append(not request.dont_filter and self.df.request_seen(request))
+            return seen
+        while len(seen) < len(requests):
+            chunk = requests[len(seen):len(seen) + self.dedup_chunk]
+            checked = [request for request in chunk if not request.dont_filter]
+            answers = iter(request_seen_many(checked) if checked else [])
+            seen.extend([not request.dont_filter and next(answers) for request in chunk])
+        return seen
+
+    def _requeue(self, requests, since):
+        """Puts requests back in front of the buffer."""
+        self.pending[:0] = requests
+        if since is not None and (self.pending_since is None or since < self.pending_since):
+            self.pending_since = since
+
+    def _accept(self, requests, seen):
+        """Drops the duplicates and keeps the other requests for the push.
+
+        Duplicates are logged and reported with the ``request_dropped``
+        signal, which the engine only sends when ``enqueue_request`` returns
+        False.
+
+        """
+        for request, dupe in zip(requests, seen):
+            if not dupe:
+                self.accepted.append(request)
+                continue
+            self.df.log(request, self.spider)
+            if self.crawler is not None:
+                self.crawler.signals.send_catch_log(signal=signals.request_dropped,
+                                                    request=request, spider=self.spider)
+
+    def _push_accepted(self):
+        """Pushes the deduped requests in bulk.
+
+        On error the requests stay in ``accepted`` for the next flush; their
+        fingerprints are already recorded, so deduping them again would drop
+        them. Returns the number of requests pushed.
+
+        """
+        accepted = self.accepted
+        if not accepted:
+            return 0
+        try:
+            push_many = getattr(self.queue, 'push_many', None)
+            if push_many is not None:
+                push_many(accepted)
+            else:
+                for request in accepted:
+                    self.queue.push(request)
+        except Exception:
+            logger.exception('Push of %(count)d requests failed, retrying on the next flush',
+                             {'count': len(accepted)}, extra={'spider': self.spider})
+            if self.stats:
+                self.stats.inc_value('scheduler/flush/errors', spider=self.spider)
+            return 0
+        self.accepted = []
+        if self.stats:
+            self.stats.inc_value('scheduler/enqueued/redis', len(accepted), spider=self.spider)
+            self.stats.inc_value('scheduler/batches', spider=self.spider)
+        return len(accepted)
+
     def next_request(self):
         block_pop_timeout = self.idle_before_close
-        request = self.queue.pop(block_pop_timeout)
+        if self.pending or self.admitting or self.accepted:
+            request = self.queue.pop(0)
+            if request is None:
+                if self.admission_async:
+                    # the engine asks again, the requests are pushed meanwhile
+                    self.admit()
+                else:
+                    self.flush_pending()
+                    request = self.queue.pop(block_pop_timeout)
+        else:
+            request = self.queue.pop(block_pop_timeout)
         if request and self.stats:
             self.stats.inc_value('scheduler/dequeued/redis', spider=self.spider)
         return request
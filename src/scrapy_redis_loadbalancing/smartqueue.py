@@ -1,18 +1,34 @@
-from collections import deque
+from collections import OrderedDict, deque
+import heapq
+import itertools
 import time
 import math
 import logging
+import random
 from twisted.internet import task
 from twisted.internet.threads import deferToThread
-from collections import Iterable
+try:
+    from collections.abc import Iterable
+except ImportError:  # PY2
+    from collections import Iterable
+from scrapy import signals
+from scrapy.utils.httpobj import urlparse_cached
 from scrapy.utils.reqser import request_to_dict, request_from_dict
-from . import picklecompat
+from . import defaults, picklecompat
+from .spill import SpillFile
 from .tools import Color
+from .utils import bytes_to_str
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def cluster_node():
+    """ 本节点在集群中的名字; recoder 会引入 reactor 和 kazoo, 所以用到时才导入 """
+    from .recoder import ClusterState
+    return ClusterState.uuid.urn
+
+
 class Base(object):
     """Per-spider base queue class"""
 
@@ -76,12 +92,26 @@ class Base(object):
 
 
 class RemoteQueue(Base):
-    """Per-spider FIFO queue"""
+    """Per-spider FIFO queue
+
+    批量原生的远程队列: 一次 push/pop 无论搬运多少任务都只有一次往返,
+    并且在服务器端原子执行, 节点中途崩溃不会丢失或重复任务.
+    """
+
+    # LRANGE + LTRIM 在脚本里一起执行, 要么整批取走, 要么一个都不取
+    POP_SCRIPT = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+end
+return items
+"""
 
     def __init__(self, *args, **kwargs):
         super(RemoteQueue, self).__init__(*args, **kwargs)
         self.pushDelay = None  # push 命令的访问延迟
         self.popDelay = None  # pop 命令的访问延迟
+        self._pop_script = self.server.register_script(self.POP_SCRIPT)
 
     @property
     def delay(self):
@@ -100,18 +130,20 @@ class RemoteQueue(Base):
         return self.server.llen(self.key)
 
     def push(self, requests):
-        """Push a request"""
+        """ 批量放入任务, 返回实际放入的数量 """
         if self.stats:  # 只要尝试放都会+1,不管有没有成功
             keypath = 'scheduler/enqueued/{clsname}'.format(clsname=self.__class__.__name__)
             self.stats.inc_value(keypath, spider=self.spider)
 
         assert isinstance(requests, Iterable), "RemoteQueue 必须提交一个可迭代的对象"
 
+        requests = list(requests)
+        datas = [self._encode_request(request) for request in requests]
+        if not datas:
+            return 0
+
         _start = time.perf_counter()
-        pipeline = self.server.pipeline()
-        for request in requests:
-            pipeline.lpush(self.key, self._encode_request(request))
-        result = pipeline.execute()
+        self._push(datas, requests)
         _end = time.perf_counter()
         _delay = _end - _start  # 计算延时
 
@@ -120,15 +152,13 @@ class RemoteQueue(Base):
         else:
             self.pushDelay = _delay
 
-        logger.info(Color.purple('push {} task to rqueue'.format(len(result))))
+        logger.info(Color.purple('push {} task to rqueue'.format(len(datas))))
+        return len(datas)
 
     def pop(self, timeout=0, amount=1):  # timeout 是为了兼容接口,未来要去掉的
-        """Pop a request"""
+        """ 批量弹出至多 amount 个任务, 返回实际取走的任务列表 """
         _start = time.perf_counter()
-        pipeline = self.server.pipeline()
-        for _ in range(int(amount)):
-            pipeline.lpop(self.key)
-        datas = pipeline.execute()
+        datas = self._pop(int(amount))
         _end = time.perf_counter()
         _delay = _end - _start
 
@@ -137,39 +167,639 @@ class RemoteQueue(Base):
         else:
             self.popDelay = _delay
 
-        result = [self._decode_request(data) for data in datas if data]
+        result = self._decode_popped(datas)
         if result:
             if self.stats:  # 增加计数器
                 keypath = 'scheduler/dequeued/{clsname}'.format(clsname=self.__class__.__name__)
                 self.stats.inc_value(keypath, spider=self.spider)
             logger.info(Color.purple('pop {} task from rqueue'.format(len(result))))
-            return result
+        return result
+
+    def _decode_popped(self, datas):
+        """ 把 _pop 的结果解码为任务列表 """
+        return [self._decode_request(data) for data in datas if data]
+
+    def _push(self, datas, requests):
+        """ 单条 LPUSH 携带全部任务, 原子执行 """
+        self.server.lpush(self.key, *datas)
+
+    def _pop(self, amount):
+        """ 原子地取出至多 amount 个编码后的任务 """
+        return self._pop_script(keys=[self.key], args=[amount])
+
+
+class RemotePriorityQueue(RemoteQueue):
+    """Per-spider priority queue using redis' sorted set
+
+    分数为 -priority, 所以分数最小的(优先级最高的)最先被取走.
+    """
+
+    # ZRANGE + ZREMRANGEBYRANK 在脚本里一起执行, 一次取走优先级最高的一批
+    POP_SCRIPT = """
+local items = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, #items - 1)
+end
+return items
+"""
+
+    def __len__(self):
+        """Return the length of the queue"""
+        return self.server.zcard(self.key)
+
+    def _push(self, datas, requests):
+        """ 单条 ZADD 携带全部任务, 原子执行 """
+        # We don't use zadd method as the order of arguments change depending on
+        # whether the class is Redis or StrictRedis, and the option of using
+        # kwargs only accepts strings, not bytes.
+        args = []
+        for request, data in zip(requests, datas):
+            args.extend((-request.priority, data))
+        self.server.execute_command('ZADD', self.key, *args)
+
+
+class ReliableRemoteQueue(RemoteQueue):
+    """ 带租约的远程队列: 取走的任务在确认(ack)之前仍保存在服务器上
+
+    每个节点的租约是一个哈希 <key>:lease:<节点名>, 租约 id -> 编码后的任务;
+    各节点的租约期限记录在有序集合 <key>:leases 中, 节点每轮负载均衡都会续约.
+    节点死亡(租约过期或 ZooKeeper 报告节点消失)后, 其租约内的任务被放回远程队列.
+    租约哈希的键名由脚本拼出, 所以只支持单个 Redis 实例.
+    """
+
+    LEASE_META = 'lease_id'  # 租约 id 记录在 request.meta 的这个键中
+
+    # 取出一批任务, 同时为每个任务登记租约并续约本节点
+    POP_SCRIPT = """
+redis.replicate_commands()
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items == 0 then
+    return items
+end
+redis.call('LTRIM', KEYS[1], #items, -1)
+local t = redis.call('TIME')
+redis.call('ZADD', KEYS[3], tonumber(t[1]) + tonumber(ARGV[3]), ARGV[2])
+local result = {}
+for i, item in ipairs(items) do
+    local id = redis.call('INCR', KEYS[4])
+    redis.call('HSET', KEYS[2], id, item)
+    result[#result + 1] = id
+    result[#result + 1] = item
+end
+return result
+"""
+
+    # 续约本节点; 期限和 POP_SCRIPT、REQUEUE_SCRIPT 一样用 Redis 的时钟, 不受各节点本地时钟偏差影响
+    RENEW_SCRIPT = """
+redis.replicate_commands()
+local t = redis.call('TIME')
+redis.call('ZADD', KEYS[1], tonumber(t[1]) + tonumber(ARGV[2]), ARGV[1])
+"""
+
+    # 把过期节点(或 ARGV[2] 指定的节点)租约内的任务放回远程队列
+    REQUEUE_SCRIPT = """
+redis.replicate_commands()
+local nodes
+if ARGV[2] ~= '' then
+    nodes = {ARGV[2]}
+else
+    local t = redis.call('TIME')
+    nodes = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', tonumber(t[1]))
+end
+local count = 0
+for _, node in ipairs(nodes) do
+    local lease = ARGV[1] .. node
+    local items = redis.call('HVALS', lease)
+    for i = 1, #items, 1000 do
+        redis.call('LPUSH', KEYS[1], unpack(items, i, math.min(i + 999, #items)))
+    end
+    count = count + #items
+    redis.call('DEL', lease)
+    redis.call('ZREM', KEYS[2], node)
+end
+return count
+"""
+
+    def __init__(self, *args, **kwargs):
+        self.timeout = kwargs.pop('timeout', defaults.SMARTQUEUE_LEASE_TIMEOUT)
+        self.node = kwargs.pop('node', None) or cluster_node()
+        super(ReliableRemoteQueue, self).__init__(*args, **kwargs)
+        self.lease_prefix = self.key + ':lease:'
+        self.lease_key = self.lease_prefix + self.node
+        self.leases_key = self.key + ':leases'
+        self.seq_key = self.key + ':lease:seq'
+        self._requeue_script = self.server.register_script(self.REQUEUE_SCRIPT)
+        self._renew_script = self.server.register_script(self.RENEW_SCRIPT)
+
+    def _push(self, datas, requests):
+        """ 放回远端的任务不再属于本节点, 在同一个事务里解除它们的租约 """
+        ids = [request.meta[self.LEASE_META] for request in requests if self.LEASE_META in request.meta]
+        pipeline = self.server.pipeline()
+        pipeline.lpush(self.key, *datas)
+        if ids:
+            pipeline.hdel(self.lease_key, *ids)
+        pipeline.execute()
+
+    def _pop(self, amount):
+        """ 返回 (租约 id, 编码后的任务) 列表 """
+        result = self._pop_script(keys=[self.key, self.lease_key, self.leases_key, self.seq_key],
+                                  args=[amount, self.node, self.timeout])
+        return list(zip(result[0::2], result[1::2]))
+
+    def _decode_popped(self, pairs):
+        """ 每个任务的租约 id 记录在 meta 中, 调度后需要 ack """
+        result = []
+        for lease_id, data in pairs:
+            request = self._decode_request(data)
+            request.meta[self.LEASE_META] = int(lease_id)
+            result.append(request)
+        return result
+
+    def ack(self, ids):
+        """ 确认一批任务已被调度, 解除租约 """
+        if ids:
+            self.server.hdel(self.lease_key, *ids)
+
+    def renew(self):
+        """ 续约: 本节点仍然存活 """
+        self._renew_script(keys=[self.leases_key], args=[self.node, self.timeout])
+
+    def requeue(self, node=None):
+        """ 把指定节点的租约任务放回远程队列; 不指定节点时处理所有已过期的租约. 返回放回的任务数 """
+        count = self._requeue_script(keys=[self.key, self.leases_key], args=[self.lease_prefix, node or ''])
+        if count:
+            logger.warning(Color.yellow('requeue {} leased task from {}'.format(count, node or 'expired nodes')))
+            if self.stats:
+                self.stats.inc_value('smartqueue/lease/requeued', count, spider=self.spider)
+        return count
+
+
+class InboxRemoteQueue(RemoteQueue):
+    """ 每个节点一个收件箱的远程队列
+
+    节点把多余的任务放进自己的收件箱 <key>:inbox:<节点名>, 也优先从自己的收件箱取回;
+    空闲节点从其他节点的收件箱中偷取任务. 各节点的负载发布在哈希 <key>:load 中, 用来挑选被偷的节点.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.node = kwargs.pop('node', None) or cluster_node()
+        super(InboxRemoteQueue, self).__init__(*args, **kwargs)
+        self.inbox_prefix = self.key + ':inbox:'
+        self.load_key = self.key + ':load'
+        self.inbox = self.inbox_prefix + self.node
+
+    def __len__(self):
+        """ 本节点收件箱的长度 """
+        return self.server.llen(self.inbox)
+
+    def _push(self, datas, requests):
+        self.server.lpush(self.inbox, *datas)
+
+    def _pop(self, amount):
+        return self._pop_script(keys=[self.inbox], args=[amount])
+
+    def steal(self, victim, amount):
+        """ 从 victim 节点的收件箱中原子地偷取至多 amount 个任务 """
+        datas = self._pop_script(keys=[self.inbox_prefix + victim], args=[int(amount)])
+        result = [self._decode_request(data) for data in datas if data]
+        if result:
+            if self.stats:
+                self.stats.inc_value('smartqueue/steal/count', spider=self.spider)
+                self.stats.inc_value('smartqueue/steal/requests', len(result), spider=self.spider)
+            logger.info(Color.purple('steal {} task from {}'.format(len(result), victim)))
+        return result
+
+    def publish(self, load):
+        """ 发布本节点的负载 """
+        self.server.hset(self.load_key, self.node, load)
+
+    def loads(self):
+        """ 返回 {节点名: 负载} """
+        return {bytes_to_str(node): float(load) for node, load in self.server.hgetall(self.load_key).items()}
+
+    def forget(self, node):
+        """ 节点已离开集群且收件箱已空, 不再把它当作偷取对象 """
+        self.server.hdel(self.load_key, node)
+
+
+class LocalQueue(object):
+    """ 本地队列: push/pop 都在左端(后进先出), 搬运时从右端(最早的任务)取出 """
+
+    def __init__(self):
+        self.queue = deque()
+
+    @classmethod
+    def from_smartqueue(cls, smartqueue):
+        return cls()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __iter__(self):
+        return iter(self.queue)
+
+    def push(self, request):
+        """ 放入一个任务 """
+        self.queue.appendleft(request)
+
+    def pop(self):
+        """ 弹出一个任务, 队列为空时返回 None """
+        try:
+            return self.queue.popleft()
+        except IndexError:
+            return None
+
+    def offload(self, amount):
+        """ 取出至多 amount 个最不急的任务, 用于上传到远端 """
+        requests = []
+        for _ in range(int(amount)):
+            try:
+                requests.append(self.queue.pop())
+            except IndexError:
+                break
+        return requests
+
+    def restore(self, requests):
+        """ 放回 offload 取出但没能上传的任务[顺序不变] """
+        self.queue.extend(reversed(requests))
+
+    def splice(self, requests):
+        """ 拼接从远端取回的任务 """
+        self.queue.extend(requests)
+
+
+class SpillLocalQueue(LocalQueue):
+    """ 内存有上限的本地队列: 超出 limit 的最早任务序列化后溢出到磁盘分段文件
+
+    内存中只保留最新的任务(队头), 更早的任务在磁盘上; 内存耗尽时再从磁盘成批读回.
+    上传到远端时优先取磁盘上的任务. limit 为 0 时不溢出, 与 LocalQueue 完全一样.
+    顺序: 内存中仍是后进先出; 磁盘文件只能从最早的记录读起, 所以读回的各批按从旧到新的顺序弹出,
+    只在每一批内部保持后进先出.
+    """
+
+    def __init__(self, encode=None, decode=None, limit=0, directory=None,
+                 segment_size=16 * 1024 * 1024, stats=None):
+        super(SpillLocalQueue, self).__init__()
+        self.encode = encode
+        self.decode = decode
+        self.limit = limit
+        self.low = limit * 3 // 4  # 溢出时一次降到 3/4, 避免每放一个任务就写一次盘
+        self.directory = directory
+        self.segment_size = segment_size
+        self.stats = stats
+        self.spill = None  # 首次溢出时才创建
+
+    @classmethod
+    def from_smartqueue(cls, smartqueue):
+        settings = smartqueue.settings
+        return cls(
+            encode=smartqueue.rqueue._encode_request,
+            decode=smartqueue.rqueue._decode_request,
+            limit=settings.getint('SMARTQUEUE_MEMORY_LIMIT', defaults.SMARTQUEUE_MEMORY_LIMIT),
+            directory=settings.get('SMARTQUEUE_SPILL_DIR', defaults.SMARTQUEUE_SPILL_DIR),
+            segment_size=settings.getint('SMARTQUEUE_SPILL_SEGMENT_SIZE', defaults.SMARTQUEUE_SPILL_SEGMENT_SIZE),
+            stats=smartqueue.stats,
+        )
+
+    def __len__(self):
+        return len(self.queue) + (len(self.spill) if self.spill else 0)
+
+    def __iter__(self):
+        return iter(self.queue)  # 只遍历内存中的任务
+
+    def push(self, request):
+        """ 放入一个任务 """
+        self.queue.appendleft(request)
+        self._check_memory()
+
+    def pop(self):
+        """ 弹出一个任务, 内存为空时先从磁盘读回一批, 队列为空时返回 None """
+        if not self.queue and self.spill:
+            # 读回的一批从旧到新, 放到左端后最新的先弹出, 右端仍是最早的任务
+            self.queue.extendleft(self._read_spill(max(self.limit // 2, 1)))
+        return super(SpillLocalQueue, self).pop()
+
+    def offload(self, amount):
+        """ 取出至多 amount 个任务用于上传, 先取磁盘上最早的任务 """
+        amount = int(amount)
+        requests = self._read_spill(amount) if self.spill else []
+        requests.extend(super(SpillLocalQueue, self).offload(amount - len(requests)))
+        return requests
+
+    def restore(self, requests):
+        """ 放回 offload 取出但没能上传的任务[顺序不变] """
+        super(SpillLocalQueue, self).restore(requests)
+        self._check_memory()
+
+    def splice(self, requests):
+        """ 拼接从远端取回的任务 """
+        super(SpillLocalQueue, self).splice(requests)
+        self._check_memory()
+
+    def _check_memory(self):
+        if self.limit and len(self.queue) > self.limit:
+            requests = [self.queue.pop() for _ in range(len(self.queue) - self.low)]
+            self._write_spill(requests)
+
+    def _write_spill(self, requests):
+        if self.spill is None:
+            self.spill = SpillFile(self.directory, self.segment_size)
+        _start = time.perf_counter()
+        written = self.spill.write([self.encode(request) for request in requests])
+        _delay = time.perf_counter() - _start
+        if self.stats:
+            self.stats.inc_value('smartqueue/spill/written', len(requests))
+            self.stats.inc_value('smartqueue/spill/written_bytes', written)
+            self.stats.set_value('smartqueue/spill/write_latency', _delay)
+            self._update_stats()
+
+    def _read_spill(self, amount):
+        _start = time.perf_counter()
+        requests = [self.decode(data) for data in self.spill.read(amount)]
+        _delay = time.perf_counter() - _start
+        if self.stats and requests:
+            self.stats.inc_value('smartqueue/spill/read', len(requests))
+            self.stats.set_value('smartqueue/spill/read_latency', _delay)
+            self._update_stats()
+        return requests
+
+    def _update_stats(self):
+        self.stats.set_value('smartqueue/spill/count', len(self.spill))
+        self.stats.set_value('smartqueue/spill/bytes', self.spill.bytes)
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+
+class LocalPriorityQueue(object):
+    """ 本地优先级队列: 最小堆, 元素为 (-priority, 序号, request), 同优先级按放入顺序弹出 """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+
+    @classmethod
+    def from_smartqueue(cls, smartqueue):
+        return cls()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __iter__(self):
+        return (request for _, _, request in sorted(self.heap))
+
+    def push(self, request):
+        """ 放入一个任务 """
+        heapq.heappush(self.heap, (-request.priority, next(self.counter), request))
+
+    def pop(self):
+        """ 弹出优先级最高的任务, 队列为空时返回 None """
+        if self.heap:
+            return heapq.heappop(self.heap)[2]
+
+    def offload(self, amount):
+        """ 取出至多 amount 个优先级最低的任务, 用于上传到远端 """
+        amount = int(amount)
+        if amount <= 0 or not self.heap:
+            return []
+        self.heap.sort()  # 有序列表本身就是合法的堆, 截掉尾部后依然是堆
+        entries = self.heap[-amount:]
+        del self.heap[-amount:]
+        return [request for _, _, request in entries]
+
+    def restore(self, requests):
+        """ 放回 offload 取出但没能上传的任务 """
+        self.splice(requests)
+
+    def splice(self, requests):
+        """ 拼接从远端取回的任务 """
+        for request in requests:
+            self.push(request)
+
+
+class LocalDomainQueue(object):
+    """ 本地分域队列: 每个下载槽(域名)一个子队列, 轮流弹出, 避免一个慢域名堵住队头
+
+    slot_available(key) 返回该下载槽是否还有空闲并发. 有任务的槽要么在就绪队列 ready 中轮询,
+    要么因为并发已满被挂起在 parked 中, 直到 release(key) (下载器空出该槽时调用) 把它放回就绪队列;
+    每次弹出只检查就绪队列的队头, 均摊 O(1), 与下载槽的数量无关. 全部挂起时按挂起顺序轮流弹出.
+    每个子队列的顺序与 LocalQueue 相同.
+    """
+
+    def __init__(self, slot_available=None):
+        self.queues = {}  # 下载槽 -> 子队列
+        self.ready = deque()  # 可能还有空闲并发的槽, 轮询顺序
+        self.parked = OrderedDict()  # 并发已满的槽, 按挂起顺序
+        self.slot_available = slot_available
+        self.length = 0
+
+    @classmethod
+    def from_smartqueue(cls, smartqueue):
+        return cls(slot_available=getattr(smartqueue, 'slot_available', None))
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for key in list(self.ready) + list(self.parked):
+            for request in self.queues[key]:
+                yield request
+
+    @staticmethod
+    def slot_key(request):
+        """ 与 scrapy 下载器相同的下载槽划分方式 """
+        return request.meta.get('download_slot') or urlparse_cached(request).hostname or ''
+
+    def _queue(self, key):
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+            self.ready.append(key)
+        return queue
+
+    def _discard(self, key):
+        del self.queues[key]
+        if key in self.parked:
+            del self.parked[key]
+        elif self.ready[-1] == key:  # 刚弹出过的槽在队尾
+            self.ready.pop()
+        else:
+            self.ready.remove(key)
+
+    def release(self, key):
+        """ 下载槽空出了并发, 挂起的槽回到就绪队列 """
+        if key in self.parked:
+            del self.parked[key]
+            self.ready.append(key)
+
+    def push(self, request):
+        """ 放入一个任务 """
+        self._queue(self.slot_key(request)).appendleft(request)
+        self.length += 1
+
+    def pop(self):
+        """ 轮流从各下载槽弹出一个任务, 优先选择还有空闲并发的槽, 队列为空时返回 None """
+        while self.ready:
+            key = self.ready[0]
+            if self.slot_available is None or self.slot_available(key):
+                self.ready.rotate(-1)  # 轮到过的槽排到最后
+                return self._take(key)
+            self.ready.popleft()
+            self.parked[key] = None
+        if not self.parked:
+            return None
+        key = next(iter(self.parked))
+        del self.parked[key]
+        self.parked[key] = None
+        return self._take(key)
+
+    def _take(self, key):
+        queue = self.queues[key]
+        request = queue.popleft()
+        self.length -= 1
+        if not queue:
+            self._discard(key)
+        return request
+
+    def offload(self, amount):
+        """ 取出至多 amount 个任务用于上传, 总是从积压最多的下载槽取, 把各槽削平 """
+        amount = int(amount)
+        if amount <= 0 or not self.length:
+            return []
+        heap = [(-len(queue), key) for key, queue in self.queues.items()]
+        heapq.heapify(heap)
+        requests = []
+        while heap and len(requests) < amount:
+            size, key = heapq.heappop(heap)
+            queue = self.queues[key]
+            requests.append(queue.pop())  # 同一个槽内取最早的任务
+            if queue:
+                heapq.heappush(heap, (size + 1, key))
+            else:
+                self._discard(key)
+        self.length -= len(requests)
+        return requests
+
+    def restore(self, requests):
+        """ 放回 offload 取出但没能上传的任务[各槽内顺序不变] """
+        for request in reversed(requests):
+            self._queue(self.slot_key(request)).append(request)
+        self.length += len(requests)
+
+    def splice(self, requests):
+        """ 拼接从远端取回的任务, 按下载槽分别附加 """
+        for request in requests:
+            self._queue(self.slot_key(request)).append(request)
+        self.length += len(requests)
+
+
+class BalanceController(object):
+    """ 根据实测延迟、本地消耗速度与积压量, 决定负载均衡的周期与每次搬运的任务量
+
+    延迟大的节点: 周期长、批量大、次数少; 局域网节点: 周期短、批量小、次数多.
+    每次只向目标值靠近 damping 的比例, 避免来回振荡.
+    """
+
+    def __init__(self, interval=defaults.SMARTQUEUE_INTERVAL,
+                 interval_min=defaults.SMARTQUEUE_INTERVAL_MIN,
+                 interval_max=defaults.SMARTQUEUE_INTERVAL_MAX,
+                 batch_size=defaults.SMARTQUEUE_BATCH_SIZE,
+                 batch_min=defaults.SMARTQUEUE_BATCH_MIN,
+                 batch_max=defaults.SMARTQUEUE_BATCH_MAX,
+                 rtt_multiplier=defaults.SMARTQUEUE_RTT_MULTIPLIER,
+                 damping=defaults.SMARTQUEUE_DAMPING):
+        self.interval_min = interval_min
+        self.interval_max = interval_max
+        self.batch_min = batch_min
+        self.batch_max = batch_max
+        self.rtt_multiplier = rtt_multiplier
+        self.damping = damping
+        self.interval = self._clamp(interval, interval_min, interval_max)
+        self.batch_size = float(self._clamp(batch_size, batch_min, batch_max))
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            interval=settings.getfloat('SMARTQUEUE_INTERVAL', defaults.SMARTQUEUE_INTERVAL),
+            interval_min=settings.getfloat('SMARTQUEUE_INTERVAL_MIN', defaults.SMARTQUEUE_INTERVAL_MIN),
+            interval_max=settings.getfloat('SMARTQUEUE_INTERVAL_MAX', defaults.SMARTQUEUE_INTERVAL_MAX),
+            batch_size=settings.getint('SMARTQUEUE_BATCH_SIZE', defaults.SMARTQUEUE_BATCH_SIZE),
+            batch_min=settings.getint('SMARTQUEUE_BATCH_MIN', defaults.SMARTQUEUE_BATCH_MIN),
+            batch_max=settings.getint('SMARTQUEUE_BATCH_MAX', defaults.SMARTQUEUE_BATCH_MAX),
+            rtt_multiplier=settings.getfloat('SMARTQUEUE_RTT_MULTIPLIER', defaults.SMARTQUEUE_RTT_MULTIPLIER),
+            damping=settings.getfloat('SMARTQUEUE_DAMPING', defaults.SMARTQUEUE_DAMPING),
+        )
+
+    @staticmethod
+    def _clamp(value, lower, upper):
+        return max(lower, min(upper, value))
+
+    def update(self, rtt, drain_rate, backlog):
+        """ 输入实测往返延迟(秒, 未知为 None)、本地消耗速度(个/秒)、待搬运量, 返回 (周期, 批量) """
+        if rtt is not None:
+            target = self._clamp(rtt * self.rtt_multiplier, self.interval_min, self.interval_max)
+            self.interval += self.damping * (target - self.interval)
+        # 一个周期内本地要消耗的任务量, 且不必超过当前真正需要搬运的量
+        target = drain_rate * self.interval if drain_rate else self.batch_min
+        target = self._clamp(min(target, math.fabs(backlog) or target), self.batch_min, self.batch_max)
+        self.batch_size += self.damping * (target - self.batch_size)
+        if math.fabs(target - self.batch_size) < 1:  # 按比例靠近永远到不了目标, 差距不到 1 个时直接取目标值
+            self.batch_size = target
+        return self.interval, int(round(self.batch_size))
 
 
 class SmartQueue(object):
+    """ 本地队列 + 远程队列 的双层任务队列
+
+    本地队列只允许在 reactor 线程中修改; 负载均衡时由 reactor 线程决定搬运计划并取出待上传的任务,
+    线程池只负责与 Redis 之间的网络 I/O, 结果再回到 reactor 线程一次性拼接进本地队列.
+    """
+
+    local_queue_cls = SpillLocalQueue
+    remote_queue_cls = RemoteQueue
 
     def __init__(self, server, spider, key, serializer=None):
-        self.lqueue = deque()  # 本地队列
-        self.rqueue = RemoteQueue(server, spider, key, serializer)  # 远程队列
+        self.spider = spider
         self.stats = spider.crawler.stats
         self.settings = spider.crawler.settings
+        self.rqueue = self.remote_queue_cls(server, spider, key, serializer, **self.remote_queue_kwargs)  # 远程队列
+        self.lqueue = self.make_local_queue()  # 本地队列
+        self.rlength = 0  # 远程队列长度, 由线程池在每次搬运后带回, reactor 线程只读这个缓存值
         self.task = None
-        self.interval = 2
+        self.inflight = None  # 正在进行中的搬运, 同一时间只有一个
+        self.prefetch = self.settings.getbool('SMARTQUEUE_PREFETCH', defaults.SMARTQUEUE_PREFETCH)
+        self.prefetch_factor = self.settings.getfloat('SMARTQUEUE_PREFETCH_FACTOR', defaults.SMARTQUEUE_PREFETCH_FACTOR)
+        self.controller = BalanceController.from_settings(self.settings)
+        self.interval = self.controller.interval
+        self.batch_size = int(self.controller.batch_size)
         self.__install_list()
 
+    @property
+    def remote_queue_kwargs(self):
+        """ 创建远程队列时的额外参数 """
+        return {}
+
+    def make_local_queue(self):
+        """ 创建本地队列 """
+        return self.local_queue_cls.from_smartqueue(self)
+
     def __install_list(self):
         logger.info(Color.violet('install load_balacing compenont'))
-        self.task = task.LoopingCall(self.thread_auto_balacing)  # 定期调用 load_balacing, 利用线程方式
-#        self.task = task.LoopingCall(self.auto_balacing)  # 定期调用 load_balacing
+        # auto_balacing 返回 Deferred, LoopingCall 会等它结束才安排下一轮, 所以搬运不会重叠
+        self.task = task.LoopingCall(self.auto_balacing)  # 定期调用 load_balacing
         self.task.start(self.interval)
 
     def __del__(self):
         if self.task and self.task.running:
             self.task.stop()
+        if hasattr(self.lqueue, 'close'):
+            self.lqueue.close()
 
     @property
     def remoteload(self):
-        return len(self.rqueue) / (
+        return self.rlength / (
                 self.settings.getfloat("CONCURRENT_REQUESTS") * (self.stats.get_value('COUNT_OF_HOSTS') or 1))
 
     @property
@@ -180,37 +810,82 @@ class SmartQueue(object):
         else:
             return 0
 
-    def tranfer(self, amount):
-        """ 开始转移 - amount:正数为 lqueue->rqueue,负数为 rqueue->lqueue """
-        limit = 200
+    def tranfer(self, amount, limit=None):
+        """ 开始转移 - amount:正数为 lqueue->rqueue,负数为 rqueue->lqueue; limit:单次搬运的上限, 默认为 batch_size
+
+        在 reactor 线程中调用, 返回 Deferred; 网络 I/O 在线程池中完成.
+        """
+        if self.inflight is not None:  # 预取或上一轮搬运还没结束
+            return self.inflight
+        limit = limit or self.batch_size
         amount = amount if math.fabs(amount) < limit else limit * amount / math.fabs(amount)
-        requests = []
         logger.info(Color.cyan('tranfer:{}'.format(amount)))
-        if amount > 0:
-            try:
-                for _ in range(int(amount)):  # 将 amount 任务装入 requests 中
-                    request = self.lqueue.pop()
-                    requests.append(request)
-            except IndexError:
-                if requests:
-                    self.lqueue.extendleft(requests)  # 如果出错还是放到本地[顺序不变]
-            else:
-                if requests:
-                    self.rqueue.push(requests)  # 没有出错就放到远端
-        elif amount < 0:
+        outgoing = self.lqueue.offload(amount) if amount > 0 else []  # 在 reactor 线程中取出待上传的任务
+        pull = int(math.fabs(amount)) if amount < 0 else 0
+        d = deferToThread(self._exchange, outgoing, pull, *self.exchange_args(outgoing))
+        d.addCallback(self._splice)
+        d.addErrback(self._exchange_failed, outgoing)
+        d.addBoth(self._exchange_done)
+        self.inflight = d
+        return d
+
+    def _exchange_done(self, _):
+        self.inflight = None
+
+    def exchange_args(self, outgoing):
+        """ 在 reactor 线程中准备 _exchange 需要的其他参数, 线程池不读取会被 reactor 修改的状态 """
+        return ()
+
+    @property
+    def watermark(self):
+        """ 低水位: 一次往返期间本地会消耗的任务量 * 倍数, 至少为 1 """
+        tps = self.stats.get_value('tps_page', None) or 0
+        return max(tps * self.rqueue.delay * self.prefetch_factor, 1)
+
+    def check_prefetch(self):
+        """ 本地任务低于低水位且远端还有任务时, 立即开始异步取回一批(双缓冲), 不等下一轮负载均衡 """
+        if not self.prefetch or self.inflight is not None or self.rlength <= 0:
+            return
+        if len(self.lqueue) < self.watermark:
+            amount = max(self.batch_size, int(self.watermark) * 2)
+            if self.stats:
+                self.stats.inc_value('smartqueue/prefetch/count')
+            # 预取量由水位决定, 不受当前 batch_size 限制, 只以 batch_max 为上限
+            self.tranfer(-amount, limit=self.controller.batch_max)
+
+    def _exchange(self, outgoing, pull):
+        """ 在线程池中执行: 只做网络 I/O, 不碰本地队列 """
+        returned, pulled, rlength = [], [], None
+        if outgoing:
             try:
-                requests = self.rqueue.pop(amount=int(math.fabs(amount)))
+                self.rqueue.push(outgoing)  # 整批原子写入远端
             except Exception:
-                if requests:
-                    self.rqueue.push(requests)  # 如果错了什么问题,就把任务放回去
-                raise  # 继续抛出错误
-            finally:
-                if requests:
-                    self.lqueue.extend(requests)  # 附加到本地队列去
-
-    def thread_auto_balacing(self):
-        deferToThread(self.auto_balacing)
-    
+                logger.exception(Color.red('push to rqueue failed, keep {} task local'.format(len(outgoing))))
+                returned = outgoing  # 写入失败就交还给 reactor 线程放回本地
+        try:
+            if pull:
+                pulled = self.rqueue.pop(amount=pull)  # 整批原子取出, 失败则远端不变
+            rlength = len(self.rqueue)
+        except Exception:
+            logger.exception(Color.red('pop from rqueue failed'))
+        return returned, pulled, rlength
+
+    def _splice(self, result):
+        """ 回到 reactor 线程: 把线程池带回的结果一次性拼接进本地队列 """
+        returned, pulled, rlength = result
+        if returned:
+            self.lqueue.restore(returned)  # 原样放回本地
+        if pulled:
+            self.lqueue.splice(pulled)  # 附加到本地队列去
+        if rlength is not None:
+            self.rlength = rlength
+
+    def _exchange_failed(self, failure, outgoing):
+        """ 线程池里出现意外错误: 把取出的任务放回本地, 不让 LoopingCall 因异常停止 """
+        logger.error(Color.red('load balacing failed: {}'.format(failure.getErrorMessage())))
+        if outgoing:
+            self.lqueue.restore(outgoing)
+
     def auto_balacing(self):
         restrain = self.stats.get_value('COUNT_OF_HOSTS', 1)  # 约束范围
         remote_tps = self.settings.getfloat("CONCURRENT_REQUESTS")  # 远端吞吐量
@@ -227,21 +902,34 @@ class SmartQueue(object):
         if restrain > 1:
             remote_tps = local_tps * (restrain - 1) + remote_tps
         amount = local_tps * remote_tps * k / (local_tps + remote_tps)
-        self.tranfer(amount)
+        self.adjust(amount)
+        return self.tranfer(amount)
+
+    def adjust(self, backlog):
+        """ 由 BalanceController 决定本轮的搬运量与下一轮的周期, 并记录到 stats """
+        measured = self.rqueue.pushDelay is not None or self.rqueue.popDelay is not None
+        rtt = self.rqueue.delay if measured else None
+        drain_rate = self.stats.get_value('tps_page', None)
+        self.interval, self.batch_size = self.controller.update(rtt, drain_rate, backlog)
+        if self.task is not None:
+            self.task.interval = self.interval  # LoopingCall 每次安排下一轮时都会读取 interval
+        if self.stats:
+            self.stats.set_value('smartqueue/interval', self.interval)
+            self.stats.set_value('smartqueue/batch_size', self.batch_size)
+            if rtt is not None:
+                self.stats.set_value('smartqueue/rtt', rtt)
 
     def push(self, request):
         """ 放入一个任务 """
-        self.lqueue.appendleft(request)
+        self.lqueue.push(request)
 
     def pop(self, timeout=0):
         """ 弹出一个任务 """
-        task = None
-        try:
-            task = self.lqueue.popleft()
-        except IndexError:
-            pass
-        finally:
-            return task
+        request = self.lqueue.pop()
+        self.check_prefetch()
+        if request is None and self.inflight is not None and self.stats:
+            self.stats.inc_value('smartqueue/prefetch/starved')  # 本地已空, 只能等待搬运结束
+        return request
 
     def clear(self):
         """Clear queue/stack"""
@@ -250,3 +938,171 @@ class SmartQueue(object):
     def __len__(self):
         """ 队列长度 """
         return len(self.lqueue)
+
+
+class PrioritySmartQueue(SmartQueue):
+    """ 保留优先级的双层任务队列: 本地为堆, 远端为有序集合
+
+    负载均衡时上传本地优先级最低的任务, 取回远端优先级最高的任务.
+    """
+
+    local_queue_cls = LocalPriorityQueue
+    remote_queue_cls = RemotePriorityQueue
+
+
+class DomainSmartQueue(SmartQueue):
+    """ 本地按下载槽分队列的双层任务队列
+
+    弹出时跳过并发已满的下载槽, 让 CONCURRENT_REQUESTS 个并发尽量都忙起来;
+    负载均衡时优先上传积压最多的下载槽的任务.
+    """
+
+    local_queue_cls = LocalDomainQueue
+
+    def __init__(self, server, spider, key, serializer=None):
+        super(DomainSmartQueue, self).__init__(server, spider, key, serializer)
+        spider.crawler.signals.connect(self.request_left_downloader, signal=signals.request_left_downloader)
+
+    def request_left_downloader(self, request, spider):
+        """ 请求离开下载器, 它的下载槽又有了空闲并发 """
+        self.lqueue.release(self.lqueue.slot_key(request))
+
+    def slot_available(self, key):
+        """ 下载器中该槽的活跃请求数是否还没到并发上限 """
+        engine = getattr(self.spider.crawler, 'engine', None)
+        downloader = getattr(engine, 'downloader', None)
+        slot = downloader.slots.get(key) if downloader is not None else None
+        if slot is None:  # 还没有建立的槽, 必然空闲
+            return True
+        return len(slot.active) < slot.concurrency
+
+
+class ReliableSmartQueue(SmartQueue):
+    """ 不会因节点死亡而丢失任务的双层任务队列
+
+    从远端取回的任务带有租约, 被调度(pop)后才确认; 节点死亡时其租约内的任务会被其他节点放回远程队列.
+    """
+
+    remote_queue_cls = ReliableRemoteQueue
+
+    def __init__(self, server, spider, key, serializer=None):
+        self.acks = []  # 已调度、待确认的租约 id, 只在 reactor 线程中追加
+        self.acking = []  # 本轮交给线程池确认的租约 id
+        super(ReliableSmartQueue, self).__init__(server, spider, key, serializer)
+        from .recoder import node_departed  # 见 cluster_node
+        spider.crawler.signals.connect(self.node_departed, signal=node_departed)
+
+    @property
+    def remote_queue_kwargs(self):
+        return {'timeout': self.settings.getint('SMARTQUEUE_LEASE_TIMEOUT', defaults.SMARTQUEUE_LEASE_TIMEOUT)}
+
+    def tranfer(self, amount, limit=None):
+        if self.inflight is not None:
+            return self.inflight
+        self.acking, self.acks = self.acks, []
+        return super(ReliableSmartQueue, self).tranfer(amount, limit)
+
+    def _exchange(self, outgoing, pull):
+        """ 除了搬运, 还要确认已调度的任务、续约本节点、回收过期节点的任务; 结果末尾附带本轮是否确认成功 """
+        acked = False
+        try:
+            self.rqueue.ack(self.acking)
+            acked = True
+            self.rqueue.renew()
+            self.rqueue.requeue()
+        except Exception:
+            logger.exception(Color.red('lease maintenance failed'))
+        return super(ReliableSmartQueue, self)._exchange(outgoing, pull) + (acked,)
+
+    def _splice(self, result):
+        """ 确认失败的租约 id 放回 acks, 下一轮再确认 (HDEL 重复执行无害) """
+        if not result[-1]:
+            self._restore_acks()
+        self.acking = []
+        super(ReliableSmartQueue, self)._splice(result[:-1])
+
+    def _exchange_failed(self, failure, outgoing):
+        self._restore_acks()
+        super(ReliableSmartQueue, self)._exchange_failed(failure, outgoing)
+
+    def _restore_acks(self):
+        self.acks[:0] = self.acking
+        self.acking = []
+
+    def node_departed(self, nodes):
+        """ ZooKeeper 报告有节点离开集群: 立即回收它们的租约 """
+        for node in nodes:
+            deferToThread(self.rqueue.requeue, node.urn).addErrback(
+                lambda failure: logger.error(Color.red('requeue failed: {}'.format(failure.getErrorMessage()))))
+
+    def pop(self, timeout=0):
+        """ 弹出一个任务, 若带有租约则记下待确认 """
+        request = super(ReliableSmartQueue, self).pop(timeout)
+        if request is not None:
+            lease_id = request.meta.pop(ReliableRemoteQueue.LEASE_META, None)
+            if lease_id is not None:
+                self.acks.append(lease_id)
+        return request
+
+
+class StealingSmartQueue(SmartQueue):
+    """ 基于工作窃取的双层任务队列
+
+    本地任务超过 4 个周期的消耗量时, 多出的部分放进自己的收件箱;
+    不足 2 个周期的消耗量时, 先取回自己收件箱中的任务, 仍然不够就用 "二选一" 的方式挑一个
+    负载更高的节点, 直接从它的收件箱中偷取. Redis 的流量只随负载不均的程度增长.
+    """
+
+    remote_queue_cls = InboxRemoteQueue
+
+    def auto_balacing(self):
+        tps = self.stats.get_value('tps_page', None) or self.settings.getfloat("CONCURRENT_REQUESTS")
+        low, high = tps * self.interval * 2, tps * self.interval * 4
+        length = len(self.lqueue)
+        if length > high:
+            amount = length - high
+        elif length < low:
+            amount = length - low
+        else:
+            amount = 0
+        self.adjust(amount)
+        return self.tranfer(amount)
+
+    @property
+    def load(self):
+        """ 本节点的负载: SlotStats 统计的本地负载, 再加上收件箱中的积压 """
+        tps = self.stats.get_value('tps_page', None)
+        localload = self.stats.get_value('localload', None)
+        if localload is None:
+            localload = self.localload
+        return localload + (self.rlength / tps if tps else 0)
+
+    def choose_victim(self, loads):
+        """ 二选一: 在负载比自己高的节点中随机抽两个, 选负载更高的那个 """
+        mine = loads.pop(self.rqueue.node, 0)
+        candidates = [node for node, load in loads.items() if load > mine]
+        if not candidates:
+            return None
+        return max(random.sample(candidates, min(2, len(candidates))), key=loads.get)
+
+    def exchange_args(self, outgoing):
+        """ 要发布的负载在 reactor 线程中算好; 本轮上传的任务算作收件箱中的积压 """
+        tps = self.stats.get_value('tps_page', None)
+        return (self.load + (len(outgoing) / tps if tps else 0),)
+
+    def _exchange(self, outgoing, pull, load):
+        returned, pulled, rlength = super(StealingSmartQueue, self)._exchange(outgoing, pull)
+        try:
+            wanted = pull - len(pulled)
+            if pull and wanted > 0:  # 自己的收件箱不够, 去偷
+                victim = self.choose_victim(self.rqueue.loads())
+                if victim is not None:
+                    stolen = self.rqueue.steal(victim, wanted)
+                    pulled = pulled + stolen
+                    from .recoder import ClusterState
+                    if not stolen and ClusterState.hosts and victim not in {host.urn for host in ClusterState.hosts}:
+                        self.rqueue.forget(victim)
+            self.rqueue.publish(load)
+        except Exception:
+            logger.exception(Color.red('work stealing failed'))
+        return returned, pulled, rlength
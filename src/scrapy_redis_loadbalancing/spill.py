@@ -0,0 +1,113 @@
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from collections import deque
+
+_HEADER = struct.Struct('>I')  # 每条记录前面是 4 字节的长度
+
+
+class SpillFile(object):
+    """ 分段的、只追加的磁盘溢出文件
+
+    每个分段是一串 "4 字节长度 + 序列化数据" 的记录, 写满 segment_size 字节后换下一个分段.
+    读取总是从最早的分段开始, 整段用 mmap 映射后顺序解析, 读完即删除, 因此先写入的记录先读出.
+    """
+
+    def __init__(self, directory=None, segment_size=16 * 1024 * 1024):
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = tempfile.mkdtemp(prefix='smartqueue-', dir=directory)
+        self.segment_size = segment_size
+        self.segments = deque()  # 每个元素为 [路径, 剩余记录数, 剩余字节数], 从旧到新
+        self.serial = 0
+        self.writer = None  # 最新分段的写句柄, 被读取前会先封存
+        self.written = 0  # 最新分段已写入的字节数
+        self.reader = None  # 最早分段的 (文件, mmap)
+        self.offset = 0  # 最早分段的读取位置
+        self.count = 0  # 磁盘上的记录数
+        self.bytes = 0  # 磁盘上的字节数
+
+    def __len__(self):
+        return self.count
+
+    def write(self, datas):
+        """ 追加一批序列化后的记录, 返回写入的字节数 """
+        total = 0
+        for data in datas:
+            if self.writer is None or self.written >= self.segment_size:
+                self._rotate()
+            record = _HEADER.pack(len(data)) + data
+            self.writer.write(record)
+            self.written += len(record)
+            segment = self.segments[-1]
+            segment[1] += 1
+            segment[2] += len(record)
+            total += len(record)
+        if self.writer is not None:
+            self.writer.flush()
+        self.count += len(datas)
+        self.bytes += total
+        return total
+
+    def read(self, amount):
+        """ 按写入顺序读出至多 amount 条记录, 读完的分段会被删除 """
+        datas = []
+        while len(datas) < amount and self.segments:
+            if self.reader is None:
+                self._open_oldest()
+            _, buf = self.reader
+            segment = self.segments[0]
+            while len(datas) < amount and segment[1]:
+                size, = _HEADER.unpack_from(buf, self.offset)
+                start = self.offset + _HEADER.size
+                datas.append(buf[start:start + size])
+                self.offset = start + size
+                segment[1] -= 1
+                segment[2] -= _HEADER.size + size
+                self.count -= 1
+                self.bytes -= _HEADER.size + size
+            if not segment[1]:
+                self._drop_oldest()
+        return datas
+
+    def _rotate(self):
+        """ 封存当前分段, 开始写一个新分段 """
+        if self.writer is not None:
+            self.writer.close()
+        self.serial += 1
+        path = os.path.join(self.directory, '{:08d}.spill'.format(self.serial))
+        self.writer = open(path, 'ab')
+        self.written = 0
+        self.segments.append([path, 0, 0])
+
+    def _open_oldest(self):
+        path = self.segments[0][0]
+        if len(self.segments) == 1 and self.writer is not None:  # 要读的是正在写的分段: 先封存
+            self.writer.close()
+            self.writer = None
+        fp = open(path, 'rb')
+        self.reader = (fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
+        self.offset = 0
+
+    def _drop_oldest(self):
+        fp, buf = self.reader
+        buf.close()
+        fp.close()
+        self.reader = None
+        os.remove(self.segments.popleft()[0])
+
+    def close(self):
+        """ 删除全部分段 """
+        if self.reader is not None:
+            fp, buf = self.reader
+            buf.close()
+            fp.close()
+            self.reader = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.segments.clear()
+        self.count = self.bytes = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
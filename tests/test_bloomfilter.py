@@ -0,0 +1,420 @@
+import hashlib
+import os
+import time as real_time
+
+import mock
+import pytest
+import redis
+
+from scrapy.http import Request
+
+from scrapy_redis_loadbalancing.bloomfilter import (
+    BloomFilter, FingerprintCache, ReplicatedBloomFilter, RotatingBloomFilter, ScalableBloomFilter, ShardedBloomFilter,
+    SimpleHash,
+)
+from scrapy_redis_loadbalancing.dupefilterbloom import BloomDupeFilter
+
+
+# allow test settings from environment
+REDIS_HOST = os.environ.get('REDIST_HOST', 'localhost')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+
+
+def fingerprint(value):
+    return hashlib.sha1(value.encode()).hexdigest()
+
+
+class TestOffsets(object):
+
+    def test_double_hashing(self):
+        bf = BloomFilter(server=None)
+        offsets = bf.offsets(fingerprint('http://example.com'))
+        assert len(offsets) == len(bf.seeds)
+        assert len(set(offsets)) == len(offsets)
+        assert all(0 <= loc < bf.bit_size for loc in offsets)
+        assert offsets == bf.offsets(fingerprint('http://example.com'))
+        assert offsets != bf.offsets(fingerprint('http://example.org'))
+
+    def test_legacy_matches_simplehash(self):
+        bf = BloomFilter(server=None, hash_mode='legacy')
+        fp = fingerprint('http://example.com')
+        assert bf.offsets(fp) == [SimpleHash(1 << 31, seed).hash(fp) for seed in bf.seeds]
+
+    def test_invalid_mode(self):
+        with pytest.raises(ValueError):
+            BloomFilter(server=None, hash_mode='foo')
+
+
+class TestFingerprintCache(object):
+
+    def test_existent(self):
+        cache = FingerprintCache(10)
+        fp = fingerprint('http://example.com')
+        assert not cache.existent(fp)
+        assert cache.existent(fp)
+        assert (cache.hits, cache.misses, len(cache)) == (1, 1, 1)
+
+    def test_contains_and_add(self):
+        cache = FingerprintCache(10)
+        fp = fingerprint('http://example.com')
+        assert not cache.contains(fp)
+        assert len(cache) == 0
+        cache.add(fp)
+        cache.add(fp)
+        assert cache.contains(fp)
+        assert len(cache) == 1
+
+    def test_clock_eviction(self):
+        cache = FingerprintCache(8)
+        assert cache.sets == 1
+        fps = [fingerprint('http://example.com/%s' % i) for i in range(10)]
+        for fp in fps[:8]:
+            cache.existent(fp)
+        cache.existent(fps[0])  # referenced, survives the next eviction
+        assert not cache.existent(fps[8])
+        assert cache.evictions == 1 and len(cache) == 8
+        assert cache.existent(fps[0])
+        assert cache.existent(fps[8])
+        assert not cache.existent(fps[1])  # evicted
+
+    def test_bounded(self):
+        cache = FingerprintCache(500)
+        assert cache.contain == 504
+        fps = [fingerprint('http://example.com/%s' % i) for i in range(5000)]
+        for fp in fps:
+            cache.existent(fp)
+        assert len(cache) <= 504
+        assert cache.misses == 5000
+        assert cache.evictions == 5000 - len(cache)
+        assert all(cache.existent(fp) for fp in fps[-50:])
+
+    def test_from_memory(self):
+        cache = FingerprintCache.from_memory(1 << 20)
+        assert len(cache.keys) * 9 + len(cache.hands) <= 1 << 20
+        assert cache.contain > 100000
+
+
+class TestSizing(object):
+
+    def test_optimal_size(self):
+        bf = BloomFilter(server=None, capacity=1000000, error_rate=0.01)
+        assert bf.hash_count == 7
+        assert bf.blockNum == 1
+        assert bf.bit_size % 8 == 0
+        assert 9585000 < bf.bit_size < 9586000
+        assert bf.false_positive_rate(1000000) == pytest.approx(0.01, rel=0.05)
+        offsets = bf.offsets(fingerprint('http://example.com'))
+        assert len(set(offsets)) == bf.hash_count
+        assert all(0 <= loc < bf.bit_size for loc in offsets)
+
+    def test_blocks(self):
+        bf = BloomFilter(server=None, key='bf', capacity=10 ** 9, error_rate=0.001)
+        assert bf.blockNum == 7
+        assert bf.bit_size <= BloomFilter.MAX_BLOCK_BITS
+        assert bf.info()['bit_size'] >= 14377587527
+        used = set(bf.block(fingerprint('http://example.com/%s' % i)) for i in range(200))
+        assert used == set('bf%s' % i for i in range(7))
+
+    def test_without_capacity(self):
+        bf = BloomFilter(server=None)
+        assert bf.info() == {'bit_size': 1 << 31, 'hash_count': 7, 'block_count': 1}
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            BloomFilter(server=None, capacity=1000, error_rate=1)
+        with pytest.raises(ValueError):
+            BloomFilter(server=None, capacity=1000, hash_mode='legacy')
+
+
+class TestBloomFilterRedis(object):
+
+    def setup_method(self):
+        self.server = redis.Redis(REDIS_HOST, REDIS_PORT)
+        self.key = 'scrapy_redis_loadbalancing:tests:bloomfilter'
+        self.bf = BloomFilter(self.server, key=self.key)
+        self.bf.bit_size = 1 << 20
+
+    def teardown_method(self):
+        self.server.delete(*self.bf.keys())
+
+    def test_existent(self):
+        fp = fingerprint('http://example.com')
+        assert not self.bf.existent(fp)
+        assert self.bf.existent(fp)
+        assert not self.bf.existent('')
+
+    def test_existent_many(self):
+        self.bf.buerfilter_is_on = False
+        fps = [fingerprint('http://example.com/%s' % i) for i in range(5)]
+        assert self.bf.existent_many(fps[:2]) == [False, False]
+        # duplicates inside one batch are seen from their second occurrence
+        assert self.bf.existent_many(fps + [fps[3], '']) == [True, True, False, False, False, True, False]
+
+    def test_existent_many_chunks(self):
+        self.bf.batch_size = 2
+        fps = [fingerprint('http://example.com/%s' % i) for i in range(5)]
+        assert self.bf.existent_many(fps) == [False] * 5
+        self.bf.buerfilter_is_on = False
+        assert self.bf.existent_many(fps) == [True] * 5
+
+    def test_cached_after_redis_answers(self):
+        fps = [fingerprint('http://example.com/%s' % i) for i in range(3)]
+        with mock.patch.object(self.bf, '_script', side_effect=redis.ConnectionError):
+            with pytest.raises(redis.ConnectionError):
+                self.bf.existent_many(fps)
+        assert len(self.bf.buerfilter) == 0
+        assert self.bf.existent_many(fps) == [False] * 3
+        assert len(self.bf.buerfilter) == 3
+
+    def test_no_dirty_segments(self):
+        self.bf.existent(fingerprint('http://example.com'))
+        assert not self.server.exists(self.bf.dirty_key, self.bf.version_key)
+
+    def test_dirty_segments(self):
+        self.bf.track_dirty = True
+        self.bf.existent(fingerprint('http://example.com'))
+        assert self.server.get(self.bf.version_key) == b'1'
+        members = self.server.zrange(self.bf.dirty_key, 0, -1)
+        assert 0 < len(members) <= self.bf.hash_count
+        assert all(m.startswith((self.key + '0@').encode()) for m in members)
+        self.bf.buerfilter_is_on = False
+        self.bf.existent(fingerprint('http://example.com'))
+        assert self.server.get(self.bf.version_key) == b'1'  # nothing changed
+
+
+class TestReplicatedBloomFilter(object):
+
+    def setup_method(self):
+        self.server = redis.Redis(REDIS_HOST, REDIS_PORT)
+        self.key = 'scrapy_redis_loadbalancing:tests:replica'
+        self.other = BloomFilter(self.server, key=self.key, capacity=100000)
+        self.other.track_dirty = True  # another replica node writing to the same filter
+        self.bf = ReplicatedBloomFilter(self.server, key=self.key, capacity=100000, sync_interval=3600)
+        self.bf.buerfilter_is_on = self.other.buerfilter_is_on = False
+
+    def teardown_method(self):
+        self.server.delete(*self.bf.keys())
+
+    def test_load_and_sync(self):
+        old = [fingerprint('http://example.com/old/%s' % i) for i in range(50)]
+        new = [fingerprint('http://example.com/new/%s' % i) for i in range(50)]
+        self.other.existent_many(old)
+        assert self.bf.existent_many(old) == [True] * 50
+        assert (self.bf.hits, self.bf.lookups) == (50, 50)
+        self.other.existent_many(new)
+        assert self.bf.sync() > 0
+        assert self.bf.existent_many(new) == [True] * 50
+        assert self.bf.hits == 100
+
+    def test_needs_capacity(self):
+        with pytest.raises(ValueError):
+            ReplicatedBloomFilter(self.server, key=self.key)
+
+    @mock.patch('scrapy_redis_loadbalancing.dupefilterbloom.deferToThread')
+    def test_loaded_on_open(self, deferToThread):
+        df = BloomDupeFilter(self.server, self.key, mock.Mock(), capacity=100000, replica=True)
+        df.open()
+        deferToThread.assert_called_once_with(df.bf.sync)
+        assert BloomDupeFilter(self.server, self.key, mock.Mock(), capacity=100000).open() is None
+
+    def test_own_writes(self):
+        fps = [fingerprint('http://example.com/%s' % i) for i in range(20)]
+        assert self.bf.existent_many(fps) == [False] * 20
+        assert self.bf.existent_many(fps) == [True] * 20
+        assert self.bf.hits == 20
+        assert self.other.existent_many(fps) == [True] * 20
+
+
+class TestScalableBloomFilter(object):
+
+    def setup_method(self):
+        self.server = redis.Redis(REDIS_HOST, REDIS_PORT)
+        self.key = 'scrapy_redis_loadbalancing:tests:scalable'
+        self.stats = mock.Mock()
+        self.bf = ScalableBloomFilter(self.server, key=self.key, capacity=100, error_rate=0.01,
+                                      check_interval=0, sample_rate=1, stats=self.stats)
+        self.bf.buerfilter_is_on = False
+
+    def teardown_method(self):
+        self.server.delete(*self.bf.keys())
+
+    def test_layers(self):
+        assert self.bf.layers[0].block_names() == [self.key + '0']
+        assert self.bf.layer(1).capacity == 200
+        assert self.bf.layer(1).error_rate == pytest.approx(0.0025)
+        assert self.bf.layer(2).hash_count > self.bf.layer(0).hash_count
+
+    def test_grow(self):
+        fps = [fingerprint('http://example.com/%s' % i) for i in range(1000)]
+        seen = []
+        for start in range(0, len(fps), 50):
+            seen.extend(self.bf.existent_many(fps[start:start + 50]))
+        assert len(self.bf.layers) >= 3
+        assert seen.count(True) < 10
+        assert self.bf.existent_many(fps) == [True] * len(fps)
+        assert self.bf.sampled == len(fps)
+        assert self.bf.false_positives == seen.count(True)
+        self.stats.set_value.assert_any_call('bloomfilter/layers', len(self.bf.layers))
+
+    def test_layers_shared(self):
+        self.bf.existent_many([fingerprint('http://example.com/%s' % i) for i in range(200)])
+        self.bf.check()
+        other = ScalableBloomFilter(self.server, key=self.key, capacity=100, error_rate=0.01)
+        other.sync()
+        assert len(other.layers) == len(self.bf.layers) > 1
+        assert other.existent(fingerprint('http://example.com/0'))
+
+    def test_observed_false_positive_rate(self):
+        assert self.bf.observed_false_positive_rate() is None
+        self.bf.sampled, self.bf.false_positives = 2000, 10
+        assert self.bf.observed_false_positive_rate() == 0.005
+
+
+class TestShardedBloomFilter(object):
+
+    def setup_method(self):
+        self.server = redis.Redis(REDIS_HOST, REDIS_PORT)
+        self.other = redis.Redis(REDIS_HOST, REDIS_PORT, db=1)
+        self.key = 'scrapy_redis_loadbalancing:tests:shardedbloomfilter'
+        self.bf = ShardedBloomFilter(self.server, key=self.key, shards=4, servers=[self.server, self.other],
+                                     capacity=10000, error_rate=0.001)
+
+    def teardown_method(self):
+        self.bf.clear()
+
+    def test_sizing(self):
+        whole = BloomFilter(None, capacity=10000, error_rate=0.001)
+        assert self.bf.blockNum == 4
+        assert self.bf.bit_size * 4 >= whole.bit_size
+        assert self.bf.hash_count == whole.hash_count
+        assert self.bf.block_names() == ['{%s%d}' % (self.key, i) for i in range(4)]
+
+    def test_sizing_without_capacity(self):
+        bf = ShardedBloomFilter(None, shards=4)
+        assert bf.bit_size * 4 == BloomFilter(None).bit_size
+        assert bf.hash_count == BloomFilter(None).hash_count
+
+    def test_existent_many(self):
+        fps = [fingerprint(str(i)) for i in range(200)]
+        assert self.bf.existent_many(fps) == [False] * 200
+        self.bf.buerfilter = FingerprintCache(10)
+        assert self.bf.existent_many(fps[:100] + [fingerprint('new')]) == [True] * 100 + [False]
+        for i, name in enumerate(self.bf.block_names()):
+            server, other = (self.server, self.other) if i % 2 == 0 else (self.other, self.server)
+            assert server.exists(name)
+            assert not server.exists(name + ':version')
+            assert not other.exists(name)
+
+    def test_clear(self):
+        self.bf.existent_many([fingerprint(str(i)) for i in range(100)])
+        self.bf.clear()
+        assert not self.server.exists(*self.bf.keys())
+        assert not self.other.exists(*self.bf.keys())
+
+
+class TestRotatingBloomFilter(object):
+
+    def setup_method(self):
+        self.server = redis.Redis(REDIS_HOST, REDIS_PORT)
+        self.key = 'scrapy_redis_loadbalancing:tests:rotating'
+        self.bf = RotatingBloomFilter(self.server, key=self.key, window=400, generations=4, capacity=1000)
+
+    def teardown_method(self):
+        for key in self.server.keys(self.key + '*'):
+            self.server.delete(key)
+
+    @mock.patch('scrapy_redis_loadbalancing.bloomfilter.time')
+    def test_window(self, time):
+        fps = [fingerprint('http://example.com/%s' % i) for i in range(10)]
+        generation = int(real_time.time() // 100)
+        time.time.return_value = generation * 100 + 50
+        assert self.bf.existent_many(fps[:5]) == [False] * 5
+        name = '%s:g%d:0' % (self.key, generation)
+        assert self.bf.keys()[-1] == name
+        assert 0 < self.server.ttl(name) <= 500
+        time.time.return_value += 400  # four generations later, still in the window
+        self.bf.buerfilter_is_on = False
+        assert self.bf.existent_many(fps) == [True] * 5 + [False] * 5
+        time.time.return_value += 100  # the first generation left the window
+        assert self.bf.existent_many(fps) == [False] * 5 + [True] * 5
+
+    @mock.patch('scrapy_redis_loadbalancing.bloomfilter.time')
+    def test_cache_reset_on_rotation(self, time):
+        fp = fingerprint('http://example.com')
+        time.time.return_value = real_time.time()
+        self.bf.existent(fp)
+        assert self.bf.existent(fp)
+        time.time.return_value += 500
+        assert not self.bf.existent(fp)
+
+    def test_needs_capacity(self):
+        with pytest.raises(ValueError):
+            RotatingBloomFilter(self.server, key=self.key)
+
+
+def test_dupefilter_request_seen_many():
+    server = redis.Redis(REDIS_HOST, REDIS_PORT)
+    key = 'scrapy_redis_loadbalancing:tests:bloomdupefilter'
+    stats = mock.Mock()
+    df = BloomDupeFilter(server, key, stats)
+    df.bf.bit_size = 1 << 20
+    try:
+        reqs = [Request('http://example.com/%s' % i) for i in range(3)]
+        assert df.request_seen_many(reqs) == [False, False, False]
+        assert df.request_seen_many(reqs[1:] + [Request('http://example.com/new')]) == [True, True, False]
+        stats.inc_value.assert_any_call('dupefilter/bloomfilter', 1)
+        stats.set_value.assert_any_call('bloomfilter/cache/hits', 2)
+        stats.set_value.assert_any_call('bloomfilter/cache/misses', 4)
+    finally:
+        server.delete(key + '0')
+
+
+def test_dupefilter_locked_while_checking():
+    df = BloomDupeFilter(None, 'key', mock.Mock())
+    df.bf = mock.Mock()
+    df.bf.existent_many.side_effect = lambda fps: [df.lock.locked()] * len(fps)
+    assert df.request_seen_many([Request('http://example.com')]) == [True]
+    assert not df.lock.locked()
+
+
+def test_dupefilter_capacity_stats():
+    stats = mock.Mock()
+    df = BloomDupeFilter(None, 'key', stats, capacity=1000, error_rate=0.01)
+    assert df.bf.bit_size == 9592
+    stats.set_value.assert_any_call('bloomfilter/hash_count', 7)
+    stats.set_value.assert_any_call('bloomfilter/capacity', 1000)
+
+
+def test_dupefilter_scalable_settings():
+    from scrapy.settings import Settings
+    kwargs = BloomDupeFilter.bloom_kwargs(Settings({'BLOOMFILTER_SCALABLE': True, 'BLOOMFILTER_CAPACITY': 1000}))
+    df = BloomDupeFilter(None, 'key', mock.Mock(), **kwargs)
+    assert isinstance(df.bf, ScalableBloomFilter)
+    assert df.bf.capacity == 1000
+    with pytest.raises(ValueError):
+        BloomDupeFilter(None, 'key', mock.Mock(), scalable=True)
+
+
+def test_dupefilter_shard_settings():
+    from scrapy.settings import Settings
+    kwargs = BloomDupeFilter.bloom_kwargs(Settings({
+        'BLOOMFILTER_CAPACITY': 1000,
+        'BLOOMFILTER_SHARD_URLS': ['redis://localhost:6379/0', 'redis://localhost:6379/1'],
+    }))
+    assert kwargs['shards'] == 2
+    df = BloomDupeFilter(None, 'key', mock.Mock(), **kwargs)
+    assert isinstance(df.bf, ShardedBloomFilter)
+    assert [server.connection_pool.connection_kwargs['db'] for server in df.bf.servers] == [0, 1]
+
+
+@pytest.mark.parametrize('settings', [
+    {'BLOOMFILTER_SCALABLE': True, 'BLOOMFILTER_REPLICA': True},
+    {'DUPEFILTER_WINDOW': 3600, 'BLOOMFILTER_SHARDS': 4},
+    {'BLOOMFILTER_SCALABLE': True, 'BLOOMFILTER_HASH': 'legacy'},
+])
+def test_dupefilter_conflicting_settings(settings):
+    from scrapy.settings import Settings
+    settings['BLOOMFILTER_CAPACITY'] = 1000
+    kwargs = BloomDupeFilter.bloom_kwargs(Settings(settings))
+    with pytest.raises(ValueError):
+        BloomDupeFilter(None, 'key', mock.Mock(), **kwargs)
@@ -0,0 +1,92 @@
+import binascii
+import hashlib
+import os
+
+import mock
+import pytest
+import redis
+
+from scrapy_redis_loadbalancing import bloomtools
+from scrapy_redis_loadbalancing.bloomfilter import BloomFilter
+
+
+REDIS_HOST = os.environ.get('REDIST_HOST', 'localhost')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+
+
+def fingerprint(value):
+    return hashlib.sha1(value.encode()).hexdigest()
+
+
+class TestBloomTools(object):
+
+    def setup_method(self):
+        self.server = redis.Redis(REDIS_HOST, REDIS_PORT)
+        self.key = 'scrapy_redis_loadbalancing:tests:bloomtools'
+
+    def teardown_method(self):
+        for key in self.server.keys(self.key + '*'):
+            self.server.delete(key)
+
+    def test_dump_restore(self, tmpdir):
+        path = str(tmpdir.join('bloom.bin'))
+        self.server.setbit(self.key + 'a', 5, 1)
+        self.server.setbit(self.key + 'a', 100000, 1)
+        assert bloomtools.dump(self.server, self.key + 'a', path, chunk_size=1000, depth=3) == 12501
+        with open(path, 'rb') as f:
+            assert f.read() == self.server.get(self.key + 'a')
+        self.server.setbit(self.key + 'b', 7, 1)
+        assert bloomtools.restore(self.server, self.key + 'b', path, chunk_size=1000, depth=3) == 1501  # zero chunks skipped
+        assert self.server.get(self.key + 'b').rstrip(b'\0') == self.server.get(self.key + 'a')
+        assert not self.server.getbit(self.key + 'b', 7)
+
+    def test_merge_file(self, tmpdir):
+        path = str(tmpdir.join('bloom.bin'))
+        self.server.setbit(self.key + 'a', 3, 1)
+        self.server.setbit(self.key + 'a', 9000, 1)
+        bloomtools.dump(self.server, self.key + 'a', path)
+        self.server.setbit(self.key + 'b', 4, 1)
+        restore = bloomtools.restore
+
+        def restore_while_writing(server, key, *args):
+            written = restore(server, key, *args)
+            server.setbit(self.key + 'b', 5, 1)  # the live filter keeps recording
+            return written
+
+        with mock.patch.object(bloomtools, 'restore', side_effect=restore_while_writing):
+            bloomtools.merge_file(self.server, self.key + 'b', path, chunk_size=512, depth=2)
+        assert [self.server.getbit(self.key + 'b', i) for i in (3, 4, 5, 9000, 9001)] == [1, 1, 1, 1, 0]
+        assert not self.server.keys('{%sb}:merge:*' % self.key)
+
+    def test_temporary_key(self):
+        assert bloomtools._temporary_key('spider:dupefilter0').startswith('{spider:dupefilter0}:merge:')
+        assert bloomtools._temporary_key('{spider:dupefilter0}').startswith('{spider:dupefilter0}:merge:')
+        assert bloomtools._temporary_key('{}x').startswith('{{}x}:merge:')
+
+    def test_merge(self):
+        self.server.setbit(self.key + 'a', 3, 1)
+        self.server.setbit(self.key + 'b', 4, 1)
+        bloomtools.merge(self.server, self.key + 'a', self.key + 'b')
+        assert self.server.getbit(self.key + 'a', 3) and self.server.getbit(self.key + 'a', 4)
+
+    def test_load_set(self):
+        fps = [fingerprint('http://example.com/%s' % i) for i in range(50)]
+        self.server.sadd(self.key + ':set', *fps[:25])
+        self.server.sadd(self.key + ':set', *[binascii.unhexlify(fp) for fp in fps[25:]])
+        bf = BloomFilter(self.server, self.key + ':bloom', capacity=10000)
+        assert bloomtools.load_set(self.server, self.key + ':set', bf, count=10) == 50
+        assert bf.existent_many(fps) == [True] * 50
+
+    def test_load_truncated(self):
+        self.server.sadd(self.key + ':set', b'12345678')
+        with pytest.raises(ValueError):
+            bloomtools.load_set(self.server, self.key + ':set', BloomFilter(self.server, self.key + ':bloom'))
+
+    def test_cli(self, tmpdir, capsys):
+        path = str(tmpdir.join('bloom.bin'))
+        self.server.setbit(self.key + 'a', 3, 1)
+        url = 'redis://%s:%d' % (REDIS_HOST, REDIS_PORT)
+        bloomtools.main(['--redis-url', url, 'dump', self.key + 'a', path])
+        bloomtools.main(['--redis-url', url, 'restore', self.key + 'c', path])
+        assert self.server.getbit(self.key + 'c', 3)
+        assert 'restored 1 bytes' in capsys.readouterr().out
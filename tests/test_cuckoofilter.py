@@ -0,0 +1,196 @@
+import hashlib
+import os
+
+import mock
+import pytest
+import redis
+
+from scrapy import Spider
+from scrapy.downloadermiddlewares.retry import RetryMiddleware
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import Request, Response
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+
+from scrapy_redis_loadbalancing.cuckoofilter import CuckooFilter, bloom_bits_per_entry
+from scrapy_redis_loadbalancing.downloadermiddlewares.forget import ForgetFailedMiddleware
+from scrapy_redis_loadbalancing.dupefiltercuckoo import CuckooDupeFilter
+
+
+# allow test settings from environment
+REDIS_HOST = os.environ.get('REDIST_HOST', 'localhost')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+
+
+def fingerprint(value):
+    return hashlib.sha1(value.encode()).hexdigest()
+
+
+class TestSizing(object):
+
+    def test_buckets(self):
+        cf = CuckooFilter(server=None, capacity=1000)
+        assert cf.buckets == 264
+        assert cf.info()['bit_size'] == 264 * 4 * 16
+        assert cf.info()['bits_per_entry'] < 17
+        assert cf.false_positive_rate() < 0.00013
+        assert bloom_bits_per_entry(cf.false_positive_rate()) > 16 / cf.load_factor
+
+    def test_too_large(self):
+        with pytest.raises(ValueError):
+            CuckooFilter(server=None, capacity=1 << 30)
+
+    def test_alternate(self):
+        cf = CuckooFilter(server=None, capacity=10000000)
+        assert cf.buckets == 2631579
+        for i in range(100):
+            index, tag = cf.position(fingerprint(str(i)))
+            assert 0 < tag < 1 << 16
+            assert 0 <= cf.alternate(index, tag) < cf.buckets
+            assert cf.alternate(cf.alternate(index, tag), tag) == index
+
+
+class TestCuckooFilterRedis(object):
+
+    def setup_method(self):
+        self.server = redis.Redis(REDIS_HOST, REDIS_PORT)
+        self.key = 'scrapy_redis_loadbalancing:tests:cuckoofilter'
+        self.cf = CuckooFilter(self.server, key=self.key, capacity=1000)
+
+    def teardown_method(self):
+        self.server.delete(*self.cf.keys())
+
+    def test_existent(self):
+        fp = fingerprint('http://example.com')
+        assert not self.cf.existent(fp)
+        assert self.cf.existent(fp)
+        assert len(self.cf) == 1
+
+    def test_existent_many(self):
+        fps = [fingerprint(str(i)) for i in range(3)]
+        assert self.cf.existent_many(fps + fps[:1]) == [False, False, False, True]
+        assert self.cf.contains_many(fps + [fingerprint('new')]) == [True, True, True, False]
+        assert len(self.cf) == 3
+
+    def test_delete(self):
+        fps = [fingerprint(str(i)) for i in range(3)]
+        self.cf.existent_many(fps)
+        assert self.cf.delete_many(fps[:2] + [fingerprint('new')]) == [True, True, False]
+        assert self.cf.contains_many(fps) == [False, False, True]
+        assert len(self.cf) == 1
+        assert not self.cf.existent(fps[0])
+
+    def test_alternate_matches_script(self):
+        # 第一个桶装满后, 新标签只能放到脚本算出的第二个桶
+        fp = fingerprint('http://example.com')
+        index, tag = self.cf.position(fp)
+        for s in range(self.cf.slots):
+            self.server.execute_command('BITFIELD', self.key, 'SET', 'u16', '#%d' % (index * 4 + s), 1)
+        self.cf.existent(fp)
+        alt = self.cf.alternate(index, tag)
+        slots = self.server.execute_command('BITFIELD', self.key, 'GET', 'u16', '#%d' % (alt * 4))
+        assert slots == [tag]
+
+    def test_overflow(self):
+        cf = CuckooFilter(self.server, key=self.key, capacity=4, max_kicks=10)
+        fps = [fingerprint(str(i)) for i in range(20)]
+        assert cf.existent_many(fps) == [False] * 20
+        assert self.server.scard(cf.overflow_key) > 0
+        assert all(cf.contains_many(fps))
+        assert all(cf.delete_many(fps))
+        assert not self.server.exists(cf.overflow_key)
+        assert len(cf) == 0
+
+
+class TestCuckooDupeFilter(object):
+
+    def setup_method(self):
+        self.server = redis.Redis(REDIS_HOST, REDIS_PORT)
+        self.stats = mock.Mock()
+        self.df = CuckooDupeFilter(self.server, 'scrapy_redis_loadbalancing:tests:cuckoodupefilter', self.stats,
+                                   capacity=1000)
+
+    def teardown_method(self):
+        self.df.clear()
+
+    def test_request_seen_and_forget(self):
+        req = Request('http://example.com')
+        assert not self.df.request_seen(req)
+        assert self.df.request_seen(req)
+        assert self.df.forget(req)
+        assert not self.df.forget(req)
+        assert not self.df.request_seen(req)
+        self.stats.inc_value.assert_any_call('dupefilter/cuckoofilter/forgotten', 1)
+        self.stats.set_value.assert_any_call('cuckoofilter/buckets', 264)
+
+    def test_settings(self):
+        kwargs = CuckooDupeFilter.bloom_kwargs(Settings({'CUCKOOFILTER_CAPACITY': 5000}))
+        assert kwargs['capacity'] == 5000
+        df = CuckooDupeFilter(None, 'key', mock.Mock(), **kwargs)
+        assert df.bf.buckets == 1316
+
+
+class TestForgetFailedMiddleware(object):
+
+    def setup_method(self):
+        self.df = mock.Mock()
+        self.crawler = mock.Mock(settings=Settings({'RETRY_HTTP_CODES': [503]}))
+        self.crawler.engine.slot.scheduler.df = self.df
+        self.mw = ForgetFailedMiddleware.from_crawler(self.crawler)
+        self.spider = mock.Mock()
+
+    def recorded(self, url='http://example.com'):
+        return Request(url, meta={'dupefilter_recorded': True})
+
+    def test_response(self):
+        req = self.recorded()
+        resp = Response('http://example.com', status=503)
+        assert self.mw.process_response(req, resp, self.spider) is resp
+        self.df.forget.assert_called_once_with(req)
+        self.mw.process_response(req, Response('http://example.com'), self.spider)
+        assert self.df.forget.call_count == 1
+
+    def test_exception(self):
+        req = self.recorded()
+        assert self.mw.process_exception(req, IOError(), self.spider) is None
+        self.df.forget.assert_called_once_with(req)
+        self.mw.process_exception(req, IgnoreRequest(), self.spider)
+        assert self.df.forget.call_count == 1
+
+    def test_skipped(self):
+        self.mw.process_exception(Request('http://example.com', dont_filter=True), IOError(), self.spider)
+        self.mw.process_exception(Request('http://example.com'), IOError(), self.spider)
+        assert not self.df.forget.called
+        self.crawler.engine.slot.scheduler.df = object()
+        self.mw.process_exception(self.recorded(), IOError(), self.spider)
+
+    def test_own_codes(self):
+        crawler = mock.Mock(settings=Settings({'DUPEFILTER_FORGET_HTTP_CODES': ['404']}))
+        assert ForgetFailedMiddleware.from_crawler(crawler).http_codes == {404}
+
+
+def test_forget_after_retries():
+    server = redis.Redis(REDIS_HOST, REDIS_PORT)
+    crawler = get_crawler(Spider, {'RETRY_TIMES': 2, 'RETRY_HTTP_CODES': [503]})
+    spider = crawler._create_spider('foo')
+    df = CuckooDupeFilter(server, 'scrapy_redis_loadbalancing:tests:cuckooretry', crawler.stats, capacity=1000)
+    crawler.engine = mock.Mock()
+    crawler.engine.slot.scheduler.df = df
+    retry = RetryMiddleware.from_crawler(crawler)
+    forget = ForgetFailedMiddleware.from_crawler(crawler)
+    try:
+        request = Request('http://example.com')
+        assert not df.request_seen(request)
+        for attempt in range(3):
+            # downloader middlewares see responses from the highest order down
+            result = retry.process_response(request, Response(request.url, status=503), spider)
+            if isinstance(result, Request):
+                assert result.dont_filter
+                request = result
+                continue
+            forget.process_response(request, result, spider)
+        assert crawler.stats.get_value('retry/max_reached') == 1
+        assert crawler.stats.get_value('dupefilter/cuckoofilter/forgotten') == 1
+        assert not df.request_seen(Request('http://example.com'))
+    finally:
+        df.clear()
@@ -1,4 +1,5 @@
 import mock
+import pytest
 
 from scrapy.http import Request
 from scrapy.settings import Settings
@@ -88,3 +89,73 @@ class TestFromMethods(object):
         assert df.server is get_redis_from_settings.return_value
         assert df.key.startswith('dupefilter:')
         assert df.debug  # true
+
+
+class TestRFPDupeFilterWindow(object):
+
+    def setup_method(self):
+        import redis
+        self.server = redis.Redis()
+        self.key = 'scrapy_redis_loadbalancing:tests:dupefilter:window'
+        self.df = RFPDupeFilter(self.server, self.key, window=400, generations=4)
+
+    def teardown_method(self):
+        for key in self.server.keys(self.key + '*'):
+            self.server.delete(key)
+
+    @mock.patch('scrapy_redis_loadbalancing.dupefilter.time')
+    def test_window(self, time):
+        import time as real_time
+        time.time.return_value = real_time.time()
+        req = Request('http://example.com')
+        assert not self.df.request_seen(req)
+        assert self.df.request_seen(req)
+        assert 0 < self.server.ttl(self.df.generation_keys()[0]) <= 501
+        time.time.return_value += 400
+        assert self.df.request_seen(req)
+        time.time.return_value += 100
+        assert not self.df.request_seen(req)
+
+    def test_from_settings(self):
+        settings = Settings({'DUPEFILTER_WINDOW': 86400})
+        df = RFPDupeFilter.from_settings(settings, stats=None)
+        assert (df.window, df.generations) == (86400, 4)
+        assert len(df.generation_keys()) == 5
+
+
+class TestRFPDupeFilterBatch(object):
+
+    def setup_method(self):
+        import redis
+        self.server = redis.Redis()
+        self.key = 'scrapy_redis_loadbalancing:tests:dupefilter:batch'
+
+    def teardown_method(self):
+        for key in self.server.keys(self.key + '*'):
+            self.server.delete(key)
+
+    def test_request_seen_many(self):
+        df = RFPDupeFilter(self.server, self.key)
+        df.batch_size = 2
+        reqs = [Request('http://example.com/%s' % i) for i in range(3)]
+        assert df.request_seen_many(reqs + [reqs[0]]) == [False, False, False, True]
+        assert df.request_seen_many(reqs[1:] + [Request('http://example.com/new')]) == [True, True, False]
+        assert df.request_seen(reqs[2])
+
+    def test_binary_fingerprints(self):
+        df = RFPDupeFilter(self.server, self.key, fingerprint_bytes=8)
+        req = Request('http://example.com')
+        assert not df.request_seen(req)
+        assert df.request_seen_many([req]) == [True]
+        member, = self.server.smembers(self.key)
+        assert member == bytes(bytearray.fromhex(df.request_fingerprint(req)))[:8]
+
+    def test_binary_fingerprints_window(self):
+        df = RFPDupeFilter(self.server, self.key, window=400, fingerprint_bytes=20)
+        reqs = [Request('http://example.com/%s' % i) for i in range(2)]
+        assert df.request_seen_many(reqs + reqs[:1]) == [False, False, True]
+        assert self.server.scard(df.generation_keys()[0]) == 2
+
+    def test_invalid_fingerprint_bytes(self):
+        with pytest.raises(ValueError):
+            RFPDupeFilter(self.server, self.key, fingerprint_bytes=21)
@@ -0,0 +1,67 @@
+import mock
+
+from scrapy.http import Request
+from scrapy.settings import Settings
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+from scrapy.utils.request import request_fingerprint
+
+from scrapy_redis_loadbalancing.downloadermiddlewares.forget import ForgetFailedMiddleware
+from scrapy_redis_loadbalancing.dupefilter import RFPDupeFilter
+from scrapy_redis_loadbalancing.dupefilterbloom import BloomDupeFilter
+from scrapy_redis_loadbalancing.fingerprint import (Fingerprinter, fingerprinter_from_crawler,
+                                                    fingerprinter_from_settings)
+from scrapy_redis_loadbalancing.scheduler import Scheduler
+
+
+class TestFingerprinter(object):
+
+    def test_matches_scrapy(self):
+        fingerprinter = Fingerprinter()
+        for req in [Request('http://example.com/a?b=1&a=2'),
+                    Request('http://Example.com/a#frag', method='POST', body=b'x')]:
+            assert fingerprinter.fingerprint(req) == request_fingerprint(req)
+
+    def test_drop_params(self):
+        fingerprinter = Fingerprinter(drop_params=['utm_*', 'gclid'])
+        base = fingerprinter(Request('http://example.com/a?id=1'))
+        assert fingerprinter(Request('http://EXAMPLE.com/a?utm_source=x&id=1&gclid=2')) == base
+        assert fingerprinter(Request('http://example.com/a?id=1&utm=1')) != base
+        assert fingerprinter.canonical_url('http://example.com/?b=1&utm_medium=m&a=2&a=1') == \
+            'http://example.com/?a=1&a=2&b=1'
+
+    def test_keep_fragments(self):
+        assert Fingerprinter(keep_fragments=True).canonical_url('http://example.com/#x') == 'http://example.com/#x'
+        assert Fingerprinter().canonical_url('http://example.com/#x') == 'http://example.com/'
+
+    def test_memoized(self):
+        fingerprinter = Fingerprinter()
+        req = Request('http://example.com')
+        with mock.patch('scrapy_redis_loadbalancing.fingerprint.hashlib') as hashlib:
+            hashlib.sha1.return_value.hexdigest.return_value = 'fp'
+            assert fingerprinter(req) == fingerprinter(req) == 'fp'
+        assert hashlib.sha1.call_count == 1
+        del req
+        assert len(fingerprinter.cache) == 0
+
+    def test_from_settings(self):
+        fingerprinter = fingerprinter_from_settings(Settings({'DUPEFILTER_DROP_PARAMS': 'utm_*,ref'}))
+        assert fingerprinter.drop_params == ['utm_*', 'ref']
+
+    def test_dupefilter(self):
+        fingerprinter = Fingerprinter(drop_params=['utm_*'])
+        df = RFPDupeFilter(mock.Mock(), 'key', fingerprinter=fingerprinter)
+        assert df.request_fingerprint(Request('http://example.com/?utm_source=x')) == \
+            request_fingerprint(Request('http://example.com/'))
+
+
+def test_shared_per_crawler():
+    crawler = get_crawler(Spider, {'DUPEFILTER_DROP_PARAMS': ['utm_*']})
+    spider = crawler._create_spider('foo')
+    fingerprinter = fingerprinter_from_crawler(crawler)
+    assert fingerprinter.drop_params == ['utm_*']
+    assert Scheduler.from_crawler(crawler).fingerprinter is fingerprinter
+    assert ForgetFailedMiddleware.from_crawler(crawler).fingerprinter is fingerprinter
+    assert RFPDupeFilter.from_spider(spider).fingerprinter is fingerprinter
+    assert BloomDupeFilter.from_crawler(crawler).fingerprinter is fingerprinter
+    assert fingerprinter_from_crawler(get_crawler(Spider)) is not fingerprinter
@@ -0,0 +1,68 @@
+from scrapy import Spider
+from scrapy.http import Request
+from scrapy.utils.reqser import request_to_dict, request_from_dict
+
+from scrapy_redis_loadbalancing import msgpackcompat, picklecompat
+
+
+class MySpider(Spider):
+    name = 'myspider'
+
+    def parse_page(self, response):
+        pass
+
+
+def test_msgpackcompat():
+    obj = {'_encoding': 'utf-8',
+        'body': '',
+        'callback': '_response_downloaded',
+        'cookies': {},
+        'dont_filter': False,
+        'errback': None,
+        'headers': {'Referer': ['http://www.dmoz.org/']},
+        'meta': {'depth': 1, 'link_text': u'Fran\xe7ais', 'rule': 0},
+        'method': 'GET',
+        'priority': 0,
+        'url': u'http://www.dmoz.org/World/Fran%C3%A7ais/',
+    }
+    # missing optional fields come back with their defaults
+    assert dict(obj, flags=[], cb_kwargs={}) == msgpackcompat.loads(msgpackcompat.dumps(obj))
+
+
+def test_request_round_trip():
+    spider = MySpider()
+    req = Request('http://example.com/page', callback=spider.parse_page,
+                  errback=spider.parse, priority=5, headers={'Referer': 'http://example.com/'},
+                  meta={'depth': 2, 'obj': object.__new__(MySpider)})
+    out = request_from_dict(msgpackcompat.loads(msgpackcompat.dumps(request_to_dict(req, spider))), spider)
+    assert out.url == req.url
+    assert out.callback == req.callback
+    assert out.errback == req.errback
+    assert out.priority == 5
+    assert out.headers == req.headers
+    assert out.meta['depth'] == 2
+    assert isinstance(out.meta['obj'], MySpider)
+
+
+def test_keeps_types():
+    obj = {'url': 'http://example.com/', 'callback': 'parse', 'dont_filter': True,
+           'meta': {'pair': (1, ('a', b'b')), 'flag': True, 'items': [1, 2]},
+           'cb_kwargs': {'key': ('x', 2)}}
+    out = msgpackcompat.loads(msgpackcompat.dumps(obj))
+    assert out['meta'] == obj['meta']
+    assert out['meta']['pair'] == (1, ('a', b'b'))
+    assert type(out['meta']['items']) is list
+    assert out['meta']['flag'] is True
+    assert out['dont_filter'] is True
+    assert out['cb_kwargs'] == {'key': ('x', 2)}
+
+
+def test_smaller_than_pickle():
+    spider = MySpider()
+    obj = request_to_dict(Request('http://example.com/page', meta={'depth': 1}), spider)
+    assert len(msgpackcompat.dumps(obj)) < len(picklecompat.dumps(obj)) / 2
+
+
+def test_reads_pickled_payloads():
+    obj = {'url': 'http://example.com/', 'callback': None}
+    assert msgpackcompat.loads(picklecompat.dumps(obj)) == obj
@@ -3,7 +3,7 @@ import mock
 from scrapy import Spider
 from scrapy.http import Request
 
-from scrapy_redis_loadbalancing.queueS import Base
+from scrapy_redis_loadbalancing.queues import Base
 
 
 class TestBaseQueue(object):
@@ -3,14 +3,15 @@ import os
 import mock
 import redis
 
-from scrapy import Request, Spider
+from scrapy import Request, Spider, signals
 from scrapy.settings import Settings
 from scrapy.utils.test import get_crawler
+from twisted.internet import defer
 from unittest import TestCase
 
 from scrapy_redis_loadbalancing import connection
 from scrapy_redis_loadbalancing.dupefilter import RFPDupeFilter
-from scrapy_redis_loadbalancing.queueS import FifoQueue, LifoQueue, PriorityQueue
+from scrapy_redis_loadbalancing.queues import FifoQueue, LifoQueue, PriorityQueue
 from scrapy_redis_loadbalancing.scheduler import Scheduler
 
 
@@ -127,6 +128,27 @@ class PriorityQueueTest(QueueTestMixin, TestCase):
         self.assertEqual(out2.url, req1.url)
         self.assertEqual(out3.url, req2.url)
 
+    def test_fifo_within_priority(self):
+        reqs = [Request('http://example.com/page%s' % i, priority=-1000000 if i % 2 else 10)
+                for i in range(20)]
+        for req in reqs:
+            self.q.push(req)
+
+        urls = [self.q.pop().url for _ in range(20)]
+        self.assertEqual(urls, [req.url for req in reqs[0::2] + reqs[1::2]])
+
+    def test_batch(self):
+        self.q.batch_size = 3
+        reqs = [Request('http://example.com/page%s' % i, priority=i // 4) for i in range(10)]
+        self.assertEqual(self.q.push_many(reqs), 10)
+        self.assertEqual(len(self.q), 10)
+
+        out = self.q.pop_many(6)
+        self.assertEqual([req.url for req in out], [req.url for req in reqs[8:] + reqs[4:8]])
+        self.assertEqual(len(self.q.pop_many(10)), 4)
+        self.assertEqual(self.q.pop_many(10), [])
+        self.assertIsNone(self.q.pop())
+
 
 class LifoQueueTest(QueueTestMixin, TestCase):
 
@@ -161,6 +183,7 @@ class SchedulerTest(RedisTestMixin, TestCase):
             'SCHEDULER_PERSIST': False,
             'SCHEDULER_SERIALIZER': 'pickle',
             'DUPEFILTER_CLASS': 'scrapy_redis_loadbalancing.dupefilter.RFPDupeFilter',
+            'BLOOMFILTER_CAPACITY': 1000,
         })
         self.scheduler = Scheduler.from_crawler(self.spider.crawler)
 
@@ -191,6 +214,212 @@ class SchedulerTest(RedisTestMixin, TestCase):
 
         self.scheduler.close('finish')
 
+    def test_batched_enqueue(self):
+        self.scheduler.queue_cls = 'scrapy_redis_loadbalancing.queues.FifoQueue'
+        self.scheduler.batch_size = 3
+        self.scheduler.open(self.spider)
+        self.assertTrue(self.scheduler._flush_task.running)
+
+        reqs = [Request('http://example.com/page%s' % i) for i in range(3)]
+        for req in reqs[:2] + reqs[:1]:
+            self.assertTrue(self.scheduler.enqueue_request(req))
+        self.assertEqual(self.scheduler.pending, [])
+        self.assertEqual(len(self.scheduler.queue), 2)
+
+        self.scheduler.enqueue_request(reqs[2])
+        self.scheduler.enqueue_request(reqs[0].replace(dont_filter=True))
+        self.assertEqual(len(self.scheduler), 4)
+
+        # the queue runs dry before the batch is full, so pending requests are flushed
+        urls = [self.scheduler.next_request().url for _ in range(4)]
+        self.assertEqual(urls, [req.url for req in reqs + reqs[:1]])
+        self.assertFalse(self.scheduler.has_pending_requests())
+
+        self.scheduler.close('finish')
+        self.assertFalse(self.scheduler._flush_task.running)
+
+    def test_batched_drops_and_errors(self):
+        dropped = []
+
+        def on_dropped(request, spider):
+            dropped.append(request)
+
+        self.spider.crawler.signals.connect(on_dropped, signal=signals.request_dropped)
+        self.scheduler.queue_cls = 'scrapy_redis_loadbalancing.queues.FifoQueue'
+        self.scheduler.dupefilter_cls = 'scrapy_redis_loadbalancing.dupefilterbloom.BloomDupeFilter'
+        self.scheduler.batch_size = 10
+        self.scheduler.open(self.spider)
+        self.fail_script(1)
+        reqs = [Request('http://example.com/page%s' % i) for i in range(3)]
+
+        for req in reqs[:2] + reqs[:1]:
+            self.scheduler.enqueue_request(req)
+        self.assertEqual(self.scheduler.flush_pending(), 0)
+        self.assertEqual(self.scheduler.pending, reqs[:2] + reqs[:1])
+        self.assertEqual(dropped, [])
+
+        with mock.patch.object(self.scheduler.queue, 'push_many', side_effect=redis.ConnectionError):
+            self.assertEqual(self.scheduler.flush_pending(), 0)
+        self.assertEqual(dropped, reqs[:1])
+        self.assertEqual(self.scheduler.accepted, reqs[:2])
+        self.assertEqual(len(self.scheduler), 2)
+
+        self.scheduler.enqueue_request(reqs[2])
+        self.assertEqual(self.scheduler.flush_pending(), 3)
+        self.assertEqual(self.scheduler.accepted, [])
+        self.assertEqual(len(self.scheduler.queue), 3)
+        self.assertEqual(self.spider.crawler.stats.get_value('scheduler/flush/errors'), 2)
+
+        self.scheduler.close('finish')
+
+    def fail_script(self, call):
+        """Makes the given call of the bloom filter script fail like a lost connection."""
+        bf = self.scheduler.df.bf
+        script, calls = bf._script, []
+
+        def flaky(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == call:
+                raise redis.ConnectionError()
+            return script(*args, **kwargs)
+
+        bf._script = flaky
+
+    def open_async(self, deferToThread):
+        self.admissions = []
+
+        def defer_to_thread(f, *args):
+            d = defer.Deferred()
+            self.admissions.append((d, f, args))
+            return d
+
+        deferToThread.side_effect = defer_to_thread
+        self.scheduler.queue_cls = 'scrapy_redis_loadbalancing.queues.FifoQueue'
+        self.scheduler.admission_async = True
+        self.scheduler.batch_size = 2
+        self.scheduler.batch_interval = 0
+        self.scheduler.admission_buffer = 4
+        self.scheduler.crawler = mock.Mock()
+        self.scheduler.open(self.spider)
+
+    def run_admission(self, index):
+        d, f, args = self.admissions[index]
+        try:
+            result = f(*args)
+        except Exception:
+            d.errback()
+        else:
+            d.callback(result)
+
+    @mock.patch('scrapy_redis_loadbalancing.scheduler.deferToThread')
+    def test_async_admission(self, deferToThread):
+        self.open_async(deferToThread)
+        engine = self.scheduler.crawler.engine
+
+        reqs = [Request('http://example.com/page%s' % i) for i in range(3)]
+        for req in reqs[:2] + reqs[:1]:
+            self.assertTrue(self.scheduler.enqueue_request(req))
+        self.assertEqual(len(self.admissions), 1)
+        self.assertEqual(len(self.scheduler.admitting), 2)
+        self.assertEqual(len(self.scheduler), 3)
+        self.assertIsNone(self.scheduler.next_request())
+        self.assertTrue(self.scheduler.has_pending_requests())
+
+        # the buffer is full while the first admission runs
+        self.scheduler.enqueue_request(reqs[2])
+        self.assertEqual(engine.pause.call_count, 1)
+
+        self.run_admission(0)
+        self.assertEqual(len(self.scheduler.queue), 2)
+        self.assertEqual(len(self.admissions), 2)
+        self.assertFalse(engine.unpause.called)
+
+        self.run_admission(1)
+        self.assertEqual(engine.unpause.call_count, 1)
+        urls = [self.scheduler.next_request().url for _ in range(3)]
+        self.assertEqual(urls, [req.url for req in reqs])
+        self.assertFalse(self.scheduler.has_pending_requests())
+        self.assertIsNotNone(self.spider.crawler.stats.get_value('scheduler/admission/latency_max'))
+
+        self.scheduler.close('finish')
+
+    @mock.patch('scrapy_redis_loadbalancing.scheduler.deferToThread')
+    def test_async_admission_failure_and_close(self, deferToThread):
+        self.open_async(deferToThread)
+        reqs = [Request('http://example.com/page%s' % i) for i in range(3)]
+        for req in reqs[:2]:
+            self.scheduler.enqueue_request(req)
+
+        self.admissions[0][0].errback(RuntimeError('connection lost'))
+        self.assertEqual(self.scheduler.pending, reqs[:2])
+        self.assertEqual(self.scheduler.admitting, [])
+        self.assertEqual(self.spider.crawler.stats.get_value('scheduler/admission/errors'), 1)
+
+        self.scheduler.admit()
+        self.scheduler.enqueue_request(reqs[2])
+        self.scheduler.persist = True
+        d = self.scheduler.close('finish')
+        self.assertEqual(len(self.scheduler.queue), 0)
+        self.run_admission(1)
+        self.assertTrue(d.called)
+        self.assertEqual(len(self.scheduler.queue), 3)
+
+    @mock.patch('scrapy_redis_loadbalancing.scheduler.deferToThread')
+    def test_async_admission_redis_error(self, deferToThread):
+        self.scheduler.dupefilter_cls = 'scrapy_redis_loadbalancing.dupefilterbloom.BloomDupeFilter'
+        self.open_async(deferToThread)
+        self.fail_script(1)
+        reqs = [Request('http://example.com/page%s' % i) for i in range(2)]
+        for req in reqs:
+            self.scheduler.enqueue_request(req)
+
+        self.run_admission(0)
+        self.assertEqual(self.scheduler.pending, reqs)
+        self.assertEqual(len(self.scheduler.queue), 0)
+
+        # nothing reached Redis, so the retry must not see duplicates
+        self.scheduler._retry.func()
+        self.run_admission(1)
+        self.assertEqual(len(self.scheduler.queue), 2)
+        self.scheduler.close('finish')
+
+    @mock.patch('scrapy_redis_loadbalancing.scheduler.deferToThread')
+    def test_async_admission_partial_failure(self, deferToThread):
+        self.scheduler.dupefilter_cls = 'scrapy_redis_loadbalancing.dupefilterbloom.BloomDupeFilter'
+        self.open_async(deferToThread)
+        self.scheduler.dedup_chunk = 1
+        self.fail_script(2)
+        reqs = [Request('http://example.com/page%s' % i) for i in range(2)]
+        for req in reqs:
+            self.scheduler.enqueue_request(req)
+
+        # the first chunk is recorded, then the connection drops
+        self.run_admission(0)
+        self.assertEqual(self.scheduler.pending, reqs[1:])
+        self.assertEqual(len(self.scheduler.queue), 1)
+
+        # the retry does not wait for the flush timer, which is off here
+        self.assertTrue(self.scheduler._retry.active())
+        self.scheduler._retry.func()
+        self.assertFalse(self.scheduler._retry)
+        self.run_admission(1)
+        self.assertEqual(len(self.scheduler.queue), 2)
+        self.scheduler.close('finish')
+
+    @mock.patch('scrapy_redis_loadbalancing.scheduler.deferToThread')
+    def test_async_admission_handler_error(self, deferToThread):
+        self.open_async(deferToThread)
+        for i in range(2):
+            self.scheduler.enqueue_request(Request('http://example.com/page%s' % i))
+        with mock.patch.object(self.scheduler, '_backpressure', side_effect=RuntimeError):
+            self.run_admission(0)
+        d = self.admissions[0][0]
+        self.assertIsNone(d.result)
+        self.assertIsNone(self.scheduler._admission)
+        self.assertEqual(len(self.scheduler.queue), 2)
+        self.scheduler.close('finish')
+        self.assertIsNone(self.scheduler._retry)
+
     def test_scheduler_persistent(self):
         # TODO: Improve this test to avoid the need to check for log messages.
         self.spider.log = mock.Mock(spec=self.spider.log)
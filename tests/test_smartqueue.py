@@ -0,0 +1,481 @@
+import os
+import shutil
+import tempfile
+
+import mock
+import redis
+
+from twisted.internet import defer
+
+from scrapy import Request, signals
+from scrapy.utils.test import get_crawler
+from unittest import TestCase
+
+from scrapy_redis_loadbalancing.smartqueue import (
+    BalanceController,
+    DomainSmartQueue,
+    InboxRemoteQueue,
+    LocalDomainQueue,
+    LocalPriorityQueue,
+    ReliableRemoteQueue,
+    ReliableSmartQueue,
+    RemotePriorityQueue,
+    RemoteQueue,
+    SmartQueue,
+    SpillLocalQueue,
+    StealingSmartQueue,
+)
+
+
+# allow test settings from environment
+REDIS_HOST = os.environ.get('REDIST_HOST', 'localhost')
+REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
+
+
+def get_spider(*args, **kwargs):
+    crawler = get_crawler(spidercls=kwargs.pop('spidercls', None),
+                          settings_dict=kwargs.pop('settings_dict', None))
+    return crawler._create_spider(*args, **kwargs)
+
+
+class RedisTestMixin(object):
+
+    @property
+    def server(self):
+        if not hasattr(self, '_redis'):
+            self._redis = redis.Redis(REDIS_HOST, REDIS_PORT)
+        return self._redis
+
+    def clear_keys(self, prefix):
+        keys = self.server.keys(prefix + '*')
+        if keys:
+            self.server.delete(*keys)
+
+
+class RemoteQueueTest(RedisTestMixin, TestCase):
+
+    def setUp(self):
+        self.spider = get_spider(name='myspider')
+        self.key = 'scrapy_redis_loadbalancing:tests:%(spider)s:requests'
+        self.q = RemoteQueue(self.server, self.spider, self.key)
+
+    def tearDown(self):
+        self.clear_keys('scrapy_redis_loadbalancing:tests:')
+
+    def test_push_pop_batch(self):
+        reqs = [Request('http://example.com/?page=%s' % i) for i in range(10)]
+        self.assertEqual(self.q.push(reqs), 10)
+        self.assertEqual(len(self.q), 10)
+
+        out = self.q.pop(amount=4)
+        self.assertEqual(len(out), 4)
+        self.assertEqual(len(self.q), 6)
+
+        # asking for more than what is left returns exactly what was moved
+        out += self.q.pop(amount=100)
+        self.assertEqual(len(self.q), 0)
+        self.assertEqual(sorted(r.url for r in out), sorted(r.url for r in reqs))
+
+    def test_pop_empty(self):
+        self.assertEqual(self.q.pop(amount=10), [])
+        self.assertEqual(self.q.push([]), 0)
+
+
+class RemotePriorityQueueTest(RemoteQueueTest):
+
+    def setUp(self):
+        super(RemotePriorityQueueTest, self).setUp()
+        self.q = RemotePriorityQueue(self.server, self.spider, self.key)
+
+    def test_pop_highest_priority_first(self):
+        self.q.push([Request('http://example.com/%s' % p, priority=p) for p in (0, 50, -10, 100)])
+        out = self.q.pop(amount=2)
+        self.assertEqual([r.priority for r in out], [100, 50])
+        out = self.q.pop(amount=2)
+        self.assertEqual([r.priority for r in out], [0, -10])
+
+
+class ReliableRemoteQueueTest(RedisTestMixin, TestCase):
+
+    def setUp(self):
+        self.spider = get_spider(name='myspider')
+        self.key = 'scrapy_redis_loadbalancing:tests:%(spider)s:requests'
+        self.q = ReliableRemoteQueue(self.server, self.spider, self.key, node='node-a')
+        self.other = ReliableRemoteQueue(self.server, self.spider, self.key, node='node-b')
+
+    def tearDown(self):
+        self.clear_keys('scrapy_redis_loadbalancing:tests:')
+
+    def test_pop_leases_until_ack(self):
+        self.q.push([Request('http://example.com/%s' % i) for i in range(5)])
+        out = self.q.pop(amount=3)
+        self.assertEqual(len(self.q), 2)
+        self.assertEqual(self.server.hlen(self.q.lease_key), 3)
+
+        self.q.ack([r.meta[ReliableRemoteQueue.LEASE_META] for r in out[:2]])
+        self.assertEqual(self.server.hlen(self.q.lease_key), 1)
+
+        # the node dies: its unacknowledged work goes back to the queue
+        self.assertEqual(self.other.requeue('node-a'), 1)
+        self.assertEqual(len(self.q), 3)
+        self.assertEqual(self.server.hlen(self.q.lease_key), 0)
+
+    def test_push_releases_lease(self):
+        self.q.push([Request('http://example.com/1')])
+        out = self.q.pop(amount=1)
+        self.q.push(out)
+        self.assertEqual(self.server.hlen(self.q.lease_key), 0)
+        self.assertEqual(len(self.q), 1)
+
+    def test_expired_leases_are_requeued(self):
+        self.q.timeout = -10
+        self.q.push([Request('http://example.com/%s' % i) for i in range(2)])
+        self.q.pop(amount=2)
+        self.assertEqual(self.other.requeue(), 2)
+        self.assertEqual(len(self.q), 2)
+        self.q.timeout = 60
+        self.q.renew()
+        self.q.pop(amount=2)
+        self.assertEqual(self.other.requeue(), 0)
+
+    @mock.patch('scrapy_redis_loadbalancing.smartqueue.time.time', return_value=0)
+    def test_renew_uses_server_clock(self, time):
+        self.q.renew()
+        now = self.server.time()[0]
+        self.assertAlmostEqual(self.server.zscore(self.q.leases_key, 'node-a'), now + self.q.timeout, delta=2)
+
+
+class InboxRemoteQueueTest(RedisTestMixin, TestCase):
+
+    def setUp(self):
+        self.spider = get_spider(name='myspider')
+        self.key = 'scrapy_redis_loadbalancing:tests:%(spider)s:requests'
+        self.a = InboxRemoteQueue(self.server, self.spider, self.key, node='node-a')
+        self.b = InboxRemoteQueue(self.server, self.spider, self.key, node='node-b')
+
+    def tearDown(self):
+        self.clear_keys('scrapy_redis_loadbalancing:tests:')
+
+    def test_inboxes_are_per_node(self):
+        self.a.push([Request('http://example.com/%s' % i) for i in range(4)])
+        self.assertEqual(len(self.a), 4)
+        self.assertEqual(len(self.b), 0)
+        self.assertEqual(self.b.pop(amount=10), [])
+
+        self.assertEqual(len(self.b.steal('node-a', 3)), 3)
+        self.assertEqual(len(self.a), 1)
+
+    def test_loads(self):
+        self.a.publish(2.5)
+        self.b.publish(0)
+        self.assertEqual(self.a.loads(), {'node-a': 2.5, 'node-b': 0.0})
+        self.a.forget('node-b')
+        self.assertEqual(self.a.loads(), {'node-a': 2.5})
+
+
+class LocalPriorityQueueTest(TestCase):
+
+    def test_priority_then_fifo(self):
+        q = LocalPriorityQueue()
+        for url, priority in [('a', 0), ('b', 10), ('c', 0), ('d', 10)]:
+            q.push(Request('http://example.com/' + url, priority=priority))
+        self.assertEqual([q.pop().url[-1] for _ in range(4)], ['b', 'd', 'a', 'c'])
+        self.assertIsNone(q.pop())
+
+    def test_offload_lowest_priority(self):
+        q = LocalPriorityQueue()
+        for priority in (5, -1, 3, 0, 9):
+            q.push(Request('http://example.com/%s' % priority, priority=priority))
+        out = q.offload(2)
+        self.assertEqual(sorted(r.priority for r in out), [-1, 0])
+        self.assertEqual([q.pop().priority for _ in range(3)], [9, 5, 3])
+
+        q.restore(out)
+        self.assertEqual(q.pop().priority, 0)
+
+
+class SpillLocalQueueTest(TestCase):
+
+    def setUp(self):
+        self.spider = get_spider(name='myspider')
+        self.tmpdir = tempfile.mkdtemp()
+        rqueue = RemoteQueue(mock.Mock(), self.spider, 'key')
+        self.q = SpillLocalQueue(rqueue._encode_request, rqueue._decode_request,
+                                 limit=8, directory=self.tmpdir,
+                                 stats=self.spider.crawler.stats)
+
+    def tearDown(self):
+        self.q.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_memory_is_bounded(self):
+        for i in range(50):
+            self.q.push(Request('http://example.com/%s' % i))
+            self.assertLessEqual(len(self.q.queue), 8)
+        self.assertEqual(len(self.q), 50)
+        stats = self.spider.crawler.stats
+        self.assertEqual(stats.get_value('smartqueue/spill/count'), len(self.q.spill))
+        self.assertGreater(stats.get_value('smartqueue/spill/bytes'), 0)
+
+        urls = set()
+        while True:
+            request = self.q.pop()
+            if request is None:
+                break
+            urls.add(request.url)
+        self.assertEqual(len(urls), 50)
+        self.assertEqual(len(self.q), 0)
+
+    def test_offload_takes_spilled_work_first(self):
+        for i in range(20):
+            self.q.push(Request('http://example.com/%s' % i))
+        out = self.q.offload(3)
+        self.assertEqual([r.url for r in out], ['http://example.com/0',
+                                                 'http://example.com/1',
+                                                 'http://example.com/2'])
+        self.assertEqual(len(self.q), 17)
+
+    def test_restore_is_bounded(self):
+        for i in range(20):
+            self.q.push(Request('http://example.com/%s' % i))
+        out = self.q.offload(15)
+        self.q.restore(out)
+        self.assertLessEqual(len(self.q.queue), 8)
+        self.assertEqual(len(self.q), 20)
+
+    def test_refill_is_lifo_within_a_batch(self):
+        for i in range(12):
+            self.q.push(Request('http://example.com/%s' % i))
+        # 0-5 were spilled, 6-11 stay in memory
+        urls = [self.q.pop().url.rsplit('/', 1)[1] for _ in range(12)]
+        self.assertEqual(urls, ['11', '10', '9', '8', '7', '6', '3', '2', '1', '0', '5', '4'])
+
+
+class LocalDomainQueueTest(TestCase):
+
+    def push_all(self, q):
+        for host, count in [('slow', 4), ('a', 1), ('b', 2)]:
+            for i in range(count):
+                q.push(Request('http://%s.example.com/%s' % (host, i)))
+
+    def test_round_robin(self):
+        q = LocalDomainQueue()
+        self.push_all(q)
+        self.assertEqual(len(q), 7)
+        hosts = [q.pop().url.split('.')[0][7:] for _ in range(7)]
+        self.assertEqual(hosts, ['slow', 'a', 'b', 'slow', 'b', 'slow', 'slow'])
+        self.assertIsNone(q.pop())
+        self.assertEqual(len(q), 0)
+
+    def test_skips_busy_slots(self):
+        q = LocalDomainQueue(slot_available=lambda key: key != 'slow.example.com')
+        self.push_all(q)
+        hosts = [q.pop().url.split('.')[0][7:] for _ in range(4)]
+        self.assertEqual(hosts, ['a', 'b', 'b', 'slow'])
+
+    def test_parked_slots_until_released(self):
+        busy = {'slow.example.com'}
+        checked = []
+
+        def slot_available(key):
+            checked.append(key)
+            return key not in busy
+
+        q = LocalDomainQueue(slot_available=slot_available)
+        self.push_all(q)
+        self.assertEqual(q.pop().url, 'http://a.example.com/0')
+        self.assertEqual(list(q.parked), ['slow.example.com'])
+        # the busy slot is not checked again until the downloader releases it
+        del checked[:]
+        self.assertEqual(q.pop().url, 'http://b.example.com/1')
+        self.assertEqual(checked, ['b.example.com'])
+
+        busy.clear()
+        q.release('slow.example.com')
+        hosts = [q.pop().url.split('.')[0][7:] for _ in range(5)]
+        self.assertEqual(hosts, ['b', 'slow', 'slow', 'slow', 'slow'])
+        self.assertIsNone(q.pop())
+
+    def test_offload_levels_biggest_slot(self):
+        q = LocalDomainQueue()
+        self.push_all(q)
+        out = q.offload(2)
+        self.assertEqual([r.url for r in out], ['http://slow.example.com/0',
+                                                 'http://slow.example.com/1'])
+        self.assertEqual(len(q), 5)
+        # slow and b are now level, so both give up work
+        self.assertEqual(sorted(r.url.split('.')[0][7:] for r in q.offload(2)), ['b', 'slow'])
+
+    def test_restore_keeps_order(self):
+        q = LocalDomainQueue()
+        self.push_all(q)
+        out = q.offload(2)
+        q.restore(out)
+        self.assertEqual(len(q), 7)
+        self.assertEqual([r.url for r in q.offload(2)], [r.url for r in out])
+
+
+class BalanceControllerTest(TestCase):
+
+    def converge(self, controller, rtt, drain_rate, backlog, rounds=50):
+        for _ in range(rounds):
+            result = controller.update(rtt, drain_rate, backlog)
+        return result
+
+    def test_high_latency_moves_big_batches_rarely(self):
+        lan = self.converge(BalanceController(), 0.001, 100, 10000)
+        wan = self.converge(BalanceController(), 0.05, 100, 10000)
+        self.assertLess(lan[0], wan[0])
+        self.assertLess(lan[1], wan[1])
+
+    def test_bounds_and_damping(self):
+        controller = BalanceController(interval=2, interval_min=1, interval_max=10,
+                                       batch_min=10, batch_max=500, damping=0.5)
+        interval, _ = controller.update(1.0, 1000, 100000)
+        self.assertEqual(interval, 6)  # half way towards the upper bound
+        interval, batch = self.converge(controller, 1.0, 1000, 100000)
+        self.assertAlmostEqual(interval, 10)
+        self.assertEqual(batch, 500)
+
+    def test_starts_from_default_batch(self):
+        self.assertEqual(BalanceController().batch_size, 200)
+        self.assertEqual(BalanceController(batch_size=5, batch_min=10).batch_size, 10)
+
+    def test_unknown_rtt_keeps_interval(self):
+        controller = BalanceController(interval=3)
+        self.assertEqual(controller.update(None, 0, 0)[0], 3)
+
+
+@mock.patch('scrapy_redis_loadbalancing.smartqueue.task')
+class SmartQueueTest(RedisTestMixin, TestCase):
+
+    def setUp(self):
+        self.spider = get_spider(name='myspider')
+        self.key = 'scrapy_redis_loadbalancing:tests:%(spider)s:requests'
+
+    def tearDown(self):
+        self.clear_keys('scrapy_redis_loadbalancing:tests:')
+
+    def test_exchange_does_not_touch_local_queue(self, task):
+        q = SmartQueue(self.server, self.spider, self.key)
+        for i in range(5):
+            q.push(Request('http://example.com/?page=%s' % i))
+        local = list(q.lqueue)
+
+        returned, pulled, rlength = q._exchange([Request('http://example.com/out')], 0)
+        self.assertEqual((returned, pulled, rlength), ([], [], 1))
+        self.assertEqual(list(q.lqueue), local)
+
+        returned, pulled, rlength = q._exchange([], 10)
+        self.assertEqual([r.url for r in pulled], ['http://example.com/out'])
+        self.assertEqual(rlength, 0)
+        self.assertEqual(list(q.lqueue), local)
+
+        q._splice((returned, pulled, rlength))
+        self.assertEqual(len(q), 6)
+        self.assertEqual(q.rlength, 0)
+
+    def test_failed_push_is_returned_in_order(self, task):
+        q = SmartQueue(self.server, self.spider, self.key)
+        for i in range(3):
+            q.push(Request('http://example.com/?page=%s' % i))
+        order = [r.url for r in q.lqueue]
+        outgoing = q.lqueue.offload(2)
+        q.rqueue.push = mock.Mock(side_effect=redis.ConnectionError)
+
+        result = q._exchange(outgoing, 0)
+        self.assertEqual(result[0], outgoing)
+        q._splice(result)
+        self.assertEqual([r.url for r in q.lqueue], order)
+
+    def test_reliable_pop_collects_acks(self, task):
+        q = ReliableSmartQueue(self.server, self.spider, self.key)
+        q.rqueue.push([Request('http://example.com/%s' % i) for i in range(3)])
+        q._splice(q._exchange([], 3))
+        self.assertEqual(len(q), 3)
+        for _ in range(3):
+            self.assertNotIn(ReliableRemoteQueue.LEASE_META, q.pop().meta)
+        self.assertEqual(len(q.acks), 3)
+
+        # a failed ack keeps the ids for the next round
+        q.acking, q.acks = q.acks, []
+        with mock.patch.object(q.rqueue, 'ack', side_effect=redis.ConnectionError):
+            q._splice(q._exchange([], 0))
+        self.assertEqual(len(q.acks), 3)
+        self.assertEqual(self.server.hlen(q.rqueue.lease_key), 3)
+
+        q.acking, q.acks = q.acks, []
+        q._splice(q._exchange([], 0))
+        self.assertEqual(q.acks, [])
+        self.assertEqual(self.server.hlen(q.rqueue.lease_key), 0)
+
+    def test_idle_node_steals_from_busiest(self, task):
+        q = StealingSmartQueue(self.server, self.spider, self.key)
+        q.rqueue = InboxRemoteQueue(self.server, self.spider, self.key, node='idle')
+        busy = InboxRemoteQueue(self.server, self.spider, self.key, node='busy')
+        busy.push([Request('http://example.com/%s' % i) for i in range(5)])
+        busy.publish(10)
+        InboxRemoteQueue(self.server, self.spider, self.key, node='calm').publish(1)
+
+        # the published load is computed on the reactor thread, from the inbox backlog known there
+        self.spider.crawler.stats.set_value('tps_page', 10)
+        q.rlength = 20
+        d = defer.Deferred()
+        with mock.patch('scrapy_redis_loadbalancing.smartqueue.deferToThread', return_value=d) as dtt:
+            q.tranfer(-4)
+            self.assertEqual(dtt.call_args[0][1:], ([], 4, 2.0))
+            d.callback(q._exchange(*dtt.call_args[0][1:]))
+        self.assertEqual(len(q), 4)
+        self.assertEqual(len(busy), 1)
+        self.assertEqual(q.rqueue.loads()['idle'], 2.0)
+
+    def test_domain_slot_released_by_downloader(self, task):
+        q = DomainSmartQueue(self.server, self.spider, self.key)
+        q.push(Request('http://example.com/'))
+        q.lqueue.ready.clear()
+        q.lqueue.parked['example.com'] = None
+        self.spider.crawler.signals.send_catch_log(signals.request_left_downloader,
+                                                   request=Request('http://example.com/other'), spider=self.spider)
+        self.assertEqual(list(q.lqueue.ready), ['example.com'])
+
+    def test_choose_victim(self, task):
+        q = StealingSmartQueue(self.server, self.spider, self.key)
+        q.rqueue.node = 'me'
+        self.assertIsNone(q.choose_victim({'me': 5, 'a': 1}))
+        self.assertEqual(q.choose_victim({'me': 1, 'a': 3, 'b': 0}), 'a')
+        self.assertEqual(q.choose_victim({'me': 0, 'a': 3, 'b': 4}), 'b')
+
+    def test_prefetch_below_watermark(self, task):
+        q = SmartQueue(self.server, self.spider, self.key)
+        q.batch_size = 20
+        q.rqueue.push([Request('http://example.com/%s' % i) for i in range(30)])
+        q.push(Request('http://example.com/local'))
+        q.rlength = 30
+        d = defer.Deferred()
+        with mock.patch('scrapy_redis_loadbalancing.smartqueue.deferToThread', return_value=d) as dtt:
+            self.assertEqual(q.pop().url, 'http://example.com/local')
+            self.assertEqual(dtt.call_count, 1)
+            self.assertIs(q.inflight, d)
+            # a second pop while the batch is in flight does not start another fetch
+            self.assertIsNone(q.pop())
+            self.assertEqual(dtt.call_count, 1)
+
+            d.callback(q._exchange(*dtt.call_args[0][1:]))
+        self.assertIsNone(q.inflight)
+        self.assertEqual(len(q), q.batch_size)
+        stats = self.spider.crawler.stats
+        self.assertEqual(stats.get_value('smartqueue/prefetch/count'), 1)
+        self.assertEqual(stats.get_value('smartqueue/prefetch/starved'), 1)
+
+    def test_prefetch_amount_follows_watermark(self, task):
+        q = SmartQueue(self.server, self.spider, self.key)
+        q.batch_size = 20
+        q.rlength = 5000
+        with mock.patch('scrapy_redis_loadbalancing.smartqueue.deferToThread') as dtt:
+            with mock.patch.object(SmartQueue, 'watermark', new_callable=mock.PropertyMock, return_value=30):
+                q.check_prefetch()
+            self.assertEqual(dtt.call_args[0][2], 60)
+            q.inflight = None
+            with mock.patch.object(SmartQueue, 'watermark', new_callable=mock.PropertyMock, return_value=5000):
+                q.check_prefetch()
+            self.assertEqual(dtt.call_args[0][2], q.controller.batch_max)
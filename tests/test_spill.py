@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+
+from scrapy_redis_loadbalancing.spill import SpillFile
+
+
+class TestSpillFile(object):
+
+    def setup_method(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.spill = SpillFile(self.tmpdir, segment_size=64)
+
+    def teardown_method(self):
+        self.spill.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_write_read_in_order(self):
+        datas = [('record-%d' % i).encode() * (i + 1) for i in range(20)]
+        written = self.spill.write(datas[:10])
+        assert written == sum(len(d) + 4 for d in datas[:10])
+        assert len(self.spill) == 10
+        assert self.spill.read(3) == datas[:3]
+
+        # writing after a partial read goes to a new segment
+        self.spill.write(datas[10:])
+        assert len(self.spill) == 17
+        assert self.spill.read(100) == datas[3:]
+        assert len(self.spill) == 0
+        assert self.spill.bytes == 0
+        assert self.spill.read(1) == []
+
+    def test_segments_are_removed_when_consumed(self):
+        self.spill.write([b'x' * 40 for _ in range(10)])
+        assert len(os.listdir(self.spill.directory)) > 1
+        self.spill.read(10)
+        assert os.listdir(self.spill.directory) == []
+
+    def test_close_removes_directory(self):
+        self.spill.write([b'data'])
+        self.spill.close()
+        assert not os.path.exists(self.spill.directory)